@@ -715,6 +715,9 @@ class DatasetInline(BaseInlineAdmin):
     readonly_fields = ("name", "_online", "created_by", "created_datetime")
     ordering = ("name",)
 
+    def get_queryset(self, request):
+        return super(DatasetInline, self).get_queryset(request).select_related("availability")
+
     def _online(self, obj):
         return obj.is_online
 
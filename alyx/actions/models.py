@@ -8,7 +8,9 @@ from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils import timezone
 
-from alyx.base import BaseModel, modify_fields, alyx_mail, BaseManager
+from alyx.base import (
+    BaseModel, modify_fields, alyx_mail, BaseManager, ReferenceManager, reference_table
+)
 from misc.models import Lab, LabLocation, LabMember, Note
 
 import os
@@ -32,6 +34,7 @@ def _default_water_type():
     return None
 
 
+@reference_table
 @modify_fields(
     name={
         "blank": False,
@@ -42,6 +45,8 @@ class ProcedureType(BaseModel):
     A procedure to be performed on a subject.
     """
 
+    objects = ReferenceManager()
+
     description = models.TextField(blank=True, help_text="Detailed description of the procedure")
 
     def save(self, *args, **kwargs):
@@ -383,6 +388,10 @@ class Session(BaseAction):
 
     auto_datetime = models.DateTimeField(auto_now=True, blank=True, null=True, verbose_name="last updated")
 
+    class Meta:
+        # keyset pagination of the REST sessions list, see alyx.pagination.AlyxPagination
+        indexes = [models.Index(fields=["start_time", "id"], name="session_start_time_id_idx")]
+
     def save(self, *args, **kwargs):
         # Default project is the subject's project.
 
@@ -423,8 +432,9 @@ class Session(BaseAction):
             or self.number != original.number
             or self.subject != original.subject
         ):
-            for dataset in self.data_dataset_session_related.all():
-                dataset.save()
+            from data.models import update_relative_paths
+
+            update_relative_paths(session_ids=[self.pk])
 
     def update_json_whiskers_from_narrative(self):
         import re
@@ -1,21 +1,27 @@
+from collections import OrderedDict
+import threading
+
 from rest_framework import serializers
+from rest_framework.exceptions import ParseError
+from rest_framework.reverse import reverse
 from django.contrib.admin.models import LogEntry, ADDITION
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Max
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 import structlog
 
-from alyx.base import BaseSerializerEnumField, get_admin_url
+from alyx.base import BaseSerializerEnumField, SparseFieldsMixin, eager_loading, get_admin_url
 from .models import ProcedureType, Session, Surgery, WaterAdministration, Weighing, WaterType, WaterRestriction
 from subjects.models import Subject, Project
-from data.models import Dataset, DatasetType
+from data.models import Dataset, FileRecord
 from misc.models import LabLocation, Lab
 from experiments.serializers import ProbeInsertionListSerializer, FilterDatasetSerializer
 from misc.serializers import NoteSerializer
-from data.serializers import DatasetSerializer
+from data.serializers import DatasetSerializer, DatasetValuesSerializer
 from data.models import DataRepository
 
-from time import time
-
 SESSION_FIELDS = (
     "id",
     "subject",
@@ -47,6 +53,91 @@ SESSION_FIELDS = (
 logger = structlog.get_logger("actions.serializers")
 
 
+SESSION_DATASETS_CACHE_SIZE = 256  # Number of sessions whose nested datasets are kept in memory
+_session_datasets = OrderedDict()  # Map of (session id, base url) to (stamp, datasets)
+_session_datasets_lock = threading.Lock()
+
+
+def _session_datasets_stamp(session_id):
+    """
+    Return the number of datasets of a session, their last modification time and the last update
+    of their availability, which the bulk updates of the file records change without touching
+    the datasets. It changes with the bulk writes of other processes, which the signals below
+    don't see.
+    """
+    stamp = Dataset.objects.filter(session=session_id).aggregate(
+        n=Count("id"), last=Max("auto_datetime"), last_availability=Max("availability__updated")
+    )
+    return stamp["n"], stamp["last"], stamp["last_availability"]
+
+
+def session_datasets(session, request=None):
+    """
+    Return the serialized datasets of a session, as in the datasets list, ordered by creation
+    date. The list is cached per session and rebuilt when its datasets or file records change.
+
+    :param session: Session instance
+    :param request: request used to build the absolute urls
+    :return: list of dataset dicts
+    """
+    key = (session.pk, request.build_absolute_uri("/") if request is not None else None)
+    stamp = _session_datasets_stamp(session.pk)
+    with _session_datasets_lock:
+        cached = _session_datasets.get(key)
+        if cached is not None and cached[0] == stamp:
+            _session_datasets.move_to_end(key)
+            return cached[1]
+    queryset = DatasetSerializer.setup_eager_loading(Dataset.objects.filter(session=session.pk))
+    queryset = DatasetValuesSerializer.setup_values(queryset).order_by("created_datetime", "id")
+    context = {"request": request, "sparse_fields": False}
+    datasets = DatasetValuesSerializer(queryset, many=True, context=context).data
+    with _session_datasets_lock:
+        _session_datasets[key] = (stamp, datasets)
+        _session_datasets.move_to_end(key)
+        while len(_session_datasets) > SESSION_DATASETS_CACHE_SIZE:
+            _session_datasets.popitem(last=False)
+    return datasets
+
+
+def invalidate_session_datasets(session_ids=None):
+    """Drop the cached datasets of the given sessions, or of all of them if None"""
+    with _session_datasets_lock:
+        if session_ids is None:
+            _session_datasets.clear()
+            return
+        session_ids = set(session_ids)
+        for key in [key for key in _session_datasets if key[0] in session_ids]:
+            del _session_datasets[key]
+
+
+@receiver([post_save, post_delete], sender=Dataset)
+def _dataset_changed(sender, instance=None, **kwargs):
+    invalidate_session_datasets([instance.session_id])
+
+
+@receiver([post_save, post_delete], sender=FileRecord)
+def _file_record_changed(sender, instance=None, **kwargs):
+    invalidate_session_datasets(
+        Dataset.objects.filter(pk=instance.dataset_id).values_list("session_id", flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=Dataset.tags.through)
+def _dataset_tags_changed(sender, instance=None, pk_set=None, **kwargs):
+    if isinstance(instance, Dataset):
+        invalidate_session_datasets([instance.session_id])
+    elif pk_set is None:  # a tag cleared of all its datasets
+        invalidate_session_datasets()
+    else:
+        datasets = Dataset.objects.filter(pk__in=pk_set)
+        invalidate_session_datasets(datasets.values_list("session_id", flat=True))
+
+
+@receiver(post_save, sender=DataRepository)
+def _data_repository_saved(sender, **kwargs):
+    invalidate_session_datasets()
+
+
 def _log_entry(instance, user):
     if instance.pk:
         LogEntry.objects.log_action(
@@ -148,7 +239,7 @@ class SessionWaterAdminSerializer(serializers.ModelSerializer):
         fields = ("id", "name", "water_type", "water_administered")
 
 
-class SessionListSerializer(BaseActionSerializer):
+class SessionListSerializer(SparseFieldsMixin, BaseActionSerializer):
     projects = serializers.SlugRelatedField(
         read_only=False, slug_field="name", queryset=Project.objects.all(), many=True
     )
@@ -163,10 +254,17 @@ class SessionListSerializer(BaseActionSerializer):
         return get_admin_url(obj)
 
     @staticmethod
-    def setup_eager_loading(queryset):
-        """Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related("subject", "lab")
-        queryset = queryset.prefetch_related("projects")
+    def setup_eager_loading(queryset, fields=None):
+        """
+        Perform necessary eager loading of data to avoid horrible performance.
+        :param fields: optional names of the fields serialized, only their relations are loaded
+        """
+        queryset = eager_loading(
+            queryset,
+            fields,
+            select_related={"subject": ["subject"], "lab": ["lab"]},
+            prefetch_related={"projects": ["projects"]},
+        )
         return queryset.order_by("-start_time")
 
     class Meta:
@@ -185,9 +283,11 @@ class SessionListSerializer(BaseActionSerializer):
         )
 
 
-class SessionDetailSerializer(BaseActionSerializer):
+class SessionDetailSerializer(SparseFieldsMixin, BaseActionSerializer):
     # data_dataset_session_related = SessionDatasetsSerializer(read_only=True, many=True)
-    data_dataset_session_related = DatasetSerializer(read_only=True, many=True)
+    data_dataset_session_related = serializers.SerializerMethodField()
+    datasets_count = serializers.SerializerMethodField()
+    datasets_url = serializers.SerializerMethodField()
     wateradmin_session_related = SessionWaterAdminSerializer(read_only=True, many=True)
     probe_insertion = ProbeInsertionListSerializer(read_only=True, many=True)
     projects = serializers.SlugRelatedField(
@@ -222,24 +322,50 @@ class SessionDetailSerializer(BaseActionSerializer):
     def get_admin_url(self, obj):
         return get_admin_url(obj)
 
+    def _datasets(self, obj):
+        """Cached datasets of the session, computed once per serialized instance"""
+        if getattr(self, "_datasets_of", (None,))[0] != obj.pk:
+            self._datasets_of = (obj.pk, session_datasets(obj, self.context.get("request")))
+        return self._datasets_of[1]
+
+    def get_data_dataset_session_related(self, obj):
+        """
+        Datasets of the session, bounded to the first `?datasets_limit=N` ones if given. The
+        full list is paginated at `datasets_url`.
+        """
+        datasets = self._datasets(obj)
+        request = self.context.get("request")
+        limit = request.query_params.get("datasets_limit") if request is not None else None
+        if limit is None:
+            return datasets
+        if not limit.isdigit():
+            raise ParseError("datasets_limit must be a positive integer")
+        return datasets[: int(limit)]
+
+    def get_datasets_count(self, obj):
+        return len(self._datasets(obj))
+
+    def get_datasets_url(self, obj):
+        return reverse(
+            "session-datasets", kwargs={"pk": obj.pk}, request=self.context.get("request")
+        )
+
     @staticmethod
-    def setup_eager_loading(queryset):
-        queryset = queryset.prefetch_related(
-            "data_dataset_session_related",
-            "data_dataset_session_related__dataset_type",
-            "data_dataset_session_related__file_records",
-            "wateradmin_session_related",
-            "probe_insertion",
+    def setup_eager_loading(queryset, fields=None):
+        """
+        Perform necessary eager loading of data to avoid horrible performance.
+        :param fields: optional names of the fields serialized, only their relations are loaded
+        """
+        queryset = eager_loading(
+            queryset,
+            fields,
+            prefetch_related={
+                "wateradmin_session_related": ["wateradmin_session_related"],
+                "probe_insertion": ["probe_insertion"],
+            },
         )
         return queryset.order_by("-start_time")
 
-    def to_representation(self, instance):
-        start_time = time()
-        representation = super().to_representation(instance)
-        end_time = time()
-        logger.warning(f"Serializing {instance} took {end_time - start_time:.6f} seconds")
-        return representation
-
     class Meta:
         model = Session
         fields = SESSION_FIELDS + (
@@ -252,6 +378,8 @@ class SessionDetailSerializer(BaseActionSerializer):
             "default_data_repository_pk",
             "rel_path",
             "admin_url",
+            "datasets_count",
+            "datasets_url",
         )
 
 
@@ -49,6 +49,7 @@ urlpatterns = [
     path("procedures", av.ProcedureTypeList.as_view(), name="procedures-list"),
     path("sessions", av.SessionAPIList.as_view(), name="session-list"),
     path("sessions/<uuid:pk>", av.SessionAPIDetail.as_view(), name="session-detail"),
+    path("sessions/<uuid:pk>/datasets", av.SessionDatasetList.as_view(), name="session-datasets"),
     path("surgeries", av.SurgeriesList.as_view(), name="surgeries-list"),
     path(
         "water-administrations",
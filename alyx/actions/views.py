@@ -22,10 +22,15 @@ from alyx.base import (
     base_json_filter,
     rich_json_filter,
     BaseFilterSet,
+    ConditionalMixin,
+    ReferenceCacheMixin,
+    SparseFieldsViewMixin,
+    StreamingListMixin,
     rest_permission_classes,
 )
 
 from subjects.models import Subject
+from data.views import DatasetList
 from experiments.views import _filter_qs_with_brain_regions
 from .water_control import water_control, to_date
 from .training_control import training_control
@@ -246,7 +251,7 @@ def training_perf_plot(request, subject_id=None):
     return wc.plot()
 
 
-class ProcedureTypeList(generics.ListCreateAPIView):
+class ProcedureTypeList(ReferenceCacheMixin, generics.ListCreateAPIView):
     queryset = ProcedureType.objects.all()
     permission_classes = rest_permission_classes()
     serializer_class = ProcedureTypeSerializer
@@ -437,7 +442,9 @@ class WaterAdministrationFilter(BaseFilterSet):
         exclude = ["json"]
 
 
-class SessionAPIList(generics.ListCreateAPIView):
+class SessionAPIList(
+    ConditionalMixin, StreamingListMixin, SparseFieldsViewMixin, generics.ListCreateAPIView
+):
     """
         get: **FILTERS**
 
@@ -476,6 +483,17 @@ class SessionAPIList(generics.ListCreateAPIView):
         `/sessions?django=~project__name__icontains,matlab
         does the exclusive set: filters sessions that do not have matlab in the project name
 
+    **PAGINATION**: `/sessions?cursor=&limit=1000` pages by start time without offset nor
+    count, follow the `next` link of each page
+
+    **EXPORT**: `/sessions?format=ndjson&limit=all` streams all the sessions, one JSON per line
+
+    **FIELDS**: `/sessions?fields=id,subject,start_time` or `/sessions?exclude=projects,users`
+    only returns and loads the listed fields
+
+    **CACHING**: send back the `ETag` of a response in `If-None-Match` to get a 304 Not Modified
+    when the sessions didn't change
+
     [===> session model reference](/admin/doc/models/actions.session)
     """
 
@@ -484,6 +502,8 @@ class SessionAPIList(generics.ListCreateAPIView):
     permission_classes = rest_permission_classes()
 
     filter_class = SessionFilter
+    cursor_ordering = ("start_time", "id")
+    conditional_relations = {"projects": None, "users": None, "procedures": None}
 
     def get_serializer_class(self):
         if not self.request:
@@ -494,15 +514,43 @@ class SessionAPIList(generics.ListCreateAPIView):
             return SessionDetailSerializer
 
 
-class SessionAPIDetail(generics.RetrieveUpdateDestroyAPIView):
+class SessionAPIDetail(
+    ConditionalMixin, SparseFieldsViewMixin, generics.RetrieveUpdateDestroyAPIView
+):
     """
     Detail of one session
+
+    **DATASETS**: `/sessions/<id>?datasets_limit=100` only nests the first datasets, all of them
+    are listed at `datasets_url`: `/sessions/<id>/datasets`
     """
 
     queryset = Session.objects.all().order_by("-start_time")
     queryset = SessionDetailSerializer.setup_eager_loading(queryset)
     serializer_class = SessionDetailSerializer
     permission_classes = rest_permission_classes()
+    conditional_relations = {
+        "projects": None,
+        "users": None,
+        "procedures": None,
+        "data_dataset_session_related": "auto_datetime",
+        "data_dataset_session_related__availability": "updated",
+        "data_dataset_session_related__tags": None,
+        "wateradmin_session_related": None,
+        "probe_insertion": "auto_datetime",
+    }
+
+
+class SessionDatasetList(DatasetList):
+    """
+    get: Datasets of one session, ordered by creation date, with the filters, pagination and
+    fields of the datasets list: `/sessions/<id>/datasets?limit=100`
+    """
+
+    http_method_names = ["get", "head", "options"]
+
+    def get_queryset(self):
+        queryset = super().get_queryset().filter(session=self.kwargs["pk"])
+        return queryset.order_by("created_datetime", "id")
 
 
 class WeighingAPIListCreate(generics.ListCreateAPIView):
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import structlog
 import os
@@ -8,27 +9,38 @@ import sys
 import pytz
 import uuid
 from collections import OrderedDict
+from itertools import islice
 from rest_framework import serializers
 from datetime import datetime
 
 from django import forms
 from django.db import models
-from django.db.models import QuerySet
+from django.db.models import BigIntegerField, Count, Func, Max, QuerySet, Sum, TextField, Value
+from django.db.models.functions import Cast
 from django.db import connection
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.conf import settings
 from django.contrib import admin
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.mail import send_mail
 from django.core.management import call_command
+from django.http import StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.urls import reverse
 from django.utils import termcolors, timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.test import TestCase
 from django_filters import CharFilter
 from django_filters.rest_framework import FilterSet
 from rest_framework.views import exception_handler
 from rest_framework.exceptions import ParseError
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.response import Response
 
-from rest_framework import permissions, generics
+from rest_framework import permissions, generics, mixins
 from dateutil.parser import parse
 from reversion.admin import VersionAdmin
 from alyx import __version__ as version
@@ -449,23 +461,164 @@ class BaseInlineAdmin(admin.TabularInline):
     }
 
 
+# Reference tables cache
+# ------------------------------------------------------------------------------------------------
+
+REFERENCE_CACHE_TIMEOUT = 3600  # Default lifetime in seconds, see settings.REFERENCE_CACHE_TIMEOUT
+LOCAL_REFERENCE_CACHE_TIMEOUT = 60  # Default lifetime in seconds of a cache kept in each process
+_reference_models = set()
+_missing = object()
+
+
+def _generation_key(model):
+    return f"alyx:reference:{model._meta.label_lower}"
+
+
+def reference_cache_version(*models):
+    """
+    Return the current generation of the given reference tables. The generation of a table is a
+    random token stored in the cache and replaced on each write, so that all the entries derived
+    from it are dropped at once, in every process sharing the cache backend.
+    """
+    keys = [_generation_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            token = uuid.uuid4().hex
+            versions[key] = token if cache.add(key, token, None) else cache.get(key, token)
+    return ":".join(versions[key] for key in keys)
+
+
+def invalidate_reference_cache(*models):
+    """Drop the cached entries derived from the given models, if they are reference tables"""
+    for model in models:
+        if model in _reference_models:
+            cache.set(_generation_key(model), uuid.uuid4().hex, None)
+
+
+def reference_cache_timeout():
+    """
+    Return settings.REFERENCE_CACHE_TIMEOUT, or by default a short lifetime if the cache backend
+    is kept in each process, as the invalidations then only reach the process that wrote.
+    """
+    timeout = getattr(settings, "REFERENCE_CACHE_TIMEOUT", None)
+    if timeout is None:
+        local = isinstance(caches["default"], LocMemCache)
+        timeout = LOCAL_REFERENCE_CACHE_TIMEOUT if local else REFERENCE_CACHE_TIMEOUT
+    return timeout
+
+
+def cached_reference(models, key, compute, timeout=None, cache_empty=True):
+    """
+    Return the value of `compute()` from the cache shared by the processes (settings.CACHES),
+    computing and storing it on a miss.
+
+    :param models: reference tables the value is derived from, any write to them invalidates it
+    :param key: key of the value, unique for the given models
+    :param compute: function without argument returning the value, must be picklable
+    :param timeout: lifetime of the value in seconds, defaults to reference_cache_timeout()
+    :param cache_empty: if False, an empty value is recomputed on each call
+    :return: the value
+    """
+    version = reference_cache_version(*models)
+    key = "alyx:reference:" + hashlib.sha1(f"{version}:{key}".encode()).hexdigest()
+    value = cache.get(key, _missing)
+    if value is _missing:
+        value = compute()
+        if value or cache_empty:
+            cache.set(key, value, reference_cache_timeout() if timeout is None else timeout)
+    return value
+
+
+def get_reference(model, **lookup):
+    """
+    Cached equivalent of `model.objects.get(**lookup)` for a reference table. Missing rows are
+    not cached, so that the rows created by other processes are found at once.
+    """
+    key = "get:" + json.dumps(sorted(lookup.items()), default=str)
+    objects = cached_reference(
+        [model], key, lambda: list(model.objects.filter(**lookup)[:2]), cache_empty=False
+    )
+    if not objects:
+        raise model.DoesNotExist(f"{model._meta.object_name} matching query does not exist.")
+    if len(objects) > 1:
+        raise model.MultipleObjectsReturned(
+            f"get() returned more than one {model._meta.object_name}"
+        )
+    return objects[0]
+
+
+def _reference_table_changed(sender, **kwargs):
+    invalidate_reference_cache(sender)
+
+
+def _reference_relation_changed(sender, instance=None, model=None, **kwargs):
+    invalidate_reference_cache(type(instance), model)
+
+
+m2m_changed.connect(_reference_relation_changed)
+
+
+def reference_table(model):
+    """
+    Model class decorator registering a table that rarely changes, whose lookups and list
+    endpoints can be cached with `cached_reference`. The cache is invalidated by the saves,
+    deletions and many to many changes of its rows, and by the bulk updates of its
+    ReferenceQuerySet or BaseQuerySet.
+    """
+    _reference_models.add(model)
+    post_save.connect(_reference_table_changed, sender=model)
+    post_delete.connect(_reference_table_changed, sender=model)
+    return model
+
+
 class BaseQuerySet(models.QuerySet):
     def update(self, **kwargs):
         if "auto_datetime" in kwargs:
-            super(BaseQuerySet, self).update(**kwargs)
+            rows = super(BaseQuerySet, self).update(**kwargs)
         else:
-            super(BaseQuerySet, self).update(**kwargs, auto_datetime=timezone.now())
+            rows = super(BaseQuerySet, self).update(**kwargs, auto_datetime=timezone.now())
+        invalidate_reference_cache(self.model)
+        return rows
 
 
 BaseManager = models.Manager.from_queryset(BaseQuerySet)
 
 
+class ReferenceQuerySet(models.QuerySet):
+    """
+    QuerySet of a reference table whose bulk writes, which send no signal, invalidate its cache
+    """
+
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        invalidate_reference_cache(self.model)
+        return rows
+
+    def bulk_create(self, *args, **kwargs):
+        objs = super().bulk_create(*args, **kwargs)
+        invalidate_reference_cache(self.model)
+        return objs
+
+    def bulk_update(self, *args, **kwargs):
+        rows = super().bulk_update(*args, **kwargs)
+        invalidate_reference_cache(self.model)
+        return rows
+
+
+ReferenceManager = models.Manager.from_queryset(ReferenceQuerySet)
+
+
 class BaseTests(TestCase):
     @classmethod
     def setUpTestData(cls):
         globals()["DISABLE_MAIL"] = True
         call_command("loaddata", op.join(DATA_DIR, "all_dumped_anon.json.gz"), verbosity=1)
 
+    def _pre_setup(self):
+        super()._pre_setup()
+        cache.clear()  # the cached reference tables outlive the rolled back test transactions
+
     def ar(self, r, code=200):
         """
         Asserts that HTTP status code matches expected value and parse data with or without
@@ -732,6 +885,303 @@ def rest_permission_classes():
     return permission_classes
 
 
+def sparse_fields(request, field_names):
+    """
+    Return the field names requested by a GET request with `?fields=a,b` and / or
+    `?exclude=c,d`, in the serializer order, or None if no field selection is requested.
+
+    :param request: REST request, or None
+    :param field_names: names of all the fields of the serializer
+    :return: list of the selected field names or None
+    """
+    if request is None or request.method != "GET":
+        return None
+    params = request.query_params
+    fields, exclude = params.get("fields"), params.get("exclude")
+    if not fields and not exclude:
+        return None
+    field_names = list(field_names)
+    requested = {name.strip() for name in ",".join(filter(None, (fields, exclude))).split(",")}
+    if unknown := requested - set(field_names) - {""}:
+        raise ParseError("Unknown fields: %s. Valid fields are: %s" % (
+            ", ".join(sorted(unknown)), ", ".join(field_names)))
+    selected = set(field_names)
+    if fields:
+        selected &= {name.strip() for name in fields.split(",")}
+    if exclude:
+        selected -= {name.strip() for name in exclude.split(",")}
+    return [name for name in field_names if name in selected]
+
+
+def eager_loading(
+    queryset, fields=None, select_related=None, prefetch_related=None, annotations=None
+):
+    """
+    Eager load the relations and compute the annotations needed by the serialized fields.
+
+    :param queryset: queryset to set up
+    :param fields: names of the fields serialized, if None everything is loaded. Otherwise the
+     default select_related of the queryset are also dropped
+    :param select_related: dict {relation: [names of the fields using it]}
+    :param prefetch_related: dict {relation: [names of the fields using it]}
+    :param annotations: dict {annotation name: (expression, [names of the fields using it])}
+    :return: queryset
+    """
+
+    def needed(names):
+        return fields is None or not set(fields).isdisjoint(names)
+
+    if fields is not None:
+        queryset = queryset.select_related(None)
+    related = [name for name, names in (select_related or {}).items() if needed(names)]
+    if related:
+        queryset = queryset.select_related(*related)
+    prefetch = [name for name, names in (prefetch_related or {}).items() if needed(names)]
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    annotate = {
+        name: expression
+        for name, (expression, names) in (annotations or {}).items()
+        if needed(names)
+    }
+    if annotate:
+        queryset = queryset.annotate(**annotate)
+    return queryset
+
+
+class SparseFieldsMixin:
+    """
+    Serializer mixin returning only the fields selected with `?fields=` and / or `?exclude=`
+    (comma separated field names) on GET requests. The selection applies to the serializer of
+    the request, not to the nested ones. See also SparseFieldsViewMixin.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        root = self.root
+        if root is self or (isinstance(root, serializers.ListSerializer) and self.parent is root):
+            selected = sparse_fields(self.context.get("request"), fields)
+            if selected is not None:
+                fields = OrderedDict((name, fields[name]) for name in selected)
+        return fields
+
+
+class SparseFieldsViewMixin:
+    """
+    View mixin loading only the relations needed by the fields selected with `?fields=` and / or
+    `?exclude=`. The view's queryset must be `setup_eager_loading(Model.objects.all())` where
+    the serializer's `setup_eager_loading(queryset, fields=None)` only loads what the fields need.
+    Values serializers (see ValuesListMixin) declare their `model_serializer_class` for that.
+    """
+
+    def get_selected_fields(self):
+        """Return the names of the fields selected by the request, or None for all the fields"""
+        request = getattr(self, "request", None)
+        if request is None or not ({"fields", "exclude"} & set(request.query_params)):
+            return None
+        serializer = self.get_serializer()
+        if hasattr(serializer, "selected_fields"):
+            return serializer.selected_fields
+        return list(serializer.fields)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields = self.get_selected_fields()
+        serializer_class = self.get_serializer_class()
+        serializer_class = getattr(serializer_class, "model_serializer_class", serializer_class)
+        if fields is None or not hasattr(serializer_class, "setup_eager_loading"):
+            return queryset
+        return serializer_class.setup_eager_loading(queryset.model.objects.all(), fields=fields)
+
+
+class ValuesListMixin:
+    """
+    List view mixin serializing the GET requests with `values_serializer_class`, a read-only
+    serializer of the dicts returned by its `setup_values(queryset)` projection, which avoids
+    instantiating the models and walking their relations for each row. The filters apply to the
+    queryset before the projection; the other methods use the view's serializer class.
+    """
+
+    values_serializer_class = None
+
+    def _use_values(self):
+        method = getattr(self.request, "method", None)
+        return self.values_serializer_class is not None and method == "GET"
+
+    def get_serializer_class(self):
+        if self._use_values():
+            return self.values_serializer_class
+        return super().get_serializer_class()
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self._use_values():
+            queryset = self.values_serializer_class.setup_values(
+                queryset, fields=self.get_serializer().selected_fields)
+        return queryset
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Newline delimited JSON, one object per line, see StreamingListMixin"""
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        rows = data if isinstance(data, list) else [data]
+        return b"".join(ndjson_lines(rows))
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=JSONEncoder, ensure_ascii=False).encode() + b"\n"
+
+
+class StreamingListMixin:
+    """
+    List view mixin streaming the whole filtered queryset as newline delimited JSON with
+    `?format=ndjson`, e.g. `/datasets?format=ndjson&lab=cortexlab`.
+
+    The rows are fetched with a server side cursor and serialized by chunks of
+    `stream_chunk_size`, so that the memory used doesn't depend on the number of rows exported.
+    The pagination is bypassed: `limit=all` (or no limit) exports all the rows, and an integer
+    limit caps their number.
+    """
+
+    stream_chunk_size = 1000
+
+    def get_renderers(self):
+        return super().get_renderers() + [NDJSONRenderer()]
+
+    def list(self, request, *args, **kwargs):
+        if not isinstance(getattr(request, "accepted_renderer", None), NDJSONRenderer):
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        limit = request.query_params.get("limit", "all")
+        if limit != "all":
+            try:
+                queryset = queryset[: int(limit)]
+            except ValueError:
+                raise ParseError("limit must be an integer or 'all'")
+        response = StreamingHttpResponse(
+            self._stream(queryset), content_type=NDJSONRenderer.media_type
+        )
+        response["X-Accel-Buffering"] = "no"  # let a reverse proxy forward the rows as they come
+        return response
+
+    def _stream(self, queryset):
+        rows = queryset.iterator(chunk_size=self.stream_chunk_size)
+        while chunk := list(islice(rows, self.stream_chunk_size)):
+            yield b"".join(ndjson_lines(self.get_serializer(chunk, many=True).data))
+
+
+def _rows_hash(*lookups):
+    """Order independent hash of a set of rows: the sum of the hashes of their lookups' values"""
+    text = [Cast(lookup, output_field=TextField()) for lookup in lookups]
+    return Sum(
+        Func(*text, function="hashtext", arg_joiner=" || ':' || ", output_field=BigIntegerField())
+    )
+
+
+class ConditionalMixin:
+    """
+    List and detail view mixin answering the GET requests whose `If-None-Match` header matches
+    the current ETag with 304 Not Modified, before anything is serialized.
+
+    The weak ETag is a hash of the request url, format and user, and of the number, the hash
+    of the primary keys and the latest `conditional_field` timestamp of the rows of the
+    filtered queryset (or of the looked up object). `conditional_relations` maps the related
+    lookups nested in the representation to their timestamp field, or None to only count and
+    hash them. Everything is aggregated with a single query over the primary keys of the
+    queryset.
+
+    The validators are only computed, and returned, for the requests with an `If-None-Match`
+    header: a client revalidating the responses sends an empty tag (`If-None-Match: ""`) with
+    its first request. The latest timestamp is also returned as `Last-Modified`. Deleting rows
+    doesn't move it, so `If-Modified-Since` alone is not honoured. Changes to the names of the
+    related rows shown as slugs, e.g. a renamed project, don't change the ETag.
+    """
+
+    conditional_field = "auto_datetime"
+    conditional_relations = {}
+
+    def get_conditional_queryset(self):
+        """Return the filtered queryset of the list, or the looked up object of a detail"""
+        queryset = generics.GenericAPIView.filter_queryset(self, self.get_queryset())
+        if isinstance(self, mixins.RetrieveModelMixin):
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return queryset
+
+    def get_validators(self):
+        """Return the ETag and the last modification datetime (or None) of the response"""
+        queryset = self.get_conditional_queryset()
+        rows = queryset.model.objects.filter(pk__in=queryset.order_by().values("pk")).order_by()
+        # The rows, then each relation, are aggregated by a subquery returning a single row
+        relations = [(None, self.conditional_field), *self.conditional_relations.items()]
+        subqueries, params = [], []
+        for i, (relation, field) in enumerate(relations):
+            lookups = ("pk", relation) if relation else ("pk",)
+            aggregates = {f"n{i}": Count(lookups[-1]), f"hash{i}": _rows_hash(*lookups)}
+            if field is not None:
+                aggregates[f"last{i}"] = Max(f"{relation}__{field}" if relation else field)
+            subquery = rows.annotate(_all=Value(1)).values("_all").annotate(**aggregates)
+            sql, subquery_params = subquery.values(*aggregates).query.sql_with_params()
+            subqueries.append(f"({sql}) s{i}")
+            params.extend(subquery_params)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT * FROM " + " CROSS JOIN ".join(subqueries), params)
+            stats = dict(zip((column.name for column in cursor.description), cursor.fetchone()))
+        request = self.request
+        key = [
+            version,
+            request.build_absolute_uri(),
+            getattr(request, "accepted_media_type", None),
+            request.user.pk,
+            sorted(stats.items()),
+        ]
+        etag = hashlib.sha1(json.dumps(key, default=str).encode()).hexdigest()
+        last = [v for k, v in stats.items() if k.startswith("last") and v is not None]
+        return "W/" + quote_etag(etag), max(last, default=None)
+
+    def get(self, request, *args, **kwargs):
+        if "HTTP_IF_NONE_MATCH" not in request.META:
+            return super().get(request, *args, **kwargs)
+        etag, last_modified = self.get_validators()
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified.timestamp())
+        return response
+
+
+class ReferenceCacheMixin:
+    """
+    List view mixin caching the serialized GET responses of reference tables by url, see
+    `cached_reference`. They are invalidated by any write to `reference_models`, which defaults to
+    the model of the view's queryset. Changes to other related tables, e.g. a renamed user, are
+    only seen once the entries expire.
+    """
+
+    reference_models = None
+
+    def list(self, request, *args, **kwargs):
+        tables = self.reference_models or (self.queryset.model,)
+        data = cached_reference(
+            tables,
+            "list:" + request.build_absolute_uri(),
+            lambda: super(ReferenceCacheMixin, self).list(request, *args, **kwargs).data,
+        )
+        return Response(data)
+
+
 mysite = MyAdminSite()
 mysite.site_header = "Alyx"
 mysite.site_title = "Alyx"
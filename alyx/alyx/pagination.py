@@ -0,0 +1,196 @@
+"""
+REST pagination, kept apart from alyx.base which imports rest_framework.generics: the
+DEFAULT_PAGINATION_CLASS setting is imported by rest_framework.generics itself.
+"""
+import base64
+from collections import OrderedDict
+from datetime import datetime
+import json
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+COUNT_ESTIMATE_THRESHOLD = 100000  # Default of settings.PAGINATION_COUNT_ESTIMATE_THRESHOLD
+
+
+def estimate_count(queryset):
+    """
+    Return the Postgres planner estimate of the number of rows of a queryset: the table
+    statistics for an unfiltered queryset, the EXPLAIN estimate otherwise.
+
+    :param queryset: QuerySet
+    :return: int, or None if there is no estimate (lists, other databases, table never analyzed)
+    """
+    if not isinstance(queryset, QuerySet):
+        return None
+    connection_ = connections[queryset.db]
+    if connection_.vendor != "postgresql":
+        return None
+    query = queryset.query
+    with connection_.cursor() as cursor:
+        unfiltered = not (query.where or query.distinct or query.combinator)
+        if unfiltered and query.group_by is None:
+            cursor.execute(
+                "SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+            return int(row[0]) if row and row[0] >= 0 else None
+        sql, params = queryset.order_by().query.sql_with_params()
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class AlyxPagination(LimitOffsetPagination):
+    """
+    Limit / offset pagination, with an opt-in keyset (cursor) mode for the list views that declare
+    a `cursor_ordering`, e.g. `/datasets?cursor=&limit=1000`.
+
+    The count is exact unless the view declares `count_estimate = True`, or the request opts in
+    with `?count_estimate=true` (`?count_estimate=false` opts out): then, when the planner
+    estimates that the filtered queryset has
+    more rows than `settings.PAGINATION_COUNT_ESTIMATE_THRESHOLD` (0 disables it), the exact
+    count is skipped and the estimate is returned with `"count_estimated": true`. The estimate
+    is corrected by the rows fetched: it is made exact by a partial page, and raised so that a
+    full page always has a `next` link.
+
+    The cursor ordering is either the primary key, or a field and the primary key, such as
+    `("created_datetime", "id")`. Each page is fetched with a `WHERE field >= last value`
+    condition matching an index on those columns rather than with an offset, so that the late
+    pages cost as much as the first ones; the rows whose field is null come last. The total
+    count is not computed and the response only holds the `next` link, null on the last page.
+    """
+
+    cursor_query_param = "cursor"
+    count_estimate_query_param = "count_estimate"
+    cursor_mode = False
+    count_estimate = False
+    count_estimated = False
+
+    def get_count(self, queryset):
+        self.count_estimated = False
+        threshold = getattr(
+            settings, "PAGINATION_COUNT_ESTIMATE_THRESHOLD", COUNT_ESTIMATE_THRESHOLD
+        )
+        if self.count_estimate and threshold:
+            estimate = estimate_count(queryset)
+            if estimate is not None and estimate >= threshold:
+                self.count_estimated = True
+                return estimate
+        return super().get_count(queryset)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        ordering = getattr(view, "cursor_ordering", None)
+        self.cursor_mode = ordering is not None and self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            count_estimate = request.query_params.get(self.count_estimate_query_param)
+            if count_estimate is None:
+                self.count_estimate = getattr(view, "count_estimate", False)
+            else:
+                self.count_estimate = count_estimate.lower() in ("true", "1")
+            page = super().paginate_queryset(queryset, request, view)
+            if page is not None and self.count_estimated:
+                page = self._correct_estimate(queryset, page)
+            return page
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.ordering = ordering
+        position = self.decode_cursor(request, queryset.model)
+        page = self._keyset_page(queryset, position, self.limit + 1)
+        self.has_next = len(page) > self.limit
+        page = page[: self.limit]
+        if page:
+            last = page[-1]
+            # rows are model instances, or dicts for the views with a values serializer
+            self.position = [
+                last[f] if isinstance(last, dict) else getattr(last, f) for f in self.ordering
+            ]
+        return page
+
+    def _correct_estimate(self, queryset, page):
+        """Bound the estimated count by the rows of the page, fetched even past the estimate"""
+        if self.offset > self.count:
+            end = self.offset + self.limit
+            page = list(queryset[self.offset:end])
+        if len(page) == self.limit:
+            self.count = max(self.count, self.offset + self.limit + 1)
+        elif page or self.offset == 0:
+            self.count, self.count_estimated = self.offset + len(page), False
+        else:
+            self.count = min(self.count, self.offset)
+        return page
+
+    def _keyset_page(self, queryset, position, n):
+        """Return the n rows following the position, a list of the values of the ordering"""
+        pk = self.ordering[-1]
+        if len(self.ordering) == 1:
+            queryset = queryset.order_by(pk)
+            if position is not None:
+                queryset = queryset.filter(**{f"{pk}__gt": position[0]})
+            return list(queryset[:n])
+        field = self.ordering[0]
+        nulls = queryset.filter(**{f"{field}__isnull": True}).order_by(pk)
+        if position is not None and position[0] is None:
+            return list(nulls.filter(**{f"{pk}__gt": position[1]})[:n])
+        rows = queryset.filter(**{f"{field}__isnull": False}).order_by(field, pk)
+        if position is not None:
+            value, last = position
+            # the redundant lower bound lets Postgres start the index scan at the position
+            rows = rows.filter(**{f"{field}__gte": value}).filter(
+                Q(**{f"{field}__gt": value}) | Q(**{field: value, f"{pk}__gt": last})
+            )
+        page = list(rows[:n])
+        if len(page) < n:
+            page += list(nulls[: n - len(page)])
+        return page
+
+    def decode_cursor(self, request, model):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            assert len(values) == len(self.ordering)
+            return [
+                None if v is None else model._meta.get_field(f).to_python(v)
+                for f, v in zip(self.ordering, values)
+            ]
+        except Exception:
+            raise NotFound("Invalid cursor")
+
+    def encode_cursor(self, position):
+        values = [
+            None if v is None else v.isoformat() if isinstance(v, datetime) else str(v)
+            for v in position
+        ]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.position))
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            response = super().get_paginated_response(data)
+            if self.count_estimated:
+                response.data = OrderedDict(
+                    [
+                        ("count", self.count),
+                        ("count_estimated", True),
+                        *list(response.data.items())[1:],
+                    ]
+                )
+            return response
+        return Response(OrderedDict([("next", self.get_next_link()), ("results", data)]))
@@ -201,7 +201,7 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
     'STRICT_JSON': False,
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_PAGINATION_CLASS': 'alyx.pagination.AlyxPagination',
     # 'DEFAULT_RENDERER_CLASSES': (
     #     'rest_framework.renderers.JSONRenderer',
     # ),
@@ -227,6 +227,7 @@ STATIC_URL = '/static/'
 MEDIA_ROOT = '/backups/uploaded/'
 MEDIA_URL = '/uploaded/'
 TABLES_ROOT = '/backups/tables/'
+CACHE_SLICES_ROOT = '/backups/tables_slices/'
 
 UPLOADED_IMAGE_WIDTH = 800
 
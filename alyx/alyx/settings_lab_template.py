@@ -15,6 +15,23 @@ DEFAULT_LAB_NAME = "defaultlab"
 WATER_RESTRICTIONS_EDITABLE = False  # if set to True, all users can edit water restrictions
 # DEFAULT_LAB_PK = '6daeb82a-50ca-4ee9-ae97-50abfd3f50b6'
 SESSION_REPO_URL = "http://ibl.flatironinstitute.org/{lab}/Subjects/{subject}/{date}/{number:03d}/"
+# Cache of the reference tables (labs, projects, repositories, dataset types, data formats,
+# procedure types, brain regions) and of their REST lists, kept in each process by default. To
+# share it between the server processes, use e.g. the Redis backend:
+# {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://127.0.0.1:6379"}
+# or the file based or database backends
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "alyx",
+    }
+}
+# Lifetime of the cached reference tables in seconds, by default 60 with a cache kept in each
+# process, which does not see the writes of the other processes, and 3600 otherwise
+# REFERENCE_CACHE_TIMEOUT = 3600
+# Above this planner estimate of their number of rows, the datasets and file records REST lists,
+# and the other lists requested with ?count_estimate=true, return an estimated count
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = 100000
 NARRATIVE_TEMPLATES = {
     "Headplate implant": dedent(
         """
@@ -216,7 +216,7 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
     'STRICT_JSON': False,
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_PAGINATION_CLASS': 'alyx.pagination.AlyxPagination',
     # 'DEFAULT_RENDERER_CLASSES': (
     #     'rest_framework.renderers.JSONRenderer',
     # ),
@@ -247,6 +247,9 @@ MEDIA_URL = '/uploaded/'
 # May be a local path, http address or s3 uri (i.e. s3://)
 TABLES_ROOT = os.path.realpath(os.path.join(BASE_DIR, '../tables/'))
 
+# Local folder for memoizing the filtered cache tables served by the cache slice endpoint
+CACHE_SLICES_ROOT = os.path.realpath(os.path.join(BASE_DIR, '../tables_slices/'))
+
 UPLOADED_IMAGE_WIDTH = 800
 
 
@@ -1,5 +1,15 @@
-from django.test import TestCase
-from alyx.base import _custom_filter_parser
+from django.core.cache import cache
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from rest_framework.exceptions import ParseError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from alyx.base import (
+    LOCAL_REFERENCE_CACHE_TIMEOUT, _custom_filter_parser, cached_reference, get_reference,
+    reference_cache_timeout, sparse_fields)
+from data.models import DataRepository
+from misc.models import Lab
+from subjects.models import Project
 
 
 class BaseCustomFilterTest(TestCase):
@@ -26,3 +36,60 @@ class BaseCustomFilterTest(TestCase):
         def value_error_on_duplicate_field():
             _custom_filter_parser('toto,abc,toto,1')
         self.assertRaises(ValueError, value_error_on_duplicate_field)
+
+
+class SparseFieldsTest(TestCase):
+
+    def test_sparse_fields(self):
+        factory = APIRequestFactory()
+        names = ['id', 'name', 'session', 'tags']
+
+        def selected(query, method='get'):
+            return sparse_fields(Request(getattr(factory, method)('/' + query)), names)
+
+        self.assertIsNone(selected(''))
+        self.assertIsNone(selected('?fields=id', method='post'))
+        self.assertEqual(['id', 'name'], selected('?fields=name,id'))
+        self.assertEqual(['id', 'session'], selected('?exclude=name,tags'))
+        self.assertEqual(['id'], selected('?fields=id,name&exclude=name'))
+        self.assertRaises(ParseError, selected, '?fields=id,toto')
+
+
+class ReferenceCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_reference_cache(self):
+        lab = Lab.objects.create(name='cachelab')
+        self.assertEqual(lab, get_reference(Lab, name='cachelab'))
+        with self.assertNumQueries(0):
+            self.assertEqual(lab, get_reference(Lab, name='cachelab'))
+        with self.assertRaises(Lab.DoesNotExist):
+            get_reference(Lab, name='otherlab')
+        # missing rows are not cached, e.g. a lab created by another process is found at once
+        QuerySet(Lab).bulk_create([Lab(name='otherlab')])
+        self.assertEqual('otherlab', get_reference(Lab, name='otherlab').name)
+        # the cache kept in each process expires sooner
+        self.assertEqual(LOCAL_REFERENCE_CACHE_TIMEOUT, reference_cache_timeout())
+        with override_settings(REFERENCE_CACHE_TIMEOUT=10):
+            self.assertEqual(10, reference_cache_timeout())
+        calls = []
+
+        def compute():
+            calls.append(None)
+            return len(calls)
+
+        self.assertEqual(1, cached_reference([Lab, Project], 'key', compute))
+        self.assertEqual(1, cached_reference([Lab, Project], 'key', compute))
+        # saves, bulk updates and many to many changes invalidate the cache
+        Project.objects.create(name='cacheproject')
+        self.assertEqual(2, cached_reference([Lab, Project], 'key', compute))
+        Lab.objects.filter(pk=lab.pk).update(institution='somewhere')
+        self.assertEqual('somewhere', get_reference(Lab, name='cachelab').institution)
+        self.assertEqual(3, cached_reference([Lab, Project], 'key', compute))
+        lab.repositories.add(DataRepository.objects.create(name='cacherepo'))
+        self.assertEqual(4, cached_reference([Lab, Project], 'key', compute))
+        lab.delete()
+        with self.assertRaises(Lab.DoesNotExist):
+            get_reference(Lab, name='cachelab')
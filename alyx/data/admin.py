@@ -254,7 +254,9 @@ class DatasetAdmin(BaseExperimentalDataAdmin):
 
     def get_queryset(self, request):
         queryset = super(DatasetAdmin, self).get_queryset(request)
-        queryset = queryset.select_related("session", "session__subject", "created_by")
+        queryset = queryset.select_related(
+            "session", "session__subject", "created_by", "availability"
+        )
         return queryset
 
     def dataset_type_(self, obj):
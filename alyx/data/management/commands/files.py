@@ -1,10 +1,17 @@
+from itertools import islice
 import logging
+import time
+
 from django.core.management import BaseCommand
-from django.db.models import Count, Q
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q, Value
+from django.db.models.functions import Replace
+from django.utils import timezone
 
 from actions.models import Session
-from data import transfers
-from data.models import Dataset, DatasetType, DataRepository, FileRecord
+from data import scanner, transfers
+from data.models import (
+    Dataset, DataRepository, FileRecord, update_dataset_availability, update_relative_paths)
 from misc.models import Lab
 logging.getLogger(__name__).setLevel(logging.WARNING)
 
@@ -67,11 +74,103 @@ def _create_missing_file_records(dry_run=False):
                     print("Created %s" % fr)
 
 
+CHUNK_SIZE = 10000
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+class _Progress:
+    """Report the number of rows processed and the throughput, at most every `interval` seconds"""
+
+    def __init__(self, label, write=print, interval=5):
+        self.label, self.write, self.interval = label, write, interval
+        self.start = self.last = time.monotonic()
+        self.n = self.changed = 0
+
+    def update(self, n, changed=0, force=False):
+        self.n += n
+        self.changed += changed
+        now = time.monotonic()
+        if force or now - self.last >= self.interval:
+            self.last = now
+            self.write("%s: %d rows processed, %d updated (%.0f rows/s)" % (
+                self.label, self.n, self.changed, self.n / max(now - self.start, 1e-6)))
+
+
+def _syncfast(path, chunk_size=CHUNK_SIZE, dry=False, write=print):
+    """
+    Set exists=True on the file records whose absolute path is listed in a text file, and touch
+    the modification time of their datasets.
+    The file records are streamed by chunks and updated with a few queries per chunk.
+    """
+    with open(path, 'r') as f:
+        existing = {line.strip() for line in f}
+    existing.discard('')
+    progress = _Progress('syncfast', write)
+    # the file records of datasets without a data repository have no absolute path
+    frs = FileRecord.objects.filter(
+        exists=False, dataset__data_repository__isnull=False
+    ).values_list('pk', 'dataset__data_repository__globus_path', 'relative_path')
+    for chunk in _chunks(frs.iterator(chunk_size=chunk_size), chunk_size):
+        found = [pk for pk, *paths in chunk if transfers._absolute_path(*paths) in existing]
+        if found and not dry:
+            dataset_ids = FileRecord.objects.filter(pk__in=found).values('dataset')
+            with transaction.atomic():
+                FileRecord.objects.filter(pk__in=found).update(exists=True)
+                # the dataset modification time is what the caches and the REST filters rely on
+                Dataset.objects.filter(pk__in=dataset_ids).update(auto_datetime=timezone.now())
+                update_dataset_availability(dataset_ids.values_list('dataset', flat=True))
+        progress.update(len(chunk), len(found))
+    progress.update(0, force=True)
+    return progress.changed
+
+
+def _normalized_relative_path():
+    return Replace(Replace(F('relative_path'), Value('\\'), Value('/')), Value('//'), Value('/'))
+
+
+def _normalize_relative_paths(chunk_size=CHUNK_SIZE, dry=False, write=print):
+    """
+    Replace the back slashes and double slashes of the file records relative paths, in SQL.
+    The records whose normalized path would clash with an existing one are left untouched, and
+    of the records sharing a normalized path only the first one (by pk) is updated, with
+    DISTINCT ON. Paths with several consecutive slashes take more than one pass.
+    """
+    progress = _Progress('normalize_relative_paths', write)
+    while True:
+        to_fix = FileRecord.objects.filter(
+            Q(relative_path__contains='\\') | Q(relative_path__contains='//')
+        ).annotate(normalized=_normalized_relative_path()).exclude(
+            Exists(FileRecord.objects.filter(relative_path=OuterRef('normalized')))
+        ).values_list('normalized', 'pk').order_by('normalized', 'pk').distinct('normalized')
+        if dry:
+            progress.update(0, to_fix.count(), force=True)
+            return progress.changed
+        n = 0
+        ids = (pk for _, pk in to_fix.iterator(chunk_size=chunk_size))
+        for chunk in _chunks(ids, chunk_size):
+            n += FileRecord.objects.filter(pk__in=chunk).update(
+                relative_path=_normalized_relative_path())
+            progress.update(len(chunk), len(chunk))
+        if n == 0:
+            break
+    progress.update(0, force=True)
+    return progress.changed
+
+
 class Command(BaseCommand):
     """
         ./manage.py files bulksync --lab=cortexlab --dry
         ./manage.py files bulktransfer --lab=cortexlab --dry
         ./manage.py files removelocal --lab=churchlandlab --dry --before=2019-05-15 --limit=5
+        ./manage.py files relative_paths --session=<session_uuid> --collection=alf --dry
+        ./manage.py files reclassify --dry
+        ./manage.py files scan --data-repository=mainenlab_server --path=/mnt/data --incremental
+        ./manage.py files verify --data-repository=mainenlab_server --path=/mnt/data --hours=8
     """
     help = "Manage files"
 
@@ -86,6 +185,14 @@ class Command(BaseCommand):
         parser.add_argument('--limit', help='limit to a maximum number of datasets')
         parser.add_argument('--user', help='select datasets created by a given user')
         parser.add_argument('--before', help='select datasets before a given date')
+        parser.add_argument('--session', nargs='*', help='session UUID(s)')
+        parser.add_argument('--collection', help='dataset collection')
+        parser.add_argument('--incremental', action='store_true',
+                            help='only list the directories changed since the last scan')
+        parser.add_argument('--workers', type=int, help='number of worker processes')
+        parser.add_argument('--hours', type=float, help='maximum duration of the run')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='number of rows processed at a time')
 
     def handle(self, *args, **options):
         action = options.get('action')
@@ -159,14 +266,41 @@ class Command(BaseCommand):
                     transfers.update_file_exists(dataset)
 
         if action == 'syncfast':
-            with open(path, 'r') as f:
-                existing = {p.strip(): True for p in f.readlines()}
-            for fr in FileRecord.objects.filter(exists=False):
-                path = transfers._get_absolute_path(fr)
-                if existing.get(path, None):
-                    self.stdout.write("File %s exists, updating." % path)
-                    fr.exists = True
-                    fr.save()
+            _syncfast(path, chunk_size=options.get('chunk_size'), dry=dry, write=self.stdout.write)
+
+        if action in ('scan', 'verify'):
+            # reconcile the file records with the files of locally mounted repositories
+            if data_repository:
+                repos = DataRepository.objects.filter(name=data_repository)
+            elif lab:
+                repos = Lab.objects.get(name=lab).repositories.all()
+            else:
+                raise ValueError("Please specify a data_repository or a lab.")
+            if path and repos.count() > 1:
+                raise ValueError("The --path option requires a single data repository.")
+            for repo in repos:
+                if action == 'verify':
+                    hours = options.get('hours')
+                    counts = scanner.verify_repository(
+                        repo, root=path, io_concurrency=options.get('workers') or 2,
+                        limit=int(limit) if limit else None,
+                        max_duration=hours * 3600 if hours else None, dry=dry)
+                    self.stdout.write(
+                        "%s: %d files verified, %d hash mismatches, %d missing, %d without hash, "
+                        "%s%s" % (
+                            repo.name, counts['verified'], counts['mismatch'], counts['missing'],
+                            counts['no_hash'],
+                            'complete' if counts['complete'] else 'to be resumed',
+                            ' (dry)' if dry else ''))
+                    continue
+                counts = scanner.scan_repository(
+                    repo, root=path, incremental=options.get('incremental'),
+                    max_workers=options.get('workers'), dry=dry)
+                self.stdout.write(
+                    "%s: %d files, %d file records found, %d missing, %d file sizes updated, "
+                    "%d files not registered%s" % (
+                        repo.name, counts['files'], counts['exists'], counts['missing'],
+                        counts['file_size'], counts['unregistered'], ' (dry)' if dry else ''))
 
         if action == 'transfer':
             for dataset in _iter_datasets(dataset_id, limit=limit, user=user):
@@ -189,42 +323,43 @@ class Command(BaseCommand):
             dr.data_url = 'http://ibl.flatironinstitute.org/cortexlab/Subjects/'
             dr.save()
 
-            qs = DatasetType.objects.filter(filename_pattern__isnull=False)
-            dt = None
-            for d in FileRecord.objects.all().select_related('dataset'):
-                try:
-                    dt = transfers.get_dataset_type(d.relative_path, qs=qs)
-                except ValueError:
-                    dt = None
-                    continue
-                if d.dataset.dataset_type_id != dt.pk:
-                    print("Different dataset type for %s : old %s new %s" % (
-                        d.relative_path, d.dataset.dataset_type.name, dt.name))
-                    d.dataset.dataset_type_id = dt.pk
-                    d.dataset.save()
-                dt = None
+        if action in ('migrate', 'reclassify'):
+            # recompute the dataset types from the file names, e.g. after changing the patterns
+            datasets = Dataset.objects.filter(pk=dataset_id) if dataset_id else None
+            changes, conflicts = transfers.reclassify_datasets(
+                datasets=datasets, dry=dry, chunk_size=options.get('chunk_size'))
+            for change in changes:
+                self.stdout.write("%(file)s (%(dataset)s): %(old)s -> %(new)s" % change)
+            for conflict in conflicts:
+                self.stdout.write(self.style.WARNING(
+                    "Conflict for %s (%s): %s -> %s" % (
+                        conflict['file'], conflict['dataset'], conflict['old'],
+                        ', '.join(conflict['new']))))
+            self.stdout.write("%d datasets %s, %d conflicts" % (
+                len(changes), 'to reclassify' if dry else 'reclassified', len(conflicts)))
 
         if action == 'normalize_relative_paths':
-            for fr in FileRecord.objects.all():
-                p = fr.relative_path or ''
-                if '\\' in p:
-                    fr.relative_path = p.replace('\\', '/')
-                    try:
-                        fr.full_clean()
-                    except Exception as e:
-                        print(fr)
-                        print(e)
-                        continue
-                    fr.save()
-                if '//' in p:
-                    fr.relative_path = p.replace('//', '/')
-                    try:
-                        fr.full_clean()
-                    except Exception as e:
-                        print(fr)
-                        print(e)
-                        continue
-                    fr.save()
+            _normalize_relative_paths(
+                chunk_size=options.get('chunk_size'), dry=dry, write=self.stdout.write)
+
+        if action == 'relative_paths':
+            # recompute the file records relative paths of sessions / datasets / a collection
+            n = update_relative_paths(
+                session_ids=options.get('session'),
+                dataset_ids=[dataset_id] if dataset_id else None,
+                collection=options.get('collection'),
+                dry=dry,
+            )
+            self.stdout.write("%d file records relative paths %s" % (
+                n, 'to update' if dry else 'updated'))
+
+        if action == 'availability':
+            # rebuild the materialized dataset availability, e.g. after raw SQL updates
+            if dry:
+                self.stdout.write("%d datasets to update" % Dataset.objects.count())
+            else:
+                n = update_dataset_availability([dataset_id] if dataset_id else None)
+                self.stdout.write("%d datasets availability updated" % n)
 
         if action == 'autoregister':
             if not data_repository:
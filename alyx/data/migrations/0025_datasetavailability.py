@@ -0,0 +1,41 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+POPULATE = """
+INSERT INTO data_datasetavailability
+    (dataset_id, n_file_records, n_existing, on_server, on_personal, updated)
+SELECT ds.id, count(fr.id), count(fr.id) FILTER (WHERE fr.exists),
+    COALESCE(bool_or(fr.exists AND NOT repo.globus_is_personal), FALSE),
+    COALESCE(bool_or(fr.exists AND repo.globus_is_personal), FALSE),
+    now()
+FROM data_dataset ds
+LEFT JOIN data_filerecord fr ON fr.dataset_id = ds.id
+LEFT JOIN data_datarepository repo ON repo.id = ds.data_repository_id
+GROUP BY ds.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0024_filerec_relative_path_not_necessary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetAvailability',
+            fields=[
+                ('dataset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='availability', serialize=False, to='data.dataset')),
+                ('n_file_records', models.IntegerField(default=0, help_text='Number of file records')),
+                ('n_existing', models.IntegerField(db_index=True, default=0, help_text='Number of existing files')),
+                ('on_server', models.BooleanField(db_index=True, default=False, help_text='Whether a file exists on a server (Globus non personal) repository')),
+                ('on_personal', models.BooleanField(default=False, help_text='Whether a file exists on a Globus personal repository')),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'dataset availabilities',
+            },
+        ),
+        migrations.RunSQL(POPULATE, migrations.RunSQL.noop),
+    ]
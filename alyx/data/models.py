@@ -1,5 +1,7 @@
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import models, connection
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
@@ -7,7 +9,7 @@ from django.utils.functional import cached_property
 
 from alyx.settings import TIME_ZONE, AUTH_USER_MODEL
 from actions.models import Session
-from alyx.base import BaseModel, modify_fields, BaseManager, CharNullField
+from alyx.base import BaseModel, BaseManager, CharNullField, ReferenceManager, reference_table
 
 import os, re
 
@@ -20,11 +22,12 @@ def _related_string(field):
 # ------------------------------------------------------------------------------------------------
 
 
-class NameManager(models.Manager):
+class NameManager(ReferenceManager):
     def get_by_natural_key(self, name):
         return self.get(name=name)
 
 
+@reference_table
 class DataRepositoryType(BaseModel):
     """
     A type of data repository, e.g. local SAMBA file server; web archive; LTO tape
@@ -41,6 +44,7 @@ class DataRepositoryType(BaseModel):
         return "<DataRepositoryType '%s'>" % self.name
 
 
+@reference_table
 class DataRepository(BaseModel):
     """
     A data repository e.g. a particular local drive, specific cloud storage
@@ -128,6 +132,7 @@ class DataRepository(BaseModel):
 # ------------------------------------------------------------------------------------------------
 
 
+@reference_table
 class DataFormat(BaseModel):
     """
     A descriptor to accompany a Dataset or DataCollection, saying what sort of information is
@@ -181,6 +186,7 @@ class DataFormat(BaseModel):
         super(DataFormat, self).save(*args, **kwargs)
 
 
+@reference_table
 class DatasetType(BaseModel):
     """
     A descriptor to accompany a Dataset or DataCollection, saying what sort of information is
@@ -349,6 +355,16 @@ class BaseExperimentalData(BaseModel):
         abstract = True
 
 
+def sanitize_folders(folder_field):
+    if folder_field is None:
+        return (  # as it is a char field, we prefer saving an empty char rather than null
+            # when using no collection
+            ""
+        )
+    folder_field = folder_field.strip(".").strip("\\").strip("/")
+    return folder_field if folder_field == "" else os.path.normpath(folder_field)
+
+
 def default_dataset_type():
     return DatasetType.objects.get_or_create(name="unknown")[0].pk
 
@@ -500,18 +516,16 @@ class Dataset(BaseExperimentalData):
         ),
     )
 
+    class Meta:
+        # keyset pagination of the REST datasets list, see alyx.pagination.AlyxPagination
+        indexes = [models.Index(fields=["created_datetime", "id"], name="dataset_created_id_idx")]
+
     @property
     def is_online(self):
-        fr = self.file_records
-        if fr:
-            return all(
-                fr.values_list("exists", flat=True)
-            )  # If we want this to be somewhat usefull, it should be a field that is checked regularly
-            # (each week let's say. If the amount of file is not crazy, maybe each day during night ?)
-            # by a worker and files "existance" should be updated at that time.
-            # This may be usefull to probe for user error (like a massive deletion) and be able to react fast before
-            # the NAS backups are trashed.
-        else:
+        """Whether all the file records of the dataset exist, see DatasetAvailability"""
+        try:
+            return self.availability.online
+        except DatasetAvailability.DoesNotExist:
             return False
 
     @property
@@ -585,16 +599,6 @@ class Dataset(BaseExperimentalData):
 
     def save(self, *args, **kwargs):
         # when a dataset is saved / created make sure the probe insertion is set in the reverse m2m
-
-        def sanitize_folders(folder_field):
-            if folder_field is None:
-                return (  # as it is a char field, we prefer saving an empty char rather than null
-                    # when using no collection
-                    ""
-                )
-            folder_field = folder_field.strip(".").strip("\\").strip("/")
-            return folder_field if folder_field == "" else os.path.normpath(folder_field)
-
         self.collection = sanitize_folders(self.collection)
 
         if self.data_repository is None:
@@ -620,11 +624,9 @@ class Dataset(BaseExperimentalData):
 
         super(Dataset, self).save(*args, **kwargs)
 
-        # save childs file records to update the changed collection or dataset type, if necessary.
-        file_records = FileRecord.objects.filter(dataset=self)
-
-        for file_record in file_records:
-            file_record.save()
+        # update the childs file records relative paths to reflect the changed collection or
+        # dataset type, if necessary.
+        update_relative_paths(dataset_ids=[self.pk])
 
         # if self.collection is None:
         #    return
@@ -810,6 +812,228 @@ class FileRecord(BaseModel):
         return "<FileRecord '%s' by %s>" % (self.relative_path, self.dataset.created_by)
 
 
+def _relative_paths_sql(session_ids=None, dataset_ids=None, collection=None):
+    """
+    Return the SQL (and its parameters) of a `new_paths (id, path)` CTE recomputing the
+    relative path of the file records in the given scope, the same way as
+    `FileRecord.get_relative_path`: session alias / collection / #revision# / file name.
+    """
+    fr, ds, se, su, dt, df, rev = (
+        m._meta.db_table
+        for m in (FileRecord, Dataset, Session, Session._meta.get_field("subject").related_model,
+                  DatasetType, DataFormat, Revision)
+    )
+    extra = FileRecord._meta.get_field("extra").column
+    where, params = ["TRUE"], []
+    if session_ids is not None:
+        where.append("ds.session_id = ANY(%s::uuid[])")
+        params.append([str(pk) for pk in session_ids])
+    if dataset_ids is not None:
+        where.append("ds.id = ANY(%s::uuid[])")
+        params.append([str(pk) for pk in dataset_ids])
+    if collection is not None:
+        where.append("ds.collection = %s")
+        params.append(sanitize_folders(collection))
+    # NB: the session date is the UTC date as in `Session.alias`, the connection time zone
+    # being UTC
+    sql = f"""
+        new_paths AS (
+            SELECT fr.id AS id, concat_ws(
+                '/',
+                su.nickname || '/' || to_char(se.start_time, 'YYYY-MM-DD') || '/' ||
+                    COALESCE(
+                        lpad(se.number::text, greatest(3, length(se.number::text)), '0'), 'None'
+                    ),
+                NULLIF(ds.collection, ''),
+                NULLIF('#' || rev.name || '#', '##'),
+                dt.object || '.' || dt.attribute || COALESCE('.' || NULLIF(fr.{extra}, ''), '') ||
+                    df.file_extension
+            ) AS path
+            FROM {fr} fr
+            JOIN {ds} ds ON ds.id = fr.dataset_id
+            JOIN {se} se ON se.id = ds.session_id
+            JOIN {su} su ON su.id = se.subject_id
+            JOIN {dt} dt ON dt.id = ds.dataset_type_id
+            JOIN {df} df ON df.id = ds.data_format_id
+            LEFT JOIN {rev} rev ON rev.id = ds.revision_id
+            WHERE {" AND ".join(where)}
+        )"""
+    return sql, params
+
+
+def update_relative_paths(session_ids=None, dataset_ids=None, collection=None, dry=False):
+    """
+    Recompute the relative path of the file records of whole sessions, datasets and/or a
+    collection with a single UPDATE statement, instead of saving each file record.
+
+    The new paths are checked for collisions (between them and against the other file records)
+    in one query before anything is written.
+
+    :param session_ids: optional list of session primary keys
+    :param dataset_ids: optional list of dataset primary keys
+    :param collection: optional collection name, combined with the above
+    :param dry: if True, only count the file records whose path would change
+    :return: the number of file records whose relative path changed (or would change)
+    """
+    cte, params = _relative_paths_sql(
+        session_ids=session_ids, dataset_ids=dataset_ids, collection=collection
+    )
+    table = FileRecord._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH {cte}
+            SELECT path FROM new_paths GROUP BY path HAVING count(*) > 1
+            UNION
+            SELECT n.path FROM new_paths n JOIN {table} fr ON fr.relative_path = n.path
+            WHERE NOT EXISTS (SELECT 1 FROM new_paths n2 WHERE n2.id = fr.id)
+            LIMIT 10
+            """,
+            params,
+        )
+        collisions = [row[0] for row in cursor.fetchall()]
+        if collisions:
+            raise ValidationError(
+                "Two files with the same session relative path cannot exist: " +
+                ", ".join(collisions)
+            )
+        if dry:
+            cursor.execute(
+                f"""
+                WITH {cte}
+                SELECT count(*) FROM new_paths n JOIN {table} fr ON fr.id = n.id
+                WHERE fr.relative_path IS DISTINCT FROM n.path
+                """,
+                params,
+            )
+            return cursor.fetchone()[0]
+        cursor.execute(
+            f"""
+            WITH {cte}
+            UPDATE {table} AS fr SET relative_path = n.path FROM new_paths n
+            WHERE fr.id = n.id AND fr.relative_path IS DISTINCT FROM n.path
+            """,
+            params,
+        )
+        return cursor.rowcount
+
+
+class DatasetAvailability(models.Model):
+    """
+    Denormalized availability of a dataset, computed from its file records so that checking
+    whether a dataset exists is a single indexed lookup. The rows are kept up to date by
+    `update_dataset_availability`, called on file record and dataset saves and deletions, and
+    after the bulk writes that bypass the model signals. Any other queryset `update` or
+    `bulk_update` of the file records `exists` flag, or raw SQL write, must be followed by a call
+    to `update_dataset_availability`, or by a rebuild with `./manage.py files availability`.
+    """
+
+    dataset = models.OneToOneField(
+        Dataset, primary_key=True, related_name="availability", on_delete=models.CASCADE
+    )
+    n_file_records = models.IntegerField(default=0, help_text="Number of file records")
+    n_existing = models.IntegerField(
+        default=0, db_index=True, help_text="Number of existing files"
+    )
+    on_server = models.BooleanField(
+        default=False,
+        db_index=True,
+        help_text="Whether a file exists on a server (Globus non personal) repository",
+    )
+    on_personal = models.BooleanField(
+        default=False, help_text="Whether a file exists on a Globus personal repository"
+    )
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "dataset availabilities"
+
+    @property
+    def online(self):
+        """Whether the dataset has file records and all of them exist"""
+        return 0 < self.n_file_records == self.n_existing
+
+    def __str__(self):
+        return "<DatasetAvailability %s %d/%d>" % (
+            self.dataset_id, self.n_existing, self.n_file_records
+        )
+
+
+def update_dataset_availability(dataset_ids=None, create=True):
+    """
+    Recompute the availability of datasets from their file records with a single statement.
+
+    :param dataset_ids: optional list of dataset primary keys, defaults to all the datasets
+    :param create: if False, only the existing availability rows are updated. This is used on
+     deletions, where the dataset itself may be about to be deleted
+    :return: the number of datasets updated
+    """
+    av, ds, fr, repo = (
+        m._meta.db_table for m in (DatasetAvailability, Dataset, FileRecord, DataRepository)
+    )
+    where, params = "TRUE", []
+    if dataset_ids is not None:
+        dataset_ids = [str(pk) for pk in dataset_ids]
+        if not dataset_ids:
+            return 0
+        where, params = "ds.id = ANY(%s::uuid[])", [dataset_ids]
+    select = f"""
+        SELECT ds.id AS dataset_id, count(fr.id) AS n_file_records,
+            count(fr.id) FILTER (WHERE fr.exists) AS n_existing,
+            COALESCE(bool_or(fr.exists AND NOT repo.globus_is_personal), FALSE) AS on_server,
+            COALESCE(bool_or(fr.exists AND repo.globus_is_personal), FALSE) AS on_personal,
+            now() AS updated
+        FROM {ds} ds
+        LEFT JOIN {fr} fr ON fr.dataset_id = ds.id
+        LEFT JOIN {repo} repo ON repo.id = ds.data_repository_id
+        WHERE {where}
+        GROUP BY ds.id"""
+    columns = ("n_file_records", "n_existing", "on_server", "on_personal", "updated")
+    if create:
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns)
+        sql = f"""
+            INSERT INTO {av} (dataset_id, {", ".join(columns)}) {select}
+            ON CONFLICT (dataset_id) DO UPDATE SET {updates}"""
+    else:
+        sql = f"""
+            UPDATE {av} av SET {", ".join(f"{c} = s.{c}" for c in columns)}
+            FROM ({select}) s WHERE av.dataset_id = s.dataset_id"""
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+@receiver(post_save, sender=FileRecord)
+def _file_record_saved(sender, instance=None, **kwargs):
+    update_dataset_availability([instance.dataset_id])
+
+
+@receiver(post_delete, sender=FileRecord)
+def _file_record_deleted(sender, instance=None, **kwargs):
+    update_dataset_availability([instance.dataset_id], create=False)
+
+
+@receiver(post_save, sender=Dataset)
+def _dataset_saved(sender, instance=None, **kwargs):
+    update_dataset_availability([instance.pk])
+
+
+@receiver(pre_save, sender=DataRepository)
+def _data_repository_saving(sender, instance=None, update_fields=None, raw=False, **kwargs):
+    # the availability of the datasets only depends on the globus_is_personal flag
+    personal = update_fields is None or "globus_is_personal" in update_fields
+    changed = sender.objects.filter(pk=instance.pk).exclude(
+        globus_is_personal=instance.globus_is_personal
+    )
+    instance._availability_changed = not raw and personal and changed.exists()
+
+
+@receiver(post_save, sender=DataRepository)
+def _data_repository_saved(sender, instance=None, created=False, **kwargs):
+    if not created and instance._availability_changed:
+        update_dataset_availability(instance.dataset_set.values_list("pk", flat=True))
+
+
 # Download table
 # ------------------------------------------------------------------------------------------------
 
@@ -0,0 +1,312 @@
+"""
+Reconcile the file records of the repositories mounted on this server with the files on disk.
+
+The session folders of a repository are walked with `os.scandir` on a process pool. The
+resulting (relative_path, size, mtime) tuples are streamed in relative path order and merged with
+the file records of the repository, sorted the same way, so that neither side needs to be held in
+memory. The `exists` flags and dataset file sizes that differ are then updated in bulk.
+
+For incremental rescans, the modification time of each directory is saved after a scan: the
+files of a directory whose mtime didn't change are not listed again. As a directory mtime only
+changes when entries are added, removed or renamed, incremental scans don't detect files
+modified in place; run a full scan for that.
+
+The content of the files can also be checked against the hashes stored in the database, see
+`verify_repository`.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import os.path as op
+import time
+
+from django.db import transaction
+from django.db.models.functions import Collate
+from django.utils import timezone
+import structlog
+
+from data.models import Dataset, FileRecord, update_dataset_availability
+from data.transfers import get_config_path
+
+logger = structlog.get_logger(__name__)
+
+SCAN_BATCH_SIZE = 1000
+
+
+def scan_session_folder(root, session_path, dir_mtimes=None):
+    """
+    List the files of a session folder and its sub-folders.
+    :param root: local path of the repository root
+    :param session_path: path of the session folder relative to the root, e.g. subject/date/001
+    :param dir_mtimes: optional dict {relative directory path: mtime_ns} of a previous scan; the
+     files of the directories with the same mtime are not listed
+    :return: sorted list of (relative_path, size, mtime) tuples, dict {relative directory path:
+     mtime_ns} and set of the directories left unchanged
+    """
+    entries, mtimes, unchanged = [], {}, set()
+    stack = [session_path]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            mtime = os.stat(op.join(root, rel_dir)).st_mtime_ns
+            it = os.scandir(op.join(root, rel_dir))
+        except OSError:
+            continue
+        mtimes[rel_dir] = mtime
+        skip_files = dir_mtimes is not None and dir_mtimes.get(rel_dir) == mtime
+        if skip_files:
+            unchanged.add(rel_dir)
+        with it:
+            for entry in it:
+                rel_path = rel_dir + '/' + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(rel_path)
+                elif not skip_files and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((rel_path, stat.st_size, stat.st_mtime))
+    entries.sort()
+    return entries, mtimes, unchanged
+
+
+def _scan_session_folder(args):
+    return scan_session_folder(*args)
+
+
+def _state_path(data_repository, kind='scan'):
+    return get_config_path(op.join(kind, f'{data_repository.name}.json'))
+
+
+def _load_state(data_repository, kind='scan'):
+    path = _state_path(data_repository, kind)
+    if not op.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _save_state(data_repository, state, kind='scan'):
+    path = _state_path(data_repository, kind)
+    with open(path + '.part', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.part', path)
+
+
+def _session_folders(file_records):
+    """Return the sorted session folders (subject/date/number) of a file records queryset"""
+    sessions = set()
+    for relative_path in file_records.values_list('relative_path', flat=True).iterator():
+        parts = relative_path.strip('/').split('/')
+        if len(parts) > 3:
+            sessions.add('/'.join(parts[:3]))
+    # Sorting the folders with a trailing slash keeps the concatenated file lists sorted
+    return sorted(sessions, key=lambda s: s + '/')
+
+
+def _flush(file_records, datasets, dry=False):
+    now = timezone.now()
+    for dataset in datasets.values():
+        dataset.auto_datetime = now
+    if not dry:
+        with transaction.atomic():
+            FileRecord.objects.bulk_update(file_records, ['exists'])
+            Dataset.objects.bulk_update(datasets.values(), ['file_size', 'auto_datetime'])
+            update_dataset_availability(datasets.keys())
+    file_records.clear()
+    datasets.clear()
+
+
+def scan_repository(data_repository, root=None, incremental=False, max_workers=None, dry=False):
+    """
+    Update the `exists` flag of the file records of a repository, and the file size of their
+    datasets, from the files present on disk.
+    :param data_repository: DataRepository instance
+    :param root: local path of the repository root, defaults to the repository's data_path
+    :param incremental: if True, the files of the directories unchanged since the last scan are
+     not listed again and their file records are left untouched
+    :param max_workers: number of processes listing the session folders
+    :param dry: if True, the changes are reported but not saved
+    :return: dict with the number of files found, file records set to existing / missing,
+     dataset sizes updated and files on disk without file record
+    """
+    root = root or data_repository.data_path
+    file_records = FileRecord.objects.filter(dataset__data_repository=data_repository)
+    sessions = _session_folders(file_records)
+    previous = _load_state(data_repository) if incremental else {}
+    logger.info('Scanning %i session folders of %s in %s',
+                len(sessions), data_repository.name, root)
+
+    counts = dict(files=0, exists=0, missing=0, file_size=0, unregistered=0)
+    state, unchanged = {}, set()
+    changed_frs, changed_dsets = [], {}
+
+    def _iter_files(results):
+        for session, (entries, mtimes, session_unchanged) in zip(sessions, results):
+            state[session] = mtimes
+            unchanged.update(session_unchanged)
+            yield from entries
+
+    records = file_records.select_related(None).select_related('dataset').only(
+        'id', 'relative_path', 'exists', 'dataset__id', 'dataset__file_size'
+    ).order_by(Collate('relative_path', 'C')).iterator(chunk_size=SCAN_BATCH_SIZE)
+
+    args = [(root, session, previous.get(session)) for session in sessions]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        files = _iter_files(executor.map(_scan_session_folder, args))
+        # Sorted merge of the files on disk with the file records
+        file, fr = next(files, None), next(records, None)
+        while file is not None or fr is not None:
+            if fr is None or (file is not None and file[0] < fr.relative_path):
+                counts['unregistered'] += 1
+                counts['files'] += 1
+                file = next(files, None)
+                continue
+            if file is not None and file[0] == fr.relative_path:
+                counts['files'] += 1
+                exists, size = True, file[1]
+                file = next(files, None)
+            elif op.dirname(fr.relative_path) in unchanged:
+                fr = next(records, None)
+                continue
+            else:
+                exists, size = False, None
+            if fr.exists != exists:
+                fr.exists = exists
+                changed_frs.append(fr)
+                changed_dsets.setdefault(fr.dataset_id, fr.dataset)
+                counts['exists' if exists else 'missing'] += 1
+                logger.info('%s:%s exist set to %s',
+                            data_repository.name, fr.relative_path, exists)
+            if size is not None and fr.dataset.file_size != size:
+                fr.dataset.file_size = size
+                changed_dsets[fr.dataset_id] = fr.dataset
+                counts['file_size'] += 1
+            if len(changed_frs) + len(changed_dsets) >= SCAN_BATCH_SIZE:
+                _flush(changed_frs, changed_dsets, dry=dry)
+            fr = next(records, None)
+    _flush(changed_frs, changed_dsets, dry=dry)
+    if not dry:
+        _save_state(data_repository, state)
+    return counts
+
+
+HASH_BUFFER_SIZE = 8 * 1024 ** 2
+HASH_ALGORITHMS = {32: 'md5', 40: 'sha1'}  # hex digest length: algorithm
+
+
+def hash_file(path, algorithm='md5'):
+    """
+    Return the hex digest of a file, read with large buffered reads, or None if it doesn't exist.
+    """
+    h = hashlib.new(algorithm)
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            while n := f.readinto(buffer):
+                h.update(view[:n])
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def _hash_file(args):
+    return hash_file(*args)
+
+
+def verify_repository(data_repository, root=None, io_concurrency=2, limit=None,
+                      max_duration=None, dry=False):
+    """
+    Check the content of the existing files of a repository against their stored hash.
+
+    The expected hash is the file record's, or else its dataset's; the algorithm (md5 or sha1) is
+    inferred from its length. Files are hashed on a process pool whose size bounds the number of
+    concurrent reads on the repository. The file records whose file doesn't match are flagged
+    with a `mismatch_hash` key in their json field, which `bulk_sync` and `_bulk_transfer` look
+    for, and the flag is removed from those that match again.
+
+    The file records are verified in relative path order and the last path verified is saved
+    (under ~/.alyx/verify/), so that a verification stopped by `limit` or `max_duration` resumes
+    from there on the next call. The checkpoint is cleared once the whole repository is verified.
+
+    :param data_repository: DataRepository instance
+    :param root: local path of the repository root, defaults to the repository's data_path
+    :param io_concurrency: number of files read concurrently
+    :param limit: maximum number of files to verify in this run
+    :param max_duration: maximum duration of this run in seconds
+    :param dry: if True, mismatches are reported but not saved
+    :return: dict with the number of files verified, mismatched, missing and without hash, and
+     whether the whole repository has been verified
+    """
+    root = root or data_repository.data_path
+    checkpoint = _load_state(data_repository, 'verify').get('relative_path')
+    file_records = FileRecord.objects.filter(
+        dataset__data_repository=data_repository, exists=True,
+    ).select_related(None).select_related('dataset').only(
+        'id', 'relative_path', 'hash', 'json', 'dataset__id', 'dataset__hash'
+    ).alias(path=Collate('relative_path', 'C')).order_by('path')
+    if checkpoint:
+        logger.info('Resuming the verification of %s from %s', data_repository.name, checkpoint)
+        file_records = file_records.filter(path__gt=checkpoint)
+    if limit:
+        file_records = file_records[:limit]
+
+    counts = dict(verified=0, mismatch=0, missing=0, no_hash=0, complete=False)
+    deadline = time.monotonic() + max_duration if max_duration else None
+    pending, changed = deque(), []
+    last_path = checkpoint
+
+    def _collect(fr, future):
+        nonlocal last_path
+        digest = future.result()
+        last_path = fr.relative_path
+        if digest is None:
+            counts['missing'] += 1
+            return
+        counts['verified'] += 1
+        mismatch = digest != fr.expected_hash.lower()
+        json_ = fr.json or {}
+        if mismatch:
+            counts['mismatch'] += 1
+            logger.warning('%s:%s hash mismatch', data_repository.name, fr.relative_path)
+        if mismatch != ('mismatch_hash' in json_):
+            if mismatch:
+                fr.json = {**json_, 'mismatch_hash': True}
+            else:
+                fr.json = {k: v for k, v in json_.items() if k != 'mismatch_hash'} or None
+            changed.append(fr)
+
+    def _save():
+        if not dry:
+            FileRecord.objects.bulk_update(changed, ['json'])
+            _save_state(data_repository, {'relative_path': last_path}, 'verify')
+        changed.clear()
+
+    n_records, n_collected, interrupted = 0, 0, False
+    with ProcessPoolExecutor(max_workers=io_concurrency) as executor:
+        for fr in file_records.iterator(chunk_size=SCAN_BATCH_SIZE):
+            if deadline and time.monotonic() > deadline:
+                interrupted = True
+                break
+            n_records += 1
+            fr.expected_hash = fr.hash or fr.dataset.hash
+            if not fr.expected_hash or len(fr.expected_hash) not in HASH_ALGORITHMS:
+                counts['no_hash'] += 1
+                continue
+            algorithm = HASH_ALGORITHMS[len(fr.expected_hash)]
+            path = op.join(root, fr.relative_path)
+            pending.append((fr, executor.submit(_hash_file, (path, algorithm))))
+            # Keep a bounded number of files in flight, collected in order for the checkpoint
+            while len(pending) > 2 * io_concurrency:
+                _collect(*pending.popleft())
+                n_collected += 1
+                if n_collected % SCAN_BATCH_SIZE == 0:
+                    _save()
+        while pending:
+            _collect(*pending.popleft())
+    _save()
+    counts['complete'] = not interrupted and not (limit and n_records >= limit)
+    if counts['complete'] and not dry:
+        _save_state(data_repository, {}, 'verify')
+    return counts
@@ -1,6 +1,14 @@
+from collections import defaultdict
+from datetime import timezone as dt_timezone
+from functools import cached_property
+import os.path as op
+
 from django.contrib.auth import get_user_model
+from django.urls import reverse as django_reverse
 from rest_framework import serializers
-from django.db.models import Count, Q, BooleanField
+from rest_framework.reverse import reverse
+from django.db.models import Count, Q, BooleanField, CharField, F, Value
+from django.db.models.functions import Cast, LPad, TruncDate
 
 from .models import (
     DataRepositoryType,
@@ -14,7 +22,7 @@ from .models import (
     Tag,
 )
 from .transfers import _get_session, _change_default_dataset
-from alyx.base import get_admin_url
+from alyx.base import SparseFieldsMixin, eager_loading, get_admin_url, sparse_fields
 from actions.models import Session
 from subjects.models import Subject
 from misc.models import LabMember
@@ -138,7 +146,7 @@ class TagSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class DatasetSerializer(serializers.HyperlinkedModelSerializer):
+class DatasetSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     dataset_type_pk = serializers.PrimaryKeyRelatedField(
         source="dataset_type",
         read_only=False,
@@ -239,19 +247,27 @@ class DatasetSerializer(serializers.HyperlinkedModelSerializer):
         return get_admin_url(obj)
 
     @staticmethod
-    def setup_eager_loading(queryset):
-        """Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related(
-            "created_by", "dataset_type", "data_format", "session", "data_repository", "revision"
-        )
-        queryset = queryset.prefetch_related(
-            "file_records",
-            "tags",
-        )
+    def setup_eager_loading(queryset, fields=None):
+        """
+        Perform necessary eager loading of data to avoid horrible performance.
+        :param fields: optional names of the fields serialized, only their relations are loaded
+        """
         public = Count("tags", filter=Q(tags__public=True), output_field=BooleanField())
         protected = Count("tags", filter=Q(tags__protected=True), output_field=BooleanField())
-        queryset = queryset.annotate(public=public, protected=protected)
-        return queryset
+        return eager_loading(
+            queryset,
+            fields,
+            select_related={
+                "created_by": ["created_by"],
+                "dataset_type": ["dataset_type", "object", "attribute", "file_records"],
+                "data_format": ["data_format", "extension", "file_records"],
+                "session": ["session", "subject", "date", "number"],
+                "data_repository": ["data_repository", "remote_root"],
+                "revision": ["revision"],
+            },
+            prefetch_related={"file_records": ["file_records"], "tags": ["tags"]},
+            annotations={"public": (public, ["public"]), "protected": (protected, ["protected"])},
+        )
 
     def create(self, validated_data):
         # Get out some useful info
@@ -329,11 +345,283 @@ class DatasetSerializer(serializers.HyperlinkedModelSerializer):
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
-        if ("collection" not in representation.keys()) or representation["collection"] is None:
+        if "collection" in self.fields and representation.get("collection") is None:
             representation["collection"] = ""
         return representation
 
 
+# Read-only fast path of the list views: the rows are fetched with `values()` rather than as model
+# instances and the computed ALF parts are built from SQL annotations, without walking the
+# relations nor matching the session path regex. The output is the same as the model serializers.
+# ------------------------------------------------------------------------------------------------
+_PK_PLACEHOLDER = "00000000-0000-0000-0000-000000000000"
+
+
+def _session_path_annotations(prefix=""):
+    """Subject, date and zero padded number of the session alias, as in Session.alias"""
+    return dict(
+        _subject=F(f"{prefix}session__subject__nickname"),
+        _date=TruncDate(f"{prefix}session__start_time", tzinfo=dt_timezone.utc),
+        _number=LPad(Cast(f"{prefix}session__number", CharField()), 3, Value("0")),
+    )
+
+
+def _repository_annotations(prefix=""):
+    """Hostname and globus path of the data repository, DataRepository.data_path is a property"""
+    return dict(
+        _hostname=F(f"{prefix}data_repository__hostname"),
+        _globus_path=F(f"{prefix}data_repository__globus_path"),
+    )
+
+
+def _remote_root(row):
+    if row["_hostname"] is None:
+        return None
+    return DataRepository(hostname=row["_hostname"], globus_path=row["_globus_path"]).data_path
+
+
+def _url_formatter(view_name, request=None, admin=False):
+    """Return a function of a primary key building its detail or admin url, reversing once"""
+    if admin:
+        url = django_reverse(view_name, args=(_PK_PLACEHOLDER,))
+    else:
+        url = reverse(view_name, kwargs={"pk": _PK_PLACEHOLDER}, request=request)
+    prefix, suffix = url.split(_PK_PLACEHOLDER)
+    return lambda pk: prefix + str(pk) + suffix
+
+
+def _file_name(row, extra):
+    if row["_object"] is None or row["_extension"] is None:
+        return None
+    extra = "." + extra if extra else ""
+    return f"{row['_object']}.{row['_attribute']}{extra}{row['_extension']}"
+
+
+def _skip_missing(representation, row):
+    """
+    Remove the computed fields whose relation is null: the model serializers skip the read-only
+    fields whose source raises an AttributeError
+    """
+    missing = {
+        "_subject": ("subject", "date", "number", "full_path"),
+        "_remote_root": ("remote_root", "full_path"),
+        "_object": ("object", "attribute", "file_name", "full_path"),
+        "_extension": ("extension", "file_name", "full_path"),
+    }
+    for key, fields in missing.items():
+        if row[key] is None:
+            for field in fields:
+                representation.pop(field, None)
+    return representation
+
+
+class ValuesListSerializer(serializers.ListSerializer):
+    """Serializes a list of `values()` dicts, fetching what they need by batch"""
+
+    def to_representation(self, data):
+        rows = list(data)
+        self.child.prepare(rows)
+        return [self.child.to_representation(row) for row in rows]
+
+
+class ValuesSerializer(serializers.BaseSerializer):
+    """
+    Base read-only serializer of the dicts of `setup_values(queryset, fields=None)`. Subclasses
+    fetch the related rows of a whole page in `prepare` and build the representation in
+    `represent`. The fields selected with `?fields=` / `?exclude=` are those of the
+    `model_serializer_class` it stands for, unless the context sets `sparse_fields` to False.
+    """
+
+    model_serializer_class = None
+    datetime_field = serializers.DateTimeField()
+
+    class Meta:
+        list_serializer_class = ValuesListSerializer
+
+    @cached_property
+    def selected_fields(self):
+        if not self.context.get("sparse_fields", True):
+            return None
+        return sparse_fields(self.context.get("request"), self.model_serializer_class.Meta.fields)
+
+    def prepare(self, rows):
+        pass
+
+    def to_representation(self, row):
+        if "_prepared" not in row:
+            self.prepare([row])
+        representation = self.represent(row)
+        if (selected := self.selected_fields) is not None:
+            representation = {
+                name: representation[name] for name in selected if name in representation
+            }
+        return representation
+
+    def datetime(self, value):
+        return None if value is None else self.datetime_field.to_representation(value)
+
+
+class DatasetValuesSerializer(ValuesSerializer):
+    """Read-only equivalent of DatasetSerializer for the GET requests of the datasets list"""
+
+    model_serializer_class = DatasetSerializer
+
+    @staticmethod
+    def setup_values(queryset, fields=None):
+        """Project a queryset set up by DatasetSerializer.setup_eager_loading on dicts"""
+        annotated = [name for name in ("public", "protected") if fields is None or name in fields]
+        return queryset.prefetch_related(None).values(
+            "id", "name", "created_datetime", "file_size", "version", "auto_datetime",
+            "default_dataset", "collection", *annotated,
+            "data_repository_id", "data_format_id", "revision_id", "dataset_type_id", "session_id",
+            _created_by=F("created_by__username"),
+            _data_repository=F("data_repository__name"),
+            **_repository_annotations(),
+            _dataset_type=F("dataset_type__name"),
+            _object=F("dataset_type__object"),
+            _attribute=F("dataset_type__attribute"),
+            _extension=F("data_format__file_extension"),
+            _revision=F("revision__name"),
+            **_session_path_annotations(),
+        )
+
+    def prepare(self, rows):
+        ids = [row["id"] for row in rows]
+        selected = self.selected_fields
+        tags, file_records = defaultdict(list), defaultdict(list)
+        if selected is None or "tags" in selected:
+            for dataset_id, name in (
+                Dataset.tags.through.objects.filter(dataset_id__in=ids)
+                .order_by("tag__name").values_list("dataset_id", "tag__name")
+            ):
+                tags[dataset_id].append(name)
+        if selected is None or "file_records" in selected:
+            for fr in FileRecord.objects.select_related(None).filter(dataset_id__in=ids).values(
+                "id", "dataset_id", "relative_path", "extra", "exists", "hash"
+            ):
+                file_records[fr["dataset_id"]].append(fr)
+        request = self.context.get("request")
+        self._url = _url_formatter("dataset-detail", request)
+        self._admin_url = _url_formatter("admin:data_dataset_change", admin=True)
+        for row in rows:
+            row["_prepared"] = True
+            row["_remote_root"] = _remote_root(row)
+            row["_tags"] = tags[row["id"]]
+            row["_file_records"] = file_records[row["id"]]
+
+    def represent(self, row):
+        date, number = row["_date"], row["_number"]
+        session = None
+        if row["_subject"] is not None:
+            session = "_".join([row["_subject"], date.isoformat(), number])
+        representation = {
+            "id": str(row["id"]),
+            "url": self._url(row["id"]),
+            "admin_url": self._admin_url(row["id"]),
+            "name": row["name"],
+            "created_by": row["_created_by"],
+            "created_datetime": self.datetime(row["created_datetime"]),
+            "data_repository": row["_data_repository"],
+            "file_size": row["file_size"],
+            "version": row["version"],
+            "auto_datetime": self.datetime(row["auto_datetime"]),
+            "dataset_type": row["_dataset_type"],
+            "default_dataset": row["default_dataset"],
+            "protected": row.get("protected"),
+            "public": row.get("public"),
+            "tags": row["_tags"],
+            "session": session,
+            "data_format": row["_extension"],
+            "data_repository_pk": row["data_repository_id"],
+            "data_format_pk": row["data_format_id"],
+            "revision_pk": row["revision_id"],
+            "dataset_type_pk": row["dataset_type_id"],
+            "session_pk": row["session_id"],
+            "remote_root": row["_remote_root"],
+            "subject": row["_subject"],
+            "date": date.isoformat() if date else None,
+            "number": int(number) if number else None,
+            "collection": row["collection"] or "",
+            "revision": row["_revision"] or "",
+            "object": row["_object"],
+            "attribute": row["_attribute"],
+            "extension": row["_extension"],
+            "file_records": [
+                _skip_missing({
+                    "id": str(fr["id"]),
+                    "relative_path": fr["relative_path"],
+                    "extra": fr["extra"],
+                    "exists": fr["exists"],
+                    "file_name": _file_name(row, fr["extra"]),
+                    "hash": fr["hash"],
+                }, row)
+                for fr in row["_file_records"]
+            ],
+        }
+        return _skip_missing(representation, row)
+
+
+class FileRecordValuesSerializer(ValuesSerializer):
+    """Read-only equivalent of FileRecordSerializer for the GET requests of the files list"""
+
+    model_serializer_class = FileRecordSerializer
+
+    @staticmethod
+    def setup_values(queryset, fields=None):
+        return queryset.select_related(None).values(
+            "id", "dataset_id", "json", "relative_path", "exists", "hash", "extra",
+            **_repository_annotations("dataset__"),
+            _object=F("dataset__dataset_type__object"),
+            _attribute=F("dataset__dataset_type__attribute"),
+            _extension=F("dataset__data_format__file_extension"),
+            _revision=F("dataset__revision__name"),
+            _collection=F("dataset__collection"),
+            **_session_path_annotations("dataset__"),
+        )
+
+    def prepare(self, rows):
+        self._url = _url_formatter("filerecord-detail", self.context.get("request"))
+        self._admin_url = _url_formatter("admin:data_filerecord_change", admin=True)
+        for row in rows:
+            row["_prepared"] = True
+            row["_remote_root"] = _remote_root(row)
+
+    def represent(self, row):
+        date = row["_date"].isoformat() if row["_date"] else None
+        revision, collection = row["_revision"] or "", row["_collection"] or ""
+        file_name = _file_name(row, row["extra"])
+        full_path = None
+        if None not in (row["_subject"], row["_remote_root"], file_name):
+            # same as FileRecord.get_relative_path, with the hashed revision folder
+            session_path = "/".join([row["_subject"], date, row["_number"]])
+            hashed = f"#{revision}#" if revision else ""
+            relative_path = op.join(session_path, collection, hashed, file_name)
+            full_path = op.join(row["_remote_root"], relative_path)
+        representation = {
+            "id": str(row["id"]),
+            "url": self._url(row["id"]),
+            "admin_url": self._admin_url(row["id"]),
+            "dataset": row["dataset_id"],
+            "json": row["json"],
+            "file_name": file_name,
+            "full_path": full_path,
+            "relative_path": row["relative_path"],
+            "exists": row["exists"],
+            "hash": row["hash"],
+            "remote_root": row["_remote_root"],
+            "attribute": row["_attribute"],
+            "object": row["_object"],
+            "extension": row["_extension"],
+            "revision": revision,
+            "collection": collection,
+            "subject": row["_subject"],
+            "date": date,
+            "number": row["_number"],
+            "extra": row["extra"],
+        }
+        return _skip_missing(representation, row)
+
+
 class DownloadSerializer(serializers.HyperlinkedModelSerializer):
     # dataset = DatasetSerializer(many=False, read_only=True)
     dataset = serializers.PrimaryKeyRelatedField(many=False, read_only=True)
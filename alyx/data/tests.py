@@ -1,7 +1,49 @@
+from datetime import datetime, timezone
+import hashlib
+from pathlib import Path
+import tempfile
+import uuid
+from unittest import mock
+
+import globus_sdk
+from one.alf.files import add_uuid_string
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.db.utils import IntegrityError
-from data.models import Dataset, DatasetType
-from data.transfers import get_dataset_type
+from actions.models import Session
+from data.models import (
+    Dataset, DatasetType, DataFormat, DataRepository, FileRecord, Revision, Tag,
+    update_dataset_availability)
+from misc.models import Lab
+from data.scanner import scan_repository, verify_repository
+from data.transfers import (
+    get_dataset_type, get_dataset_types, bulk_sync, GlobusListingCache, GlobusSession,
+    reclassify_datasets, _create_dataset_file_records_bulk, _globus_transfer_filerecords,
+    _source_repositories)
+from subjects.models import Project, Subject
+
+
+def create_datasets(repositories, dataset_types=None, **kwargs):
+    """
+    Bulk create a dataset obj{i}.attr.npy per data repository, bypassing Dataset.save, in the
+    session subject/2020-01-01/001 of a project whose default repository is the first one.
+    The dataset types default to obj{i}.attr.
+    """
+    project, _ = Project.objects.get_or_create(
+        name='project', defaults={'default_data_repository': repositories[0]})
+    subject, _ = Subject.objects.get_or_create(nickname='subject')
+    session = Session.objects.filter(subject=subject, number=1).first() or \
+        Session.objects.create(subject=subject, project=project, number=1,
+                               start_time=datetime(2020, 1, 1, 12, tzinfo=timezone.utc))
+    data_format, _ = DataFormat.objects.get_or_create(file_extension='.npy')
+    dataset_types = dataset_types or [
+        DatasetType.objects.get_or_create(object=f'obj{i}', attribute='attr')[0]
+        for i in range(len(repositories))]
+    return Dataset.objects.bulk_create([
+        Dataset(name=f'{dt.name}.npy', session=session, dataset_type=dt, data_format=data_format,
+                data_repository=repo, **kwargs)
+        for dt, repo in zip(dataset_types, repositories)])
 
 
 class TestModel(TestCase):
@@ -12,6 +54,45 @@ class TestModel(TestCase):
         assert dset.is_protected is False
 
 
+class TestDatasetAvailability(TestCase):
+    def test_availability(self):
+        server = DataRepository.objects.create(name='server', globus_is_personal=False)
+        dset, = Dataset.objects.bulk_create(
+            [Dataset(name='obj.attr.npy', data_repository=server)])
+        fr0, fr1 = FileRecord.objects.bulk_create([
+            FileRecord(dataset=dset, relative_path=f'a/00{i}/obj.attr.npy', exists=True)
+            for i in range(2)])
+        self.assertFalse(dset.is_online)
+        # bulk writes bypass the signals and are followed by an explicit update
+        self.assertEqual(1, update_dataset_availability([dset.pk]))
+        dset = Dataset.objects.get(pk=dset.pk)
+        self.assertTrue(dset.is_online)
+        self.assertTrue(dset.availability.on_server)
+        self.assertFalse(dset.availability.on_personal)
+        FileRecord.objects.filter(pk=fr1.pk).update(exists=False)
+        update_dataset_availability()
+        dset = Dataset.objects.get(pk=dset.pk)
+        self.assertEqual((2, 1), (dset.availability.n_file_records, dset.availability.n_existing))
+        self.assertFalse(dset.is_online)
+        # the repository saves only update the availability when the personal flag changes
+        with mock.patch('data.models.update_dataset_availability') as update:
+            server.hostname = 'host'
+            server.save()
+            server.globus_is_personal = True
+            server.save(update_fields=['hostname'])
+            update.assert_not_called()
+            server.save()
+            update.assert_called_once()
+        server.globus_is_personal = False
+        server.save()
+        # deleting a file record updates the availability of its dataset
+        fr1.delete()
+        self.assertTrue(Dataset.objects.get(pk=dset.pk).is_online)
+        # deleting the dataset cascades to its file records and availability
+        dset.delete()
+        self.assertFalse(FileRecord.objects.filter(pk=fr0.pk).exists())
+
+
 class TestDatasetTypeModel(TestCase):
     def test_model_methods(self):
         dtype, _ = DatasetType.objects.get_or_create(
@@ -36,3 +117,321 @@ class TestDatasetTypeModel(TestCase):
         for filename, dataname in filename_typename:
             with self.subTest(filename=filename):
                 self.assertEqual(get_dataset_type(filename).name, dataname)
+
+    def test_batch_matching(self):
+        DatasetType.objects.create(object='foo', attribute='bar', filename_pattern='*FOO.b?r*')
+        DatasetType.objects.create(object='bar', attribute='baz', filename_pattern=None)
+        filenames = ['foo.bar.npy', 'bar.baz.ext', 'nothing.here.npy']
+        dtypes = get_dataset_types(filenames, strict=False)
+        self.assertEqual(['foo.bar', 'bar.baz', None], [getattr(d, 'name', None) for d in dtypes])
+        with self.assertRaises(ValueError):
+            get_dataset_types(['foo.bar.npy', 'nothing.here.npy'])
+        # the compiled matcher is rebuilt when a dataset type is saved
+        DatasetType.objects.create(
+            object='nothing', attribute='here', filename_pattern='nothing.*')
+        self.assertEqual(get_dataset_type('nothing.here.npy').name, 'nothing.here')
+        # ambiguous filenames are reported
+        DatasetType.objects.create(
+            object='nothing', attribute='else', filename_pattern='*.here.npy')
+        with self.assertRaises(ValueError):
+            get_dataset_type('nothing.here.npy')
+
+
+class TestReclassifyDatasets(TestCase):
+    def test_reclassify_datasets(self):
+        DatasetType.objects.create(object='spikes', attribute='times', filename_pattern='*.times*')
+        DatasetType.objects.create(object='spikes', attribute='amps', filename_pattern='*.amps*')
+        DatasetType.objects.create(object='clusters', attribute='amps', filename_pattern=None)
+        unknown = DatasetType.objects.create(name='unknown')
+        repo = DataRepository.objects.create(name='server')
+        datasets = create_datasets([repo] * 3, dataset_types=[unknown] * 3)
+        FileRecord.objects.bulk_create([
+            FileRecord(dataset=datasets[0], relative_path='s/2020-01-01/001/spikes.times.npy'),
+            FileRecord(dataset=datasets[1], relative_path='s/2020-01-01/001/spikes.amps.npy'),
+            FileRecord(dataset=datasets[1], relative_path='s/2020-01-01/001/x.times.npy'),
+            FileRecord(dataset=datasets[2], relative_path='s/2020-01-01/001/other.npy'),
+        ])
+        changes, conflicts = reclassify_datasets(dry=True)
+        self.assertEqual([(datasets[0].pk, 'unknown', 'spikes.times')],
+                         [(c['dataset'], c['old'], c['new']) for c in changes])
+        self.assertEqual([['spikes.amps', 'spikes.times']], [c['new'] for c in conflicts])
+        self.assertEqual('unknown', Dataset.objects.get(pk=datasets[0].pk).dataset_type.name)
+        # only the datasets whose type changed are written
+        reclassify_datasets()
+        dataset = Dataset.objects.get(pk=datasets[0].pk)
+        self.assertEqual('spikes.times', dataset.dataset_type.name)
+        self.assertEqual('spikes.times.npy', dataset.name)
+        self.assertEqual('unknown', Dataset.objects.get(pk=datasets[1].pk).dataset_type.name)
+
+
+class TestRegisterFilesBulk(TestCase):
+    def test_file_records_existence(self):
+        server = DataRepository.objects.create(name='server')
+        local = DataRepository.objects.create(name='local', globus_is_personal=True)
+        session = create_datasets((server,))[0].session
+        DatasetType.objects.create(object='spikes', attribute='times')
+        files = [dict(filename='spikes.times.npy', collection='alf', revision=None)]
+
+        def exists(**kwargs):
+            datasets, _ = _create_dataset_file_records_bulk(files, session=session, **kwargs)
+            return FileRecord.objects.get(dataset=datasets[0]).exists
+
+        # the files exist in the repository of their dataset if it is among those registered
+        self.assertTrue(exists(repositories=[server], exists_in=[server]))
+        self.assertFalse(exists(repositories=[server], exists_in=(None,)))
+        self.assertFalse(exists(repositories=[local], exists_in=[server]))
+        self.assertTrue(exists(exists_in=[local, server]))
+        # a dataset without repository has no existing file
+        Dataset.objects.filter(session=session).delete()
+        Session.objects.filter(pk=session.pk).update(default_data_repository=None)
+        Project.objects.update(default_data_repository=None)
+        session = Session.objects.get(pk=session.pk)
+        self.assertFalse(exists(repositories=[server], exists_in=(None,)))
+
+    def test_rollback(self):
+        server = DataRepository.objects.create(name='server')
+        dataset = create_datasets((server,))[0]
+        files = [dict(filename='obj0.attr.npy', collection='', revision='v1')]
+        # invalid fields are rejected before writing anything, including the new revisions
+        with self.assertRaises(ValidationError):
+            _create_dataset_file_records_bulk(
+                [dict(files[0], hash='0' * 65)], session=dataset.session, exists_in=[server])
+        self.assertFalse(Revision.objects.filter(name='v1').exists())
+        # so are the files registered along with a protected dataset
+        dataset.tags.add(Tag.objects.create(name='tag', protected=True))
+        DatasetType.objects.create(object='obj1', attribute='attr')
+        files = [dict(filename='obj0.attr.npy', collection='', revision=None),
+                 dict(filename='obj1.attr.npy', collection='', revision='v1')]
+        _, response = _create_dataset_file_records_bulk(files, session=dataset.session)
+        self.assertEqual(403, response.status_code)
+        self.assertFalse(Revision.objects.filter(name='v1').exists())
+        _create_dataset_file_records_bulk(files[1:], session=dataset.session)
+        self.assertTrue(Dataset.objects.filter(revision__name='v1').exists())
+
+
+class FakeTransferClient:
+    """Local stand-in for a globus_sdk.TransferClient, listing files from a dict"""
+    def __init__(self, files, disconnected=()):
+        self.files = files  # {(endpoint, directory): {file name: size}}
+        self.disconnected = {str(ep) for ep in disconnected}
+        self.ls_calls = []
+
+    def get_endpoint(self, endpoint):
+        connected = False if str(endpoint) in self.disconnected else None
+        return {'gcp_connected': connected, 'display_name': str(endpoint)}
+
+    def operation_ls(self, endpoint, path=None):
+        self.ls_calls.append((str(endpoint), path))
+        files = self.files.get((str(endpoint), path), {})
+        return [{'name': name, 'size': size, 'type': 'file'} for name, size in files.items()]
+
+
+class FakeTransferAPIError(globus_sdk.TransferAPIError):
+    def __init__(self, http_status):
+        self.http_status = http_status
+
+    def __str__(self):
+        return f'HTTP {self.http_status}'
+
+
+class TestGlobusSession(TestCase):
+    def test_retries(self):
+        client = mock.MagicMock()
+        client.operation_ls.side_effect = [FakeTransferAPIError(503), [{'name': 'a'}]]
+        session = GlobusSession(client=client, backoff=0)
+        self.assertEqual([{'name': 'a'}], session.operation_ls('endpoint', path='/'))
+        self.assertEqual(2, client.operation_ls.call_count)
+        # client errors are not retried
+        client.get_endpoint.side_effect = FakeTransferAPIError(404)
+        with self.assertRaises(globus_sdk.TransferAPIError):
+            session.get_endpoint('endpoint')
+        self.assertEqual(1, client.get_endpoint.call_count)
+        # other attributes are those of the client
+        self.assertIs(client.get_submission_id, session.get_submission_id)
+
+    def test_client_created_once(self):
+        factory = mock.MagicMock()
+        session = GlobusSession(client_factory=factory)
+        session.operation_ls('endpoint', path='/')
+        session.submit_transfer({})
+        factory.assert_called_once()
+
+
+class TestBulkSync(TestCase):
+    def setUp(self):
+        self.server = DataRepository.objects.create(
+            name='flatiron_server', globus_path='/server/', globus_endpoint_id=uuid.uuid4())
+        self.offline = DataRepository.objects.create(
+            name='flatiron_offline', globus_path='/offline/', globus_endpoint_id=uuid.uuid4())
+        self.datasets = create_datasets((self.server, self.server, self.offline), file_size=1)
+        FileRecord.objects.bulk_create([
+            FileRecord(dataset=d, relative_path=f'subject/2020-01-01/001/{d.name}',
+                       exists=False, json={'transfer_pending': True}) for d in self.datasets])
+
+    def test_bulk_sync(self):
+        d0, d1, d2 = self.datasets
+        ep, path = str(self.server.globus_endpoint_id), '/server/subject/2020-01-01/001'
+        gc = FakeTransferClient(
+            {(ep, path): {add_uuid_string(d0.name, d0.pk).as_posix(): 10}},
+            disconnected=[self.offline.globus_endpoint_id])
+        changed = bulk_sync(gc=gc, cache=GlobusListingCache())
+        # the directory is listed once and the unreachable endpoint is skipped
+        self.assertEqual([(ep, path)], gc.ls_calls)
+        self.assertEqual(1, len(changed))
+        fr = FileRecord.objects.get(dataset=d0)
+        self.assertTrue(fr.exists)
+        self.assertIsNone(fr.json)
+        self.assertEqual(10, Dataset.objects.get(pk=d0.pk).file_size)
+        for d in (d1, d2):
+            fr = FileRecord.objects.get(dataset=d)
+            self.assertFalse(fr.exists)
+            self.assertEqual({'transfer_pending': True}, fr.json)
+        # a shared listing cache spares the listing of the same directory
+        cache = GlobusListingCache()
+        bulk_sync(gc=gc, cache=cache)
+        bulk_sync(gc=gc, cache=cache)
+        self.assertEqual(2, len(gc.ls_calls))
+
+    def test_transfer_planning(self):
+        d0, d1, d2 = self.datasets
+        # the files of a session are transferred from a personal repository of its lab
+        lab = Lab.objects.create(name='lab')
+        local = DataRepository.objects.create(
+            name='local', globus_path='/local/', globus_endpoint_id=uuid.uuid4(),
+            globus_is_personal=True)
+        other = DataRepository.objects.create(
+            name='other', globus_path='/other/', globus_endpoint_id=uuid.uuid4(),
+            globus_is_personal=True)
+        aws = DataRepository.objects.create(
+            name='aws_local', globus_path='/aws/', globus_endpoint_id=uuid.uuid4(),
+            globus_is_personal=True)
+        lab.repositories.add(self.server, local, other, aws)
+        session = Session.objects.create(
+            subject=d0.session.subject, project=d0.session.project, lab=lab, number=2,
+            start_time=datetime(2020, 1, 1, 12, tzinfo=timezone.utc))
+        dataset = Dataset.objects.create(
+            session=session, dataset_type=d0.dataset_type, data_format=d0.data_format,
+            data_repository=self.server)
+        fr = FileRecord.objects.create(dataset=dataset, exists=False)
+        dfs = FileRecord.objects.filter(exists=False)
+        # the personal repositories outside of AWS are ranked by name
+        self.assertEqual({lab.pk: local}, _source_repositories(dfs))
+        # a transfer from the local to the server repository is planned
+        with self.assertNumQueries(5):
+            gc, tm = _globus_transfer_filerecords(dfs, dry=True)
+        self.assertIsNone(gc)
+        self.assertEqual((2, 3), tm.shape)
+        transfers = [t for t in tm.flat if t != 0]
+        self.assertEqual(1, len(transfers))
+        self.assertEqual(local.globus_endpoint_id, transfers[0]['source_endpoint'])
+        self.assertEqual(self.server.globus_endpoint_id, transfers[0]['destination_endpoint'])
+        destination = add_uuid_string(f'/server/{fr.relative_path}', dataset.pk).as_posix()
+        self.assertEqual([{'source_path': f'/local/{fr.relative_path}',
+                           'destination_path': destination}], transfers[0]['DATA'])
+        # the files of a session without a personal repository are flagged as missing
+        missing = FileRecord.objects.filter(json__has_key='local_missing')
+        self.assertEqual({d0.pk, d1.pk, d2.pk}, set(missing.values_list('dataset', flat=True)))
+
+
+class TestScanRepository(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmpdir.name)
+        self.repo = DataRepository.objects.create(name='local_server', globus_path='/data/')
+        self.datasets = create_datasets([self.repo] * 3)
+        self.file_records = FileRecord.objects.bulk_create([
+            FileRecord(dataset=d, relative_path=f'subject/2020-01-01/00{i}/alf/{d.name}',
+                       exists=i == 2) for i, d in enumerate(self.datasets)])
+        for fr in self.file_records[:2]:
+            (file := self.root / fr.relative_path).parent.mkdir(parents=True)
+            file.write_bytes(b'x' * 10)
+        (self.root / 'subject/2020-01-01/000/alf/unregistered.npy').touch()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_scan_repository(self):
+        config_path = lambda p: str(self.root / p.replace('/', '_'))  # noqa
+        with mock.patch('data.scanner.get_config_path', config_path):
+            counts = scan_repository(self.repo, root=self.root, max_workers=2)
+            self.assertEqual(
+                dict(files=3, exists=2, missing=1, file_size=2, unregistered=1), counts)
+            self.assertEqual([True, True, False], [
+                FileRecord.objects.get(pk=fr.pk).exists for fr in self.file_records])
+            self.assertEqual(10, Dataset.objects.get(pk=self.datasets[0].pk).file_size)
+            # an incremental rescan only lists the directories changed since
+            (self.root / self.file_records[0].relative_path).unlink()
+            counts = scan_repository(self.repo, root=self.root, incremental=True)
+            self.assertEqual(
+                dict(files=1, exists=0, missing=1, file_size=0, unregistered=1), counts)
+            self.assertFalse(FileRecord.objects.get(pk=self.file_records[0].pk).exists)
+            self.assertTrue(FileRecord.objects.get(pk=self.file_records[1].pk).exists)
+
+    def test_verify_repository(self):
+        fr0, fr1, fr2 = self.file_records
+        md5 = hashlib.md5(b'x' * 10).hexdigest()
+        # the flag of a file matching its hash again is removed
+        FileRecord.objects.filter(pk=fr0.pk).update(
+            exists=True, hash=md5, json={'mismatch_hash': True})
+        FileRecord.objects.filter(pk=fr1.pk).update(exists=True, json={'transfer_pending': True})
+        Dataset.objects.filter(pk=fr1.dataset_id).update(hash=hashlib.sha1(b'y').hexdigest())
+        Dataset.objects.filter(pk=fr2.dataset_id).update(hash=md5)
+        config_path = lambda p: str(self.root / p.replace('/', '_'))  # noqa
+        with mock.patch('data.scanner.get_config_path', config_path):
+            # stopped after the first file, the verification resumes from there
+            counts = verify_repository(self.repo, root=self.root, limit=1)
+            self.assertEqual(1, counts['verified'])
+            self.assertFalse(counts['complete'])
+            counts = verify_repository(self.repo, root=self.root)
+            self.assertEqual(dict(verified=1, mismatch=1, missing=1, no_hash=0, complete=True),
+                             counts)
+        self.assertIsNone(FileRecord.objects.get(pk=fr0.pk).json)
+        self.assertEqual({'transfer_pending': True, 'mismatch_hash': True},
+                         FileRecord.objects.get(pk=fr1.pk).json)
+
+
+class TestFilesCommand(TestCase):
+    def setUp(self):
+        self.repo = DataRepository.objects.create(name='server', globus_path='/data/')
+        self.datasets = create_datasets([self.repo] * 3)
+        paths = ['sub/2020-01-01/001/a.npy', 'sub\\2020-01-01\\001\\b.npy',
+                 'sub/2020-01-01//001///c.npy']
+        self.file_records = FileRecord.objects.bulk_create([
+            FileRecord(dataset=d, relative_path=p) for d, p in zip(self.datasets, paths)])
+
+    def test_syncfast(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('/data/sub/2020-01-01/001/a.npy\n/data/other.npy\n')
+        call_command('files', 'syncfast', path=f.name, chunk_size=2, stdout=mock.MagicMock())
+        Path(f.name).unlink()
+        exists = FileRecord.objects.filter(exists=True).values_list('pk', flat=True)
+        self.assertEqual([self.file_records[0].pk], list(exists))
+        # the modification time of the changed dataset is touched
+        d0, d1, _ = Dataset.objects.filter(
+            pk__in=[d.pk for d in self.datasets]).order_by('name')
+        self.assertGreater(d0.auto_datetime, d1.auto_datetime)
+        self.assertTrue(d0.is_online)
+
+    def test_syncfast_without_repository(self):
+        dataset = self.datasets[0]
+        Dataset.objects.filter(pk=dataset.pk).update(data_repository=None)
+        FileRecord.objects.create(dataset=dataset, exists=False)
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('/data/sub/2020-01-01/001/a.npy\n')
+        call_command('files', 'syncfast', path=f.name, stdout=mock.MagicMock())
+        Path(f.name).unlink()
+        self.assertFalse(FileRecord.objects.filter(exists=True).exists())
+
+    def test_normalize_relative_paths(self):
+        # two records whose paths normalize to the same path in the same pass
+        FileRecord.objects.bulk_create([
+            FileRecord(dataset=self.datasets[0], relative_path=p, extra='dup')
+            for p in ('sub\\2020-01-01\\001\\d.npy', 'sub/2020-01-01//001/d.npy')])
+        call_command('files', 'normalize_relative_paths', chunk_size=1, stdout=mock.MagicMock())
+        paths = FileRecord.objects.values_list('relative_path', flat=True)
+        self.assertEqual(
+            ['sub/2020-01-01/001/a.npy', 'sub/2020-01-01/001/b.npy', 'sub/2020-01-01/001/c.npy'],
+            sorted(paths.exclude(extra='dup')))
+        # only one of them is normalized, the other one is left untouched
+        self.assertEqual(1, paths.filter(relative_path='sub/2020-01-01/001/d.npy').count())
+        self.assertEqual(2, paths.filter(extra='dup').count())
@@ -1,12 +1,25 @@
 import datetime
+import json
 import os.path as op
+from unittest import mock
 import uuid
 
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
 
+from actions.models import Session
 from alyx.base import BaseTests
-from data.models import Dataset, FileRecord, Download, Tag
+from alyx.pagination import estimate_count
+from data.models import (
+    Dataset, DatasetType, DataFormat, DataRepository, FileRecord, Download, Revision, Tag)
+from data.serializers import DatasetSerializer, FileRecordSerializer
+from subjects.models import Project, Subject
 
 
 class APIDataTests(BaseTests):
@@ -808,3 +821,253 @@ class APIDataTests(BaseTests):
         # check that all modified_datetime fields are set to the value we chose
         for iurl, url in enumerate(dset_urls):
             self.assertEqual(self.client.get(url).data['auto_datetime'], mod_dates[0])
+
+
+class APIDatasetListTests(BaseTests):
+    """Dataset and file record lists: serialization, pagination, caching and registration"""
+
+    def setUp(self):
+        self.superuser = get_user_model().objects.create_superuser('test', 'test', 'test')
+        self.client.login(username='test', password='test')
+        self.repo = DataRepository.objects.create(
+            name='server', hostname='server', globus_path='/mnt/data/')
+        project = Project.objects.create(name='project', default_data_repository=self.repo)
+        subject = Subject.objects.create(nickname='subject')
+        self.subject = subject.nickname
+        start_time = datetime.datetime(2018, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        self.session = Session.objects.create(
+            subject=subject, project=project, number=1, start_time=start_time)
+        self.data_format = DataFormat.objects.create(name='e1', file_extension='.e1')
+        self.datasets = [
+            self.create_dataset('a.a'),
+            self.create_dataset('a.b', revision=Revision.objects.create(name='v1'), extra='001'),
+        ]
+        self.datasets[1].tags.add(Tag.objects.create(name='tag1', public=True))
+
+    def create_dataset(self, name, extra=None, **kwargs):
+        """Create a dataset of a new dataset type `name`, with an existing file record"""
+        object, attribute = name.split('.')
+        dataset_type = DatasetType.objects.create(
+            object=object, attribute=attribute, filename_pattern=name + '.*')
+        dataset = Dataset.objects.create(
+            session=self.session, dataset_type=dataset_type, data_format=self.data_format,
+            data_repository=self.repo, collection='alf', created_by=self.superuser, **kwargs)
+        FileRecord.objects.create(dataset=dataset, extra=extra, exists=True)
+        return dataset
+
+    def test_values_serializers(self):
+        # the GET lists use the values serializers, same output as the model serializers
+        request = Request(APIRequestFactory().get('/'))
+        for name, serializer_class, queryset in (
+                ('dataset-list', DatasetSerializer,
+                 DatasetSerializer.setup_eager_loading(Dataset.objects.all())),
+                ('filerecord-list', FileRecordSerializer,
+                 FileRecordSerializer.setup_eager_loading(FileRecord.objects.all()))):
+            expected = serializer_class(queryset, many=True, context={'request': request}).data
+            expected = json.loads(JSONRenderer().render(expected))
+            r = self.client.get(reverse(name))
+            self.assertEqual(200, r.status_code)
+            rows = json.loads(r.content)['results']
+            self.assertEqual(2, len(rows))
+            self.assertEqual(sorted(expected, key=lambda d: d['id']),
+                             sorted(rows, key=lambda d: d['id']))
+
+    def test_dataset_cursor_pagination(self):
+        dates = [datetime.datetime(2018, 1, day, 12, tzinfo=datetime.timezone.utc)
+                 for day in (3, 1, 2, 2)]
+        datasets = [self.create_dataset(f'cursor.d{i}', created_datetime=date)
+                    for i, date in enumerate(dates)]
+        Dataset.objects.filter(pk=datasets[0].pk).update(created_datetime=None)
+        expected = list(Dataset.objects.order_by('created_datetime', 'id').values_list(
+            'name', flat=True))
+        # pages of 3 datasets, without count, the null dates last
+        url, names = reverse('dataset-list') + '?cursor=&limit=3', []
+        while url:
+            r = self.ar(self.client.get(url))
+            self.assertNotIn('count', r)
+            self.assertLessEqual(len(r['results']), 3)
+            names.extend(d['name'] for d in r['results'])
+            url = r['next']
+        self.assertEqual(expected, names)
+        self.assertEqual(datasets[0].name, names[-1])
+        # filters still apply and the default pagination is unchanged
+        r = self.ar(self.client.get(reverse('dataset-list') + '?cursor=&created_date=2018-01-02'))
+        self.assertEqual(2, len(r['results']))
+        self.assertIsNone(r['next'])
+        r = self.client.get(reverse('dataset-list') + '?limit=2&offset=2')
+        self.assertEqual(len(expected), r.data['count'])
+        # an invalid cursor is a 404
+        self.ar(self.client.get(reverse('dataset-list') + '?cursor=invalid'), 404)
+
+    def test_dataset_ndjson_export(self):
+        self.create_dataset('a.c')
+        url = reverse('dataset-list') + '?format=ndjson&limit=all'
+        with mock.patch('data.views.DatasetList.stream_chunk_size', 2):
+            r = self.client.get(url)
+            self.assertTrue(r.streaming)
+            self.assertEqual('application/x-ndjson', r['Content-Type'])
+            lines = b''.join(r.streaming_content).decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual(3, len(rows))
+        self.assertEqual({'a.a.e1', 'a.b.e1', 'a.c.e1'}, {d['name'] for d in rows})
+        # the paginated list returns the same rows, filters and limits apply
+        paginated = self.ar(self.client.get(reverse('dataset-list')))
+        self.assertEqual(sorted(str(d['id']) for d in paginated), sorted(d['id'] for d in rows))
+        r = self.client.get(url.replace('limit=all', 'limit=1'))
+        self.assertEqual(1, len(b''.join(r.streaming_content).splitlines()))
+        r = self.client.get(reverse('dataset-list') + '?format=ndjson&dataset_type=a.b')
+        self.assertEqual(1, len(b''.join(r.streaming_content).splitlines()))
+
+    def test_session_datasets(self):
+        session = Session.objects.order_by('number').first()
+        datasets = self.ar(self.client.get(reverse('dataset-list') + f'?session={session.pk}'))
+        datasets = sorted(datasets, key=lambda d: (d['created_datetime'], d['id']))
+        url = reverse('session-detail', args=[session.pk])
+        d = self.ar(self.client.get(url))
+        self.assertEqual(2, d['datasets_count'])
+        self.assertEqual(datasets, d['data_dataset_session_related'])
+        # the nested datasets can be bounded, the full list is paginated in a sub-resource
+        d = self.ar(self.client.get(url + '?datasets_limit=1'))
+        self.assertEqual(datasets[:1], d['data_dataset_session_related'])
+        self.assertEqual(2, d['datasets_count'])
+        r = self.client.get(d['datasets_url'] + '?limit=1')
+        self.assertEqual(200, r.status_code)
+        r = r.data
+        self.assertEqual(2, r['count'])
+        self.assertEqual(datasets[:1], r['results'])
+        self.ar(self.client.get(url + '?datasets_limit=-1'), 400)
+        # the cached datasets are invalidated by the writes
+        dataset = Dataset.objects.get(pk=datasets[0]['id'])
+        dataset.tags.add(Tag.objects.create(name='tag2', public=True))
+        FileRecord.objects.filter(dataset=dataset).delete()
+        d = self.ar(self.client.get(url))
+        self.assertEqual(['tag2'], d['data_dataset_session_related'][0]['tags'])
+        self.assertEqual([], d['data_dataset_session_related'][0]['file_records'])
+
+    def test_conditional_requests(self):
+        url = reverse('dataset-list') + '?limit=10'
+        # the validators are only computed, in a single query, for the conditional requests
+        with CaptureQueriesContext(connection) as unconditional:
+            r = self.client.get(url)
+        self.assertNotIn('ETag', r)
+        with CaptureQueriesContext(connection) as conditional:
+            r = self.client.get(url, HTTP_IF_NONE_MATCH='""')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(len(unconditional) + 1, len(conditional))
+        etag = r['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertIn('Last-Modified', r)
+        # nothing changed: not modified, and nothing serialized
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, r.status_code)
+        self.assertEqual(b'', r.content)
+        # the validator depends on the query and on the rows and their nested relations
+        r = self.client.get(url + '&offset=1', HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(etag, r['ETag'])
+        dataset = Dataset.objects.first()
+        dataset.tags.add(Tag.objects.create(name='tag2', public=True))
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, r.status_code)
+        etag = r['ETag']
+        FileRecord.objects.filter(dataset=dataset).delete()
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, r.status_code)
+        # replacing a row by an older one changes neither the count nor the latest timestamp
+        dataset_type = DatasetType.objects.create(object='old', attribute='old')
+        old = Dataset(name='old.old.e1', session=self.session, dataset_type=dataset_type,
+                      data_format=self.data_format)
+        auto_datetime = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+        Dataset.objects.bulk_create([old])
+        Dataset.objects.filter(pk=old.pk).update(auto_datetime=auto_datetime)
+        etag = self.client.get(url, HTTP_IF_NONE_MATCH=etag)['ETag']
+        old.delete()
+        old.pk = uuid.uuid4()
+        Dataset.objects.bulk_create([old])
+        Dataset.objects.filter(pk=old.pk).update(auto_datetime=auto_datetime)
+        self.assertEqual(200, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        # detail views
+        url = reverse('dataset-detail', args=[dataset.pk])
+        etag = self.client.get(url, HTTP_IF_NONE_MATCH='""')['ETag']
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        dataset.save()
+        self.assertEqual(200, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        # the session detail aggregates its nested relations
+        url = reverse('session-detail', args=[self.session.pk])
+        etag = self.client.get(url, HTTP_IF_NONE_MATCH='""')['ETag']
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        dataset.tags.clear()
+        self.assertEqual(200, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+    def test_estimated_count(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE data_dataset')
+            cursor.execute('ANALYZE actions_session')
+        self.assertEqual(2, estimate_count(Dataset.objects.all()))
+        self.assertIsNotNone(estimate_count(Dataset.objects.filter(collection='alf').distinct()))
+        url = reverse('dataset-list')
+        with override_settings(PAGINATION_COUNT_ESTIMATE_THRESHOLD=1):
+            # the datasets list estimates its count unless the exact count is requested
+            r = self.client.get(url + '?limit=1&count_estimate=false')
+            self.assertNotIn('count_estimated', r.data)
+            r = self.client.get(url + '?limit=1')
+            self.assertTrue(r.data['count_estimated'])
+            self.assertEqual(1, len(r.data['results']))
+            self.assertIsNotNone(r.data['next'])
+            # a partial page gives the exact count
+            r = self.client.get(url + '?limit=10')
+            self.assertNotIn('count_estimated', r.data)
+            self.assertEqual(2, r.data['count'])
+            # the other lists only estimate their count on request
+            r = self.client.get(reverse('session-list') + '?limit=1')
+            self.assertNotIn('count_estimated', r.data)
+            r = self.client.get(reverse('session-list') + '?limit=1&count_estimate=true')
+            self.assertTrue(r.data['count_estimated'])
+        # below the threshold, the count is exact
+        r = self.client.get(url + '?limit=1')
+        self.assertNotIn('count_estimated', r.data)
+        self.assertEqual(2, r.data['count'])
+
+    def test_dataset_sparse_fields(self):
+        r = self.ar(self.client.get(reverse('dataset-list') + '?fields=id,name,session'))
+        self.assertEqual(2, len(r))
+        self.assertEqual({'id', 'name', 'session'}, set(r[0]))
+        r = self.ar(self.client.get(reverse('dataset-list') + '?exclude=file_records,tags,public'))
+        self.assertNotIn('file_records', r[0])
+        self.assertIn('protected', r[0])
+        self.ar(self.client.get(reverse('dataset-list') + '?fields=id,toto'), 400)
+        # the detail view returns the selected fields too
+        r = self.ar(self.client.get(reverse('dataset-detail', args=[r[0]['id']]) + '?fields=name'))
+        self.assertEqual(['name'], list(r))
+
+    def test_register_files_bulk(self):
+        # files differing only by their extra are file records of the same dataset
+        data = {'path': '%s/2018-01-01/1/dir' % self.subject,
+                'filenames': 'a.a.e1,a.a.00.e1,a.a.01.e1,a.b.e1',
+                'name': 'server',
+                }
+        r = self.ar(self.post(reverse('register-file'), data), 201)
+        self.assertEqual(len(r), 4)
+        self.assertEqual(len({d['id'] for d in r}), 2)
+        ds = Dataset.objects.get(name='a.a.e1', collection='dir')
+        self.assertEqual(ds.file_records.count(), 3)
+        self.assertEqual(set(ds.file_records.values_list('extra', flat=True)), {'', '00', '01'})
+        self.assertEqual(len(r[0]['file_records']), 3)
+        # registering the same files again doesn't duplicate anything
+        self.ar(self.post(reverse('register-file'), data), 201)
+        datasets = Dataset.objects.filter(name__in=('a.a.e1', 'a.b.e1'), collection='dir')
+        self.assertEqual(datasets.count(), 2)
+        self.assertEqual(FileRecord.objects.filter(dataset=ds).count(), 3)
+
+    def test_relative_paths_update(self):
+        data = {'path': '%s/2018-01-01/1/dir' % self.subject,
+                'filenames': 'a.a.e1,a.a.00.e1',
+                'name': 'server',
+                }
+        self.ar(self.post(reverse('register-file'), data), 201)
+        # changing the collection rewrites the relative paths of all the file records
+        ds = Dataset.objects.get(name='a.a.e1', collection='dir')
+        ds.collection = 'newdir'
+        ds.save()
+        session_path = '%s/2018-01-01/001' % self.subject
+        self.assertEqual(set(ds.file_records.values_list('relative_path', flat=True)),
+                         {session_path + '/newdir/a.a.e1', session_path + '/newdir/a.a.00.e1'})
@@ -3,20 +3,34 @@ import structlog
 import os
 import os.path as op
 import re
+import threading
 import time
+from collections import defaultdict
+from itertools import groupby, islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from fnmatch import fnmatch
+from fnmatch import translate
 
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.db.models import Case, When, Count, Q, F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 import globus_sdk
 import numpy as np
 from one.alf.files import filename_parts, add_uuid_string
 from one.alf.spec import is_valid
 
 from alyx import settings
-from data.models import FileRecord, Dataset, DatasetType, DataFormat, DataRepository
+from alyx.base import cached_reference, get_reference
+from data.models import (
+    FileRecord, Dataset, DatasetType, DataFormat, DataRepository, Revision, sanitize_folders,
+    update_dataset_availability, update_relative_paths)
 from rest_framework.response import Response
 from actions.models import Session
+from misc.models import Lab
 
 logger = structlog.get_logger(__name__)
 
@@ -65,24 +79,167 @@ def get_globus_transfer_rt():
         return json.load(f).get('transfer_rt', None)
 
 
+def _save_globus_access_token(token_response):
+    """Store a refreshed access token with the refresh token, for the next processes"""
+    path = get_config_path('globus-token.json')
+    data = token_response.by_resource_server['transfer.api.globus.org']
+    with open(path, 'r') as f:
+        tokens = json.load(f)
+    tokens.update(transfer_at=data['access_token'], expires_at_s=data['expires_at_seconds'])
+    with open(path, 'w') as f:
+        json.dump(tokens, f, indent=2, sort_keys=True)
+
+
 def globus_transfer_client():
-    transfer_rt = get_globus_transfer_rt()
-    if not transfer_rt:
+    """Create a new Globus transfer client, reusing the access token stored on disk if valid"""
+    path = get_config_path('globus-token.json')
+    if not get_globus_transfer_rt():
         create_globus_token()
-        transfer_rt = get_globus_transfer_rt()
-    client = create_globus_client()
-    authorizer = globus_sdk.RefreshTokenAuthorizer(transfer_rt, client)
+    with open(path, 'r') as f:
+        tokens = json.load(f)
+    authorizer = globus_sdk.RefreshTokenAuthorizer(
+        tokens['transfer_rt'], create_globus_client(),
+        access_token=tokens.get('transfer_at'), expires_at=tokens.get('expires_at_s'),
+        on_refresh=_save_globus_access_token)
     tc = globus_sdk.TransferClient(authorizer=authorizer)
     return tc
 
 
+class EndpointRateLimiter:
+    """
+    Per-endpoint limit on the number of concurrent Globus requests and on the request rate.
+
+    Usage:
+    >>> limiter = EndpointRateLimiter(max_concurrent=2, min_interval=.1)
+    >>> with limiter(endpoint_id):
+    ...     gc.operation_ls(endpoint_id, path=path)
+    """
+
+    def __init__(self, max_concurrent=2, min_interval=0.):
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_call = {}
+
+    @contextmanager
+    def __call__(self, endpoint):
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                endpoint, threading.BoundedSemaphore(self.max_concurrent))
+        with semaphore:
+            with self._lock:
+                now = time.monotonic()
+                start = max(self._next_call.get(endpoint, now), now)
+                self._next_call[endpoint] = start + self.min_interval
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+
+class GlobusSession:
+    """
+    Process-wide Globus transfer session.
+
+    Wraps a single TransferClient, so that the access token is loaded once and refreshed only
+    when it expires, and HTTP connections are pooled by the client's requests session. The
+    Globus API calls are retried with an exponential backoff on rate limiting and server errors,
+    and the number of concurrent requests per endpoint is bounded. Other attributes are those of
+    the wrapped client, so a session can be used wherever a TransferClient is expected.
+
+    The client is created on first use by `client_factory`; a fake client can be passed instead
+    to run the transfer functions offline:
+    >>> set_globus_session(GlobusSession(client=FakeTransferClient()))
+    """
+
+    def __init__(self, client=None, client_factory=None, max_retries=4,
+                 backoff=1., max_per_endpoint=4):
+        self._client = client
+        self._client_factory = client_factory
+        self._lock = threading.Lock()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = EndpointRateLimiter(max_concurrent=max_per_endpoint)
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = (self._client_factory or globus_transfer_client)()
+            return self._client
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    @staticmethod
+    def _is_retryable(err):
+        return err.http_status == 429 or err.http_status >= 500
+
+    def call(self, method, *args, endpoint=None, **kwargs):
+        """
+        Call a method of the transfer client, retrying on rate limiting and server errors.
+        :param method: name of the TransferClient method
+        :param endpoint: optional endpoint id on which the concurrency limit applies
+        :return: the method's response
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.limiter(str(endpoint)) if endpoint else nullcontext():
+                    return getattr(self.client, method)(*args, **kwargs)
+            except globus_sdk.TransferAPIError as err:
+                if attempt == self.max_retries or not self._is_retryable(err):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning('Globus error, retrying in %.1fs (%i/%i)',
+                               delay, attempt + 1, self.max_retries, exc_info=err)
+                time.sleep(delay)
+
+    def operation_ls(self, endpoint_id, **kwargs):
+        return self.call('operation_ls', endpoint_id, endpoint=endpoint_id, **kwargs)
+
+    def get_endpoint(self, endpoint_id, **kwargs):
+        return self.call('get_endpoint', endpoint_id, endpoint=endpoint_id, **kwargs)
+
+    def submit_transfer(self, data):
+        return self.call('submit_transfer', data)
+
+    def submit_delete(self, data):
+        return self.call('submit_delete', data)
+
+
+_globus_session = None
+_globus_session_lock = threading.Lock()
+
+
+def globus_session():
+    """Return the process-wide GlobusSession"""
+    global _globus_session
+    with _globus_session_lock:
+        if _globus_session is None:
+            _globus_session = GlobusSession()
+        return _globus_session
+
+
+def set_globus_session(session):
+    """Replace the process-wide GlobusSession, e.g. with one wrapping a fake client"""
+    global _globus_session
+    with _globus_session_lock:
+        _globus_session = session
+
+
 def _escape_label(label):
     return re.sub(r'[^a-zA-Z0-9 \-]', '-', label)
 
 
 def _get_absolute_path(file_record):
-    path1 = file_record.data_repository.globus_path
-    path2 = file_record.relative_path
+    globus_path = file_record.dataset.data_repository.globus_path
+    return _absolute_path(globus_path, file_record.relative_path)
+
+
+def _absolute_path(path1, path2):
+    """The absolute path of a file from its repository globus path and its relative path"""
     path2 = path2.replace('\\', '/')
     # HACK
     if path2.startswith('Data2/'):
@@ -128,7 +285,7 @@ def start_globus_transfer(source_file_id, destination_file_id, dry_run=False):
         source_fr.data_repository.name,
         destination_fr.data_repository.name,
     )
-    tc = globus_transfer_client()
+    tc = globus_session()
     tdata = globus_sdk.TransferData(
         tc, source_id, destination_id, verify_checksum=True, sync_level='checksum',
         label=label[0: min(len(label), 128)],
@@ -153,63 +310,248 @@ def start_globus_transfer(source_file_id, destination_file_id, dry_run=False):
     return response
 
 
-def globus_file_exists(file_record):
-    tc = globus_transfer_client()
+def globus_file_exists(file_record, gc=None, cache=None):
+    """
+    Check whether a file exists on the Globus endpoint of its data repository.
+    :param file_record: FileRecord instance
+    :param gc: (optional) globus transfer client, defaults to the process-wide Globus session
+    :param cache: (optional) GlobusListingCache, to list each directory only once
+    :return: bool
+    """
     path = _get_absolute_path(file_record)
     dir_path = op.dirname(path)
     name = op.basename(path)
     name_uuid = add_uuid_string(name, file_record.dataset.pk).as_posix()
+    endpoint = file_record.dataset.data_repository.globus_endpoint_id
+    existing = globus_ls(gc or globus_session(), endpoint, dir_path, cache=cache)
+    return any(existing.get(n, 0) > 0 for n in (name, name_uuid))
+
+
+class DatasetTypeMatcher:
+    """
+    Compiled filename -> DatasetType matcher.
+
+    Dataset types without filename pattern are looked up by name in a hash table keyed by the
+    `object.attribute` part of the filename. Filename patterns are translated to regular
+    expressions once and indexed by their literal prefix (the part before the first wildcard),
+    so that a filename is only tested against the patterns that can possibly match it. All
+    matches are reported so that ambiguous filenames raise an error, as in the former
+    implementation.
+    """
+
+    def __init__(self, dataset_types):
+        self.created = time.monotonic()
+        self._by_name = {}
+        self._by_prefix = {}
+        for dt in dataset_types:
+            pattern = (dt.filename_pattern or '').strip().lower()
+            if not pattern:
+                self._by_name.setdefault(dt.name, []).append(dt)
+                continue
+            wildcard = [i for i in map(pattern.find, '*?[') if i >= 0]
+            prefix = pattern[:min(wildcard, default=len(pattern))]
+            self._by_prefix.setdefault(prefix, []).append((re.compile(translate(pattern)), dt))
+        self._prefix_lengths = sorted({len(p) for p in self._by_prefix})
+
+    def candidates(self, filename):
+        """Return all the dataset types matching a filename"""
+        if is_valid(filename):
+            obj_attr = '.'.join(filename_parts(filename)[1:3])
+        else:  # will match name against filename sans extension
+            obj_attr = op.splitext(filename)[0]
+        matches = list(self._by_name.get(obj_attr, ()))
+        basename = op.basename(filename).lower()
+        for n in self._prefix_lengths:
+            if n > len(basename):
+                break
+            for regex, dt in self._by_prefix.get(basename[:n], ()):
+                if regex.match(basename):
+                    matches.append(dt)
+        return matches
+
+    def match(self, filename):
+        """Return the dataset type of a filename, raise a ValueError if there is 0 or 2+ matches"""
+        dataset_types = self.candidates(filename)
+        n = len(dataset_types)
+        if n == 0:
+            raise ValueError("No dataset type found for filename `%s`" % filename)
+        elif n >= 2:
+            raise ValueError("Multiple matching dataset types found for filename `%s`: %s" % (
+                filename, ', '.join(map(str, dataset_types))))
+        return dataset_types[0]
+
+    def classify(self, filenames, strict=True):
+        """
+        Return the dataset types of a list of filenames.
+        :param filenames: list of file names
+        :param strict: if True, raises a ValueError on unknown or ambiguous filenames, otherwise
+         None is returned for those
+        :return: list of DatasetType, in the same order as the filenames
+        """
+        out = []
+        for filename in filenames:
+            try:
+                out.append(self.match(filename))
+            except ValueError:
+                if strict:
+                    raise
+                out.append(None)
+        return out
+
+
+# Process-wide matcher, rebuilt lazily when a dataset type is saved or deleted in this process.
+# As other processes may change the table, it also expires after a while and is rebuilt once
+# before reporting an unknown filename.
+DATASET_TYPE_MATCHER_MAX_AGE = 300
+_dataset_type_matcher = None
+_dataset_type_matcher_lock = threading.Lock()
+
+
+def dataset_type_matcher(refresh=False):
+    """Return the process-wide compiled DatasetTypeMatcher"""
+    global _dataset_type_matcher
+    with _dataset_type_matcher_lock:
+        matcher = _dataset_type_matcher
+        if (refresh or matcher is None or
+                time.monotonic() - matcher.created > DATASET_TYPE_MATCHER_MAX_AGE):
+            matcher = DatasetTypeMatcher(DatasetType.objects.all())
+            _dataset_type_matcher = matcher
+        return matcher
+
+
+@receiver([post_save, post_delete], sender=DatasetType)
+def invalidate_dataset_type_matcher(sender=None, **kwargs):
+    global _dataset_type_matcher
+    with _dataset_type_matcher_lock:
+        _dataset_type_matcher = None
+
+
+def get_dataset_types(filenames, qs=None, strict=True):
+    """
+    Get the dataset types of a list of filenames in one call.
+    :param filenames: list of file names
+    :param qs: optional dataset types to match against, defaults to all of them
+    :param strict: if True, raises a ValueError on unknown or ambiguous filenames, otherwise
+     None is returned for those
+    :return: list of DatasetType, in the same order as the filenames
+    """
+    if qs:
+        return DatasetTypeMatcher(qs).classify(filenames, strict=strict)
+    matcher = dataset_type_matcher()
     try:
-        existing = tc.operation_ls(file_record.data_repository.globus_endpoint_id, path=dir_path)
-    except globus_sdk.TransferAPIError as e:
-        logger.warning(e)
-        return False
-    for existing_file in existing:
-        if existing_file['name'] in (name, name_uuid) and existing_file['size'] > 0:
-            return True
-    return False
+        return matcher.classify(filenames, strict=strict)
+    except ValueError:
+        # The dataset types may have been changed by another process since the last build
+        if time.monotonic() - matcher.created < 1:
+            raise
+        return dataset_type_matcher(refresh=True).classify(filenames, strict=strict)
 
 
 def get_dataset_type(filename, qs=None):
     """Get the dataset type from a given filename"""
-    dataset_types = []
-    for dt in qs or DatasetType.objects.all():
-        if not dt.filename_pattern.strip():
-            # If the filename pattern is null, check whether the filename object.attribute matches
-            # the dataset type name.
-            if is_valid(filename):
-                obj_attr = '.'.join(filename_parts(filename)[1:3])
-            else:  # will match name against filename sans extension
-                obj_attr = op.splitext(filename)[0]
-            if dt.name == obj_attr:
-                dataset_types.append(dt)
-        # Check whether pattern matches filename
-        elif fnmatch(op.basename(filename).lower(), dt.filename_pattern.lower()):
-            dataset_types.append(dt)
-    n = len(dataset_types)
-    if n == 0:
-        raise ValueError("No dataset type found for filename `%s`" % filename)
-    elif n >= 2:
-        raise ValueError("Multiple matching dataset types found for filename `%s`: %s" % (
-            filename, ', '.join(map(str, dataset_types))))
-    return dataset_types[0]
+    return get_dataset_types([filename], qs=qs)[0]
+
+
+def _classified_file_records(rows, matcher, chunk_size):
+    """Yield (row, dataset type or None) pairs, classifying the file names by chunks"""
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_size)):
+        yield from zip(chunk, matcher.classify([op.basename(r[1]) for r in chunk], strict=False))
+
+
+def reclassify_datasets(datasets=None, dataset_types=None, dry=False, chunk_size=10000):
+    """
+    Recompute the dataset type of datasets from the file names of their file records, e.g. after
+    adding or changing filename patterns.
+
+    The file names are streamed and classified by chunks against a compiled DatasetTypeMatcher.
+    Only the datasets whose type changed are written, with a bulk update of their type and name,
+    followed by a single update of the relative paths of their file records. Datasets whose file
+    records match different types, or whose new type is already used by another dataset of the
+    same session and collection, are left untouched and reported as conflicts.
+
+    :param datasets: optional Dataset queryset, defaults to all the datasets
+    :param dataset_types: dataset types to match against, defaults to those with a filename
+     pattern
+    :param dry: if True, the changes are only reported
+    :param chunk_size: number of file names classified at a time
+    :return: list of changes and list of conflicts, as dicts with keys `dataset`, `file`, `old`,
+     and `new` (list of candidate dataset type names for the conflicts)
+    """
+    if dataset_types is None:
+        dataset_types = DatasetType.objects.exclude(filename_pattern__isnull=True).exclude(
+            filename_pattern='')
+    matcher = DatasetTypeMatcher(dataset_types)
+    type_names = dict(DatasetType.objects.values_list('pk', 'name'))
+    frs = FileRecord.objects.order_by('dataset_id', 'relative_path')
+    if datasets is not None:
+        frs = frs.filter(dataset__in=datasets)
+    rows = frs.values_list(
+        'dataset_id', 'relative_path', 'dataset__dataset_type_id', 'dataset__session_id',
+        'dataset__collection', 'dataset__data_format_id', 'dataset__data_format__file_extension',
+    ).iterator(chunk_size=chunk_size)
+
+    changes, conflicts, updated = [], [], {}
+    classified = _classified_file_records(rows, matcher, chunk_size)
+    for dataset_id, group in groupby(classified, key=lambda x: x[0][0]):
+        group = list(group)
+        (_, file, old_type, session, collection, data_format, extension), _ = group[0]
+        new_types = {dt.pk: dt for _, dt in group if dt is not None}
+        if not new_types or old_type in new_types and len(new_types) == 1:
+            continue
+        change = dict(dataset=dataset_id, file=file, old=type_names[old_type])
+        if len(new_types) > 1:
+            conflicts.append({**change, 'new': sorted(dt.name for dt in new_types.values())})
+            continue
+        dt = next(iter(new_types.values()))
+        changes.append({**change, 'new': dt.name})
+        # all the foreign keys with a default are set, as their default would be queried
+        updated[dataset_id] = Dataset(
+            pk=dataset_id, dataset_type_id=dt.pk, data_format_id=data_format, session_id=session,
+            collection=collection, name=dt.object + '.' + dt.attribute + extension)
+
+    # Two datasets of a session cannot have the same collection and dataset type
+    keys = defaultdict(list)
+    for d in updated.values():
+        keys[(d.session_id, d.collection, d.dataset_type_id)].append(d.pk)
+    existing = Dataset.objects.filter(
+        session__in={k[0] for k in keys}, dataset_type__in={k[2] for k in keys},
+    ).exclude(pk__in=updated.keys()).values_list('session', 'collection', 'dataset_type')
+    taken = {k for k in keys if len(keys[k]) > 1} | set(existing).intersection(keys)
+    clashing = {pk for k in taken for pk in keys[k]}
+    for change in filter(lambda c: c['dataset'] in clashing, changes):
+        conflicts.append({**change, 'new': [change['new']]})
+    changes = [c for c in changes if c['dataset'] not in clashing]
+    for pk in clashing:
+        del updated[pk]
+
+    logger.info('%i datasets to reclassify, %i conflicts', len(changes), len(conflicts))
+    if dry or not updated:
+        return changes, conflicts
+    now = timezone.now()
+    for dataset in updated.values():
+        dataset.auto_datetime = now
+    with transaction.atomic():
+        Dataset.objects.bulk_update(
+            updated.values(), ['dataset_type', 'name', 'auto_datetime'], batch_size=chunk_size)
+        update_relative_paths(dataset_ids=list(updated))
+    return changes, conflicts
 
 
 def get_data_format(filename):
     file_extension = op.splitext(filename)[-1]
     # This raises an error if there is 0 or 2+ matching data formats.
-    return DataFormat.objects.get(file_extension=file_extension)
+    return get_reference(DataFormat, file_extension=file_extension)
 
 
 def _get_repositories_for_labs(labs, server_only=False):
     # List of data repositories associated to the subject's labs.
     repositories = set()
     for lab in labs:
-        if server_only:
-            repos = lab.repositories.filter(globus_is_personal=False)
-        else:
-            repos = lab.repositories.all()
-        repositories.update(repos)
+        repositories.update(cached_reference(
+            [Lab, DataRepository], f'repositories:{lab.pk}:{server_only}',
+            lambda: list(lab.repositories.filter(globus_is_personal=False) if server_only
+                         else lab.repositories.all())))
     return list(repositories)
 
 
@@ -255,97 +597,215 @@ def _change_default_dataset(session, collection, dataset_type):
         dataset.update(default_dataset=False)
 
 
-def _check_dataset_protected(session, collection, filename):
-    # Order datasets by the latest revision with the original one last
-    dataset = Dataset.objects.filter(session=session, collection=collection,
-                                     name=filename).order_by(
-        F('revision__created_datetime').desc(nulls_last=True))
-    if dataset.count() == 0:
-        return False, []
-    else:
-        protected = any([d.is_protected for d in dataset])
-        protected_info = [{d.revision.name if d.revision else '': d.is_protected}
-                          for d in dataset]
-        return protected, protected_info
-
+def _clean_fields(instances):
+    """
+    Validate the field values of model instances, e.g. their max_length, as full_clean does but
+    without the queries of the relation and uniqueness checks. Raises a ValidationError.
+    """
+    for instance in instances:
+        instance.clean_fields(exclude=[f.name for f in instance._meta.fields if f.is_relation])
 
-def _create_dataset_file_records(
-        rel_dir_path=None, filename=None, session=None, user=None,
-        repositories=None, exists_in=None, collection=None, hash=None,
-        file_size=None, version=None, revision=None, default=None):
 
+def _check_datasets_protected(session, infos):
+    """
+    Check in a single query whether the datasets of the files of a registration request are
+    protected.
+    :param session: Session instance
+    :param infos: list of dicts with `collection` and `filename` keys, as returned by
+     `_get_name_collection_revision`
+    :return: list of booleans and list of protected info (one per file), a list of
+     {revision name: protected} dicts of the existing datasets, latest revision first
+    """
+    datasets = Dataset.objects.filter(
+        session=session,
+        collection__in={info['collection'] for info in infos},
+        name__in={info['filename'] for info in infos},
+    ).select_related('revision').annotate(
+        n_protected=Count('tags', filter=Q(tags__protected=True))
+    ).order_by(F('revision__created_datetime').desc(nulls_last=True))
+
+    by_name = {}
+    for d in datasets:
+        by_name.setdefault((d.collection, d.name), []).append(
+            {d.revision.name if d.revision else '': d.n_protected > 0})
+
+    protected, protected_info = [], []
+    for info in infos:
+        prot_info = by_name.get((info['collection'], info['filename']), [])
+        protected.append(any(v for d in prot_info for v in d.values()))
+        protected_info.append(prot_info)
+    return protected, protected_info
+
+
+def _create_dataset_file_records_bulk(
+        files, session=None, user=None, data_repository=None, repositories=None, exists_in=None,
+        default=None):
+    """
+    Create or update the datasets and file records of the files registered by the register-file
+    endpoint.
+
+    Revisions, dataset types, data formats, existing datasets, file records and protection tags
+    are resolved once for the whole request, then datasets and file records are upserted with a
+    few bulk statements inside a single transaction. Files sharing the same collection, dataset
+    type, format and revision (ie. differing only by their extra) belong to the same dataset.
+
+    :param files: list of dicts as returned by `_get_name_collection_revision`, with the
+     additional optional keys `hash`, `file_size` and `version`
+    :param session: Session instance the files belong to
+    :param user: user registering the files
+    :param data_repository: repository of the new datasets. If None, the session (or project)
+     default data repository is used, as in `Dataset.save`
+    :param repositories: repositories the files are registered in, e.g. those of the labs. A file
+     exists if the repository of its dataset is one of them and is in `exists_in`. Defaults to
+     all the repositories
+    :param exists_in: repositories in which the files currently exist, (None,) for none
+    :param default: whether the registered datasets become the default revision
+    :return: (list of datasets, one per file, None) or (None, Response) if a dataset is protected
+    """
     assert session is not None
-    revision_name = f'#{revision.name}#' if revision else ''
-    relative_path = op.join(rel_dir_path, collection or '', revision_name, filename)
-    dataset_type = get_dataset_type(filename)
-    data_format = get_data_format(filename)
-    assert dataset_type
-    assert data_format
-
-    # If we are going to set this one as the default we need to change any previous ones with
-    # same session, collection and name to have default flag to false
-    if default:
-        _change_default_dataset(session, collection, filename)
-
-    # Get or create the dataset.
-    dataset, is_new = Dataset.objects.get_or_create(
-        collection=collection, name=filename, session=session,
-        dataset_type=dataset_type, data_format=data_format, revision=revision)
-    dataset.default_dataset = default is True
-    dataset.save()
-
-    # If the dataset already existed see if it is protected (i.e can't be overwritten)
-    if not is_new:
-        protected_tag = dataset.tags.filter(protected=True).count()
-        if protected_tag > 0:
-            # Raise an error indicating dataset cannot be overwritten
-            data = {'status_code': 403,
-                    'detail': 'Dataset ' + str(dataset.pk) + ' is protected, cannot patch'}
-            return None, Response(data=data, status=403)
-
-    # The user doesn't have to be the same when getting an existing dataset, but we still
-    # have to set the created_by field.
-    dataset.created_by = user
-    if version is not None:
-        dataset.version = version
-    """
-    if a hash/filesize is provided, label the dataset with it
-    if there was a hash and or filesize in the dataset and the provided items are different,
-    then set the existing file records exists field to False
-    If the hash doesn't exist and/or can't be verified, assume that the dataset is patched
-    """
-    is_patched = True
-    if hash is not None:
-        if dataset.hash is not None:
-            is_patched = not dataset.hash == hash
-        dataset.hash = hash
-    if file_size is not None:
-        dataset.file_size = file_size
-    # Validate the fields.
-    dataset.full_clean()
-    dataset.save()
-
-    # Create one file record per repository.
-    exists_in = exists_in or ()
-    for repo in repositories:
-        exists = repo in exists_in
-        # Do not create a new file record if it already exists.
-        fr, is_new = FileRecord.objects.get_or_create(
-            dataset=dataset, data_repository=repo, relative_path=relative_path)
-        if is_new or is_patched:
-            fr.exists = exists
-            fr.json = None  # this is important if a dataset is patched during an ongoing transfer
-        # Validate the fields.
-        fr.full_clean()
-        fr.save()
-
-    return dataset, None
+    exists_in = [repo for repo in exists_in or () if repo is not None]
+    if repositories is not None:
+        exists_in = [repo for repo in exists_in if repo in repositories]
+    if data_repository is None:
+        data_repository = (session.default_data_repository or
+                           session.project.default_data_repository)
+    session_path = session.alias
+
+    # Dataset types and data formats: one call each
+    dataset_types = get_dataset_types([f['filename'] for f in files])
+    extensions = {op.splitext(f['filename'])[-1] for f in files}
+    data_formats = {
+        df.file_extension: df for df in DataFormat.objects.filter(file_extension__in=extensions)}
+
+    # Revisions: one query, the missing ones are created with the datasets
+    revision_names = {f['revision'] for f in files if f['revision'] is not None}
+    revisions = {r.name: r for r in Revision.objects.filter(name__in=revision_names)}
+    missing = [Revision(name=name) for name in revision_names - revisions.keys()]
+    revisions.update({r.name: r for r in missing})
+
+    resolved = []
+    for f, dataset_type in zip(files, dataset_types):
+        filename = f['filename']
+        extension = op.splitext(filename)[-1]
+        if extension not in data_formats:
+            raise DataFormat.DoesNotExist(f'No data format found for extension `{extension}`')
+        data_format = data_formats[extension]
+        revision = revisions.get(f['revision']) if f['revision'] is not None else None
+        extra = filename_parts(filename)[4] if is_valid(filename) else None
+        collection = sanitize_folders(f['collection'])
+        key = (collection, dataset_type.pk, data_format.pk, getattr(revision, 'pk', None))
+        file_name = dataset_type.name + (f'.{extra}' if extra else '') + data_format.file_extension
+        relative_path = op.join(
+            session_path, collection, revision.hashed if revision else '', file_name)
+        resolved.append((key, f, dataset_type, data_format, revision, extra or '', relative_path))
+
+    with transaction.atomic():
+        # Existing datasets of the session for the collections / dataset types concerned
+        existing = Dataset.objects.filter(
+            session=session,
+            collection__in={r[0][0] for r in resolved},
+            dataset_type_id__in={r[0][1] for r in resolved},
+        ).annotate(n_protected=Count('tags', filter=Q(tags__protected=True)))
+        existing = {
+            (d.collection, d.dataset_type_id, d.data_format_id, d.revision_id): d
+            for d in existing}
+        taken = {(k[0], k[1]) for k in existing}
+
+        for key, *_ in resolved:
+            if key in existing and existing[key].n_protected > 0:
+                data = {'status_code': 403,
+                        'detail': 'Dataset ' + str(existing[key].pk) +
+                                  ' is protected, cannot patch'}
+                return None, Response(data=data, status=403)
+
+        _clean_fields(missing)
+        Revision.objects.bulk_create(missing)
+
+        # If these are going to be the default datasets, all the previous ones with the same
+        # session, collection and dataset type lose the default flag
+        if default:
+            q = Q()
+            for collection, dataset_type_id in {(k[0], k[1]) for k, *_ in resolved}:
+                q |= Q(collection=collection, dataset_type_id=dataset_type_id)
+            Dataset.objects.filter(q, session=session, default_dataset=True).update(
+                default_dataset=False)
+
+        now = timezone.now()
+        datasets, new_datasets, previous_hashes = {}, [], {}
+        for key, f, dataset_type, data_format, revision, *_ in resolved:
+            if key not in datasets:
+                if key in existing:
+                    dataset = existing[key]
+                    previous_hashes[key] = dataset.hash
+                else:
+                    if (key[0], key[1]) in taken:
+                        raise ValidationError(
+                            "Two datasets for the same session with the same dataset type and "
+                            "collection cannot exist")
+                    taken.add((key[0], key[1]))
+                    dataset = Dataset(
+                        session=session, collection=key[0], dataset_type=dataset_type,
+                        data_format=data_format, revision=revision,
+                        data_repository=data_repository,
+                        name=dataset_type.name + data_format.file_extension)
+                    new_datasets.append(dataset)
+                    previous_hashes[key] = None
+                dataset.default_dataset = default is True
+                dataset.created_by = user
+                dataset.auto_datetime = now
+                datasets[key] = dataset
+            dataset = datasets[key]
+            if f.get('version') is not None:
+                dataset.version = f['version']
+            if f.get('hash') is not None:
+                dataset.hash = f['hash']
+            if f.get('file_size') is not None:
+                dataset.file_size = f['file_size']
+
+        # Validate the fields as the model forms would, bulk_create skips the validation
+        _clean_fields(datasets.values())
+        Dataset.objects.bulk_create(new_datasets)
+        Dataset.objects.bulk_update(
+            [d for k, d in datasets.items() if k in existing],
+            ['default_dataset', 'created_by', 'version', 'hash', 'file_size', 'auto_datetime'])
+
+        # File records: one per file, matched on their relative path
+        frs = FileRecord.objects.filter(relative_path__in=[r[-1] for r in resolved])
+        frs = {fr.relative_path: fr for fr in frs}
+        new_frs, updated_frs = [], []
+        for key, f, *_, extra, relative_path in resolved:
+            dataset = datasets[key]
+            exists = dataset.data_repository is not None and dataset.data_repository in exists_in
+            fr = frs.get(relative_path)
+            if fr is None:
+                fr = FileRecord(dataset=dataset, extra=extra, relative_path=relative_path,
+                                exists=exists, hash=f.get('hash'))
+                new_frs.append(fr)
+                frs[relative_path] = fr
+                continue
+            if fr.dataset_id != dataset.pk:
+                raise ValidationError("Two files with the same session relative path cannot exist")
+            # If a hash is provided and matches the one known, the file is not patched.
+            # If the hash doesn't exist and/or can't be verified, assume the file is patched
+            known_hash = fr.hash or previous_hashes[key]
+            if f.get('hash') is None or known_hash is None or known_hash != f['hash']:
+                fr.exists = exists
+                # this is important if a dataset is patched during an ongoing transfer
+                fr.json = None
+                fr.hash = f.get('hash') or fr.hash
+                updated_frs.append(fr)
+        _clean_fields(new_frs + updated_frs)
+        FileRecord.objects.bulk_create(new_frs)
+        FileRecord.objects.bulk_update(updated_frs, ['exists', 'json', 'hash'])
+        update_dataset_availability([d.pk for d in datasets.values()])
+
+    return [datasets[key] for key, *_ in resolved], None
 
 
 def iter_registered_directories(data_repository=None, tc=None, path=None):
     """Iterater over pairs (globus dir path, [list of files]) in any directory that
     contains session.metadat.json."""
-    tc = tc or globus_transfer_client()
+    tc = tc or globus_session()
     # Default path: the root of the data repository.
     path = path or data_repository.path
     try:
@@ -369,28 +829,29 @@ def iter_registered_directories(data_repository=None, tc=None, path=None):
 def update_file_exists(dataset):
     """Update the exists field if it is False and that it exists on Globus."""
     files = FileRecord.objects.filter(dataset=dataset)
+    cache = GlobusListingCache()
     for file in files:
         file_exists_db = file.exists
-        file_exists_globus = globus_file_exists(file)
+        file_exists_globus = globus_file_exists(file, cache=cache)
         if file_exists_db and file_exists_globus:
             logger.info(
-                "File %s exists on %s.", file.relative_path, file.data_repository.name)
+                "File %s exists on %s.", file.relative_path, file.dataset.data_repository.name)
         elif file_exists_db and not file_exists_globus:
             logger.warning(
                 "File %s exists on %s in the database but not in globus.",
-                file.relative_path, file.data_repository.name)
+                file.relative_path, file.dataset.data_repository.name)
             file.exists = False
             file.save()
         elif not file_exists_db and file_exists_globus:
             logger.info(
                 "File %s exists on %s, updating the database.",
-                file.relative_path, file.data_repository.name)
+                file.relative_path, file.dataset.data_repository.name)
             file.exists = True
             file.save()
         elif not file_exists_db and not file_exists_globus:
             logger.info(
                 "File %s does not exist on %s.",
-                file.relative_path, file.data_repository.name)
+                file.relative_path, file.dataset.data_repository.name)
 
 
 def transfers_required(dataset):
@@ -427,42 +888,102 @@ def transfers_required(dataset):
         }
 
 
-def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False):
+class GlobusListingCache:
+    """
+    Thread-safe cache of Globus directory listings, keyed by (endpoint id, path). Listings are
+    stored as {file name: size} dicts and expire after `max_age` seconds.
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._listings = {}
+
+    def get(self, endpoint, path):
+        """Return the cached listing of a directory, or None if missing or expired"""
+        with self._lock:
+            created, listing = self._listings.get((str(endpoint), path), (0, None))
+        return listing if time.monotonic() - created < self.max_age else None
+
+    def set(self, endpoint, path, listing):
+        with self._lock:
+            self._listings[(str(endpoint), path)] = (time.monotonic(), listing)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+# Process-wide listing cache shared by the sync functions. It only spares repeated listings of
+# the same directories within a short time, e.g. between a sync and the following transfer.
+globus_listing_cache = GlobusListingCache()
+
+
+def globus_ls(gc, endpoint, path, cache=None, limiter=None):
+    """
+    List the files of a Globus directory.
+    :param gc: globus transfer client, or any object with a compatible `operation_ls` method
+    :param endpoint: Globus endpoint id
+    :param path: absolute path of the directory on the endpoint
+    :param cache: optional GlobusListingCache
+    :param limiter: optional EndpointRateLimiter
+    :return: dict {file name: size}, empty if the directory can't be listed
+    """
+    listing = cache.get(endpoint, path) if cache is not None else None
+    if listing is not None:
+        return listing
+    try:
+        with limiter(endpoint) if limiter else nullcontext():
+            result = gc.operation_ls(endpoint, path=path)
+    except globus_sdk.TransferAPIError as e:
+        logger.warning(e)
+        return {}
+    listing = {f['name']: f['size'] for f in result if f.get('type', 'file') == 'file'}
+    if cache is not None:
+        cache.set(endpoint, path, listing)
+    return listing
+
+
+BULK_SYNC_MAX_WORKERS = 8
+
+
+def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False,
+              max_workers=BULK_SYNC_MAX_WORKERS, limiter=None, cache=None):
     """
     updates the Alyx database file records field 'exists' by looking at each Globus repository.
     This is meant to be launched before the transfer() function
-    Local filerecord =  data_repository__globus_is_personal=True
-    Server filerecord =  data_repository__globus_is_personal=False
+    Local filerecord =  dataset__data_repository__globus_is_personal=True
+    Server filerecord =  dataset__data_repository__globus_is_personal=False
     The algorithm looks at datasets for which the server data file does not exist. For each
         -   the locals filerecords are checked and their exist flag updated
         -   the server filerecords that have a json__transfer_pending=True flag are checked and
     their exist flags updated
+    The file records are grouped by endpoint and directory, each directory is listed once on a
+    thread pool, and the changes are written with a few bulk updates at the end.
     :param dry_run (False) just prints the files if True
     :param lab (optional) specific lab name only
     :param gc (optional) globus transfer client. If not given will instantiated within fucntion
-    :param local_only: (False) if set to True, only local files will be checked. This is useful
     :param check_mismatch: (False) if set to True, will add to the queries filerecords existing
      on SDSC but labeled as mismatched hash
-    for patching files
+    :param max_workers: maximum number of concurrent directory listings
+    :param limiter: (optional) EndpointRateLimiter, by default 2 concurrent listings per endpoint
+     unless gc is a GlobusSession, which has its own limits
+    :param cache: (optional) GlobusListingCache, defaults to the process-wide listing cache
     """
+    q = Q(exists=False, dataset__data_repository__globus_is_personal=False,
+          dataset__data_repository__name__icontains='flatiron')
     if check_mismatch:
-        dfs = FileRecord.objects.filter(
-            Q(exists=False, data_repository__globus_is_personal=False,
-              data_repository__name__icontains='flatiron') |
-            Q(json__has_key="mismatch_hash"))
-    else:
-        dfs = FileRecord.objects.filter(
-            Q(exists=False, data_repository__globus_is_personal=False,
-              data_repository__name__icontains='flatiron'))
+        q |= Q(json__has_key="mismatch_hash")
+    dfs = FileRecord.objects.filter(q)
     if lab:
-        dfs = dfs.filter(data_repository__lab__name=lab)
+        dfs = dfs.filter(dataset__data_repository__lab__name=lab)
     # get all the datasets concerned and then back down to get all files for all those datasets
     dsets = Dataset.objects.filter(pk__in=dfs.values_list('dataset').distinct())
     all_files = FileRecord.objects.filter(
         dataset__in=dsets).order_by('-dataset__created_datetime')
     # checks all local files by default, and only transfer pending files for the server
     all_files = all_files.filter(
-        Q(data_repository__globus_is_personal=True) |
+        Q(dataset__data_repository__globus_is_personal=True) |
         Q(json__has_key="transfer_pending"))
     if dry_run:
         fvals = all_files.values_list('relative_path', flat=True).distinct()
@@ -470,58 +991,73 @@ def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False):
             print(fval)
         return fvals
 
-    gc = gc or globus_transfer_client()
-    # loop over all files concerned by a transfer and update the exists and filesize fields
-    files_to_ls = all_files.order_by('data_repository__globus_endpoint_id', 'relative_path')
-    _last_ep = None
-    _last_path = None
-    nfiles = files_to_ls.count()
-    c = 0
-    for qf in files_to_ls:
-        c += 1
-        # if the last endpoint has already been queried, do not repeat the query
-        if _last_ep != qf.data_repository.globus_endpoint_id:
-            _last_ep = qf.data_repository.globus_endpoint_id
-            ep_info = gc.get_endpoint(_last_ep)
-        # if the endpoint is not connected skip
-        # NB: the non-personal endpoints have a None so need to explicitly test for False
-        if ep_info['gcp_connected'] is False:
-            logger.warning('UNREACHABLE Endpoint "' + ep_info['display_name'] +
-                           '" (' + str(_last_ep) + ') ' + qf.relative_path)
-            continue
-        # if we already listed the current path of the endpoint, do not repeat the rest ls command
-        cpath, fil = os.path.split(qf.relative_path)
-        fil_uuid = add_uuid_string(fil, qf.dataset_id).as_posix()
-        cpath = qf.data_repository.globus_path + cpath
-        if _last_path != cpath:
-            _last_path = cpath
-            try:
-                print(str(c) + '/' + str(nfiles) + ' ls ' + cpath + ' on ' + str(_last_ep))
-                ls_result = gc.operation_ls(_last_ep, path=_last_path)
-            except globus_sdk.TransferAPIError:
-                ls_result = []
-        # compare the current file against the ls list, update the file_size if necessary
-        exists = False
-        for ind, gfil in enumerate(ls_result):
-            if gfil['name'] in (fil_uuid, fil):
-                exists = True
-                if qf.dataset.file_size != gfil['size']:
-                    qf.dataset.file_size = gfil['size']
-                    qf.dataset.save()
-                break
-        # update the filerecord exists field if needed
-        if qf.exists != exists:
-            qf.exists = exists
-            qf.save()
-            # sets the json field to None so that the transfer pending flag is nulled
-            if exists:
-                qf.dataset.file_records.update(json=None)
-            print(str(c) + '/' + str(nfiles) + ' ' + str(qf.data_repository.name) + ':' +
-                  qf.relative_path + ' exist set to ' + str(exists) + ' in Alyx')
-
-
-def _filename_from_file_record(fr, add_uuid=False):
-    fn = fr.data_repository.globus_path + fr.relative_path
+    gc = gc or globus_session()
+    # the Globus session already bounds the number of concurrent requests per endpoint
+    if limiter is None and not isinstance(gc, GlobusSession):
+        limiter = EndpointRateLimiter()
+    cache = globus_listing_cache if cache is None else cache
+
+    # group the file records by endpoint and directory
+    directories = defaultdict(list)
+    for fr in all_files.order_by('dataset__data_repository__globus_endpoint_id', 'relative_path'):
+        repo = fr.dataset.data_repository
+        cpath = repo.globus_path + os.path.split(fr.relative_path)[0]
+        directories[(repo.globus_endpoint_id, cpath)].append(fr)
+
+    # query the status of each endpoint once and skip the unreachable ones
+    # NB: the non-personal endpoints have a None so need to explicitly test for False
+    connected = {}
+    for endpoint in {ep for ep, _ in directories}:
+        ep_info = gc.get_endpoint(endpoint)
+        connected[endpoint] = ep_info['gcp_connected'] is not False
+        if not connected[endpoint]:
+            logger.warning('UNREACHABLE Endpoint "%s" (%s): skipping %i directories',
+                           ep_info['display_name'], endpoint,
+                           sum(ep == endpoint for ep, _ in directories))
+    to_list = [key for key in directories if connected[key[0]]]
+
+    def _ls(key):
+        return globus_ls(gc, *key, cache=cache, limiter=limiter)
+
+    logger.info('Listing %i directories on %i endpoints', len(to_list), sum(connected.values()))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = dict(zip(to_list, executor.map(_ls, to_list)))
+
+    # compare the file records against the listings, update exists and file_size if necessary
+    changed_frs, changed_dsets, now_existing = [], {}, set()
+    for key, listing in listings.items():
+        for fr in directories[key]:
+            fil = os.path.basename(fr.relative_path)
+            fil_uuid = add_uuid_string(fil, fr.dataset_id).as_posix()
+            size = listing.get(fil_uuid, listing.get(fil))
+            exists = size is not None
+            if exists and fr.dataset.file_size != size:
+                fr.dataset.file_size = size
+                changed_dsets[fr.dataset_id] = fr.dataset
+            if fr.exists != exists:
+                fr.exists = exists
+                changed_frs.append(fr)
+                changed_dsets.setdefault(fr.dataset_id, fr.dataset)
+                if exists:
+                    now_existing.add(fr.dataset_id)
+                logger.info('%s:%s exist set to %s in Alyx',
+                            fr.dataset.data_repository.name, fr.relative_path, exists)
+
+    now = timezone.now()
+    for dataset in changed_dsets.values():
+        dataset.auto_datetime = now
+    with transaction.atomic():
+        Dataset.objects.bulk_update(changed_dsets.values(), ['file_size', 'auto_datetime'])
+        FileRecord.objects.bulk_update(changed_frs, ['exists'])
+        update_dataset_availability({fr.dataset_id for fr in changed_frs})
+        # sets the json field to None so that the transfer pending flag is nulled
+        FileRecord.objects.filter(dataset__in=now_existing).update(json=None)
+    return changed_frs
+
+
+def _filename_from_file_record(fr, add_uuid=False, data_repository=None):
+    data_repository = data_repository or fr.dataset.data_repository
+    fn = data_repository.globus_path + fr.relative_path
     if add_uuid:
         fn = add_uuid_string(fn, fr.dataset.pk).as_posix()
     return fn
@@ -552,8 +1088,8 @@ def _bulk_transfer(dry_run=False, lab=None, maxsize=None, minsize=None, gc=None)
     :return: globus_client, transfer_matrix (an array of transfer objects)
     """
     dfs = FileRecord.objects.filter(
-        (Q(exists=False, data_repository__globus_is_personal=False,
-           data_repository__name__icontains='flatiron') |
+        (Q(exists=False, dataset__data_repository__globus_is_personal=False,
+           dataset__data_repository__name__icontains='flatiron') |
          Q(json__has_key="mismatch_hash")) &
         ~Q(json__has_key="transfer_pending")
     )
@@ -564,45 +1100,65 @@ def _bulk_transfer(dry_run=False, lab=None, maxsize=None, minsize=None, gc=None)
     if not dfs:
         return
     if lab:
-        dfs = dfs.filter(data_repository__lab__name=lab)
+        dfs = dfs.filter(dataset__data_repository__lab__name=lab)
     gc, tm = _globus_transfer_filerecords(dfs, dry=dry_run, gc=gc)
     return gc, tm
 
 
+def _source_repositories(dfs):
+    """
+    Pick a source repository for the file records of a queryset, in one query.
+    A dataset has a single data repository, so a file missing from its server repository is
+    expected at the same relative path on a Globus personal repository of the session lab,
+    where it was acquired. The personal repositories outside of AWS are ranked by name and
+    the first one of each lab is kept with DISTINCT ON.
+    :param dfs: file records queryset
+    :return: dict {lab id: source data repository}
+    """
+    lab_repositories = Lab.repositories.through.objects.filter(
+        ~Q(datarepository__name__icontains='aws'), datarepository__globus_is_personal=True,
+        lab__in=dfs.values('dataset__session__lab'),
+    ).select_related('datarepository').order_by('lab', 'datarepository__name').distinct('lab')
+    return {lr.lab_id: lr.datarepository for lr in lab_repositories}
+
+
 def _globus_transfer_filerecords(dfs, dry=True, gc=None):
     """
     Transfers the file records. The query set has to contain only is_globus_personal=False flag
     (ie. they are server side file records). The algorithm creates a transfer object for each
     unique pair of globus source / globus destination ids and launches the transfers at the end.
+    The sources of all the file records are found with a single query (see
+    _source_repositories) and the planned records are flagged as pending with a single update.
     :param dfs: file records queryset
     :param dry:
     :param gc (optional) globus transfer client. If not given will instantiated within function
     :return: globus_client, transfer_matrix (an array of transfer objects)
     """
-    gc = None if dry else gc or globus_transfer_client()
-    dfs = dfs.order_by('data_repository__globus_endpoint_id', 'relative_path')
-    pri_repos = DataRepository.objects.filter(globus_is_personal=False, name__icontains='flatiron')
-    sec_repos = DataRepository.objects.filter(globus_is_personal=True)
-    tm = np.zeros([pri_repos.count(), sec_repos.count()], dtype=object)
-    nfiles = dfs.count()
-    c = 0
+    gc = None if dry else gc or globus_session()
+    dfs = dfs.select_related('dataset__data_repository', 'dataset__session').order_by(
+        'dataset__data_repository__globus_endpoint_id', 'relative_path')
+    pri_repos = list(DataRepository.objects.filter(
+        globus_is_personal=False, name__icontains='flatiron'))
+    sec_repos = list(DataRepository.objects.filter(globus_is_personal=True))
+    ipri_index = {repo.pk: i for i, repo in enumerate(pri_repos)}
+    isec_index = {repo.pk: i for i, repo in enumerate(sec_repos)}
+    tm = np.zeros([len(pri_repos), len(sec_repos)], dtype=object)
+    sources = _source_repositories(dfs)
+    missing, planned = [], []
     # create the tasks
     for ds in dfs:
-        c += 1
-        ipri = [ind for ind, cr in enumerate(pri_repos) if cr == ds.data_repository][0]
-        src_file = ds.dataset.file_records.filter(~Q(data_repository__name__icontains='aws'),
-                                                  exists=True).first()
-        if not src_file:
-            logger.warning(str(ds.data_repository.name) + ':' + ds.relative_path +
+        ipri = ipri_index.get(ds.dataset.data_repository_id)
+        if ipri is None:
+            logger.warning('%s is not on a server repository', ds.relative_path)
+            continue
+        src_repo = sources.get(ds.dataset.session.lab_id)
+        if not src_repo:
+            logger.warning(str(ds.dataset.data_repository.name) + ':' + ds.relative_path +
                            ' is nowhere to ' + 'be found in local AND remote repositories')
             ds.json = {'local_missing': True}
-            ds.save()
-            continue
-        isec = next((ind for ind, cr in enumerate(sec_repos) if cr == src_file.data_repository),
-                    None)
-        if isec is None:
-            print("no _isec")
+            missing.append(ds)
             continue
+        isec = isec_index[src_repo.pk]
         # if the transfer doesn't exist, create it:
         if tm[ipri][isec] == 0:
             label = sec_repos[isec].name + ' to ' + pri_repos[ipri].name
@@ -623,14 +1179,16 @@ def _globus_transfer_filerecords(dfs, dry=True, gc=None):
 
         # add the transfer to the current task
         destination_file = _filename_from_file_record(ds, add_uuid=True)
-        source_file = _filename_from_file_record(src_file)
+        source_file = _filename_from_file_record(ds, data_repository=src_repo)
         if not dry:
             tm[ipri][isec].add_item(source_path=source_file, destination_path=destination_file)
         else:
             tm[ipri][isec]['DATA'].append({'source_path': source_file,
                                            'destination_path': destination_file})
-
-        print(str(c) + '/' + str(nfiles) + ' ' + source_file + ' to ' + destination_file)
+        planned.append(ds.pk)
+    FileRecord.objects.bulk_update(missing, ['json'])
+    logger.info('%i files to transfer in %i tasks, %i missing',
+                len(planned), sum(t != 0 for t in tm.flat), len(missing))
     # launch the transfer tasks
     if dry:
         return None, tm
@@ -638,7 +1196,7 @@ def _globus_transfer_filerecords(dfs, dry=True, gc=None):
         if t == 0:
             continue
         gc.submit_transfer(t)
-    dfs.exclude(json__has_key="local_missing").update(json={'transfer_pending': True})
+    FileRecord.objects.filter(pk__in=planned).update(json={'transfer_pending': True})
     return gc, tm
 
 
@@ -677,7 +1235,8 @@ def globus_transfer_datasets(dsets, dry=True):
     :param dry:
     :return: globus_client, transfer_matrix (an array of transfer objects)
     """
-    frecs = FileRecord.objects.filter(data_repository__globus_is_personal=False, dataset__in=dsets)
+    frecs = FileRecord.objects.filter(
+        dataset__data_repository__globus_is_personal=False, dataset__in=dsets)
     gc, tm = _globus_transfer_filerecords(frecs, dry=dry)
     return gc, tm
 
@@ -695,7 +1254,7 @@ def globus_delete_local_datasets(datasets, dry=True, gc=None):
     globus_endpoints = file_records.values_list('data_repository__globus_endpoint_id',
                                                 flat=True).distinct()
     # create a globus delete_client for each globus endpoint
-    gtc = gc or globus_transfer_client()
+    gtc = gc or globus_session()
     delete_clients = []
     for ge in globus_endpoints:
         delete_clients.append(globus_sdk.DeleteData(gtc, ge, label=''))
@@ -809,7 +1368,7 @@ def globus_delete_file_records(file_records, dry=True, gc=None):
     related_datasets = file_records.values_list('dataset', flat=True).distinct()
 
     # create a globus delete_client for each globus endpoint
-    gtc = gc or globus_transfer_client()
+    gtc = gc or globus_session()
     delete_clients = []
     if not dry:
         # delete_clients = []
@@ -3,11 +3,21 @@ import re
 
 from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404
+from django.db.models import F
 from rest_framework import generics, viewsets, mixins, serializers
 from rest_framework.response import Response
 import django_filters
 import os
-from alyx.base import BaseFilterSet, rest_permission_classes
+from alyx.base import (
+    BaseFilterSet,
+    ConditionalMixin,
+    ReferenceCacheMixin,
+    SparseFieldsViewMixin,
+    StreamingListMixin,
+    ValuesListMixin,
+    get_reference,
+    rest_permission_classes,
+)
 from subjects.models import Subject, Project
 from experiments.models import ProbeInsertion
 from misc.models import Lab
@@ -29,17 +39,19 @@ from .serializers import (
     DataFormatSerializer,
     DatasetTypeSerializer,
     DatasetSerializer,
+    DatasetValuesSerializer,
     DownloadSerializer,
     FileRecordSerializer,
+    FileRecordValuesSerializer,
     RevisionSerializer,
     TagSerializer,
 )
 from .transfers import (
     _get_session,
     _get_repositories_for_labs,
-    _create_dataset_file_records,
+    _create_dataset_file_records_bulk,
     bulk_sync,
-    _check_dataset_protected,
+    _check_datasets_protected,
     _get_name_collection_revision,
 )
 
@@ -49,7 +61,7 @@ logger = structlog.get_logger(__name__)
 # ------------------------------------------------------------------------------------------------
 
 
-class DataRepositoryTypeList(generics.ListCreateAPIView):
+class DataRepositoryTypeList(ReferenceCacheMixin, generics.ListCreateAPIView):
     queryset = DataRepositoryType.objects.all()
     serializer_class = DataRepositoryTypeSerializer
     permission_classes = rest_permission_classes()
@@ -82,13 +94,14 @@ class DataRepositoryFilter(BaseFilterSet):
         return queryset.filter(hostname=hostname).filter(globus_path=path)
 
 
-class DataRepositoryList(generics.ListCreateAPIView):
+class DataRepositoryList(ReferenceCacheMixin, generics.ListCreateAPIView):
     filter_class = DataRepositoryFilter
     queryset = DataRepository.objects.all()
     serializer_class = DataRepositorySerializer
     permission_classes = rest_permission_classes()
     filter_fields = ("name", "globus_endpoint_id")
     lookup_field = "name"
+    reference_models = (DataRepository, DataRepositoryType)
 
 
 class DataRepositoryDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -102,7 +115,7 @@ class DataRepositoryDetail(generics.RetrieveUpdateDestroyAPIView):
 # ------------------------------------------------------------------------------------------------
 
 
-class DataFormatList(generics.ListCreateAPIView):
+class DataFormatList(ReferenceCacheMixin, generics.ListCreateAPIView):
     queryset = DataFormat.objects.all()
     serializer_class = DataFormatSerializer
     permission_classes = rest_permission_classes()
@@ -120,7 +133,7 @@ class DataFormatDetail(generics.RetrieveUpdateDestroyAPIView):
 # ------------------------------------------------------------------------------------------------
 
 
-class DatasetTypeList(generics.ListCreateAPIView):
+class DatasetTypeList(ReferenceCacheMixin, generics.ListCreateAPIView):
     queryset = DatasetType.objects.all()
     serializer_class = DatasetTypeSerializer
     permission_classes = rest_permission_classes()
@@ -195,15 +208,16 @@ class DatasetFilter(BaseFilterSet):
 
     def filter_exists(self, dsets, name, value):
         """
-        Filters datasets for which at least one file record Globus not personal exists.
+        Filters datasets for which at least one file record exists (or, if False, is missing).
         Only if the database has any globus non-personal repositories (ie. servers)
         """
-        if len(DataRepository.objects.filter(globus_is_personal=False)) > 0:
-            frs = FileRecord.objects.filter(
-                pk__in=dsets.values_list("file_records", flat=True)
-            )
-            pkd = frs.filter(exists=value).values_list("dataset", flat=True)
-            dsets = dsets.filter(pk__in=pkd)
+        if DataRepository.objects.filter(globus_is_personal=False).exists():
+            if value:
+                dsets = dsets.filter(availability__n_existing__gt=0)
+            else:
+                dsets = dsets.filter(
+                    availability__n_existing__lt=F("availability__n_file_records")
+                )
         return dsets
 
     def probe_insertion_filter(self, dsets, _, pk):
@@ -227,7 +241,13 @@ class DatasetFilter(BaseFilterSet):
             return dsets.exclude(tags__protected=True)
 
 
-class DatasetList(generics.ListCreateAPIView):
+class DatasetList(
+    ConditionalMixin,
+    StreamingListMixin,
+    SparseFieldsViewMixin,
+    ValuesListMixin,
+    generics.ListCreateAPIView,
+):
     """
     get: **FILTERS**
     -   **subject**: subject nickname: `/datasets?subject=Algernon`
@@ -245,20 +265,36 @@ class DatasetList(generics.ListCreateAPIView):
     -   **public**: only returns datasets that are public or not public
     -   **protected**: only returns datasets that are protected or not protected
 
+    **PAGINATION**: `/datasets?cursor=&limit=1000` pages by creation date without offset nor
+    count, follow the `next` link of each page
+
+    **EXPORT**: `/datasets?format=ndjson&limit=all` streams all the datasets, one JSON per line
+
+    **FIELDS**: `/datasets?fields=id,name,session` or `/datasets?exclude=file_records,tags`
+    only returns and loads the listed fields
+
+    **CACHING**: send back the `ETag` of a response in `If-None-Match` to get a 304 Not Modified
+    when the datasets didn't change
+
     [===> dataset model reference](/admin/doc/models/data.dataset)
     """
 
     queryset = Dataset.objects.all()
     queryset = DatasetSerializer.setup_eager_loading(queryset)
     serializer_class = DatasetSerializer
+    values_serializer_class = DatasetValuesSerializer
     permission_classes = rest_permission_classes()
     filter_class = DatasetFilter
+    cursor_ordering = ("created_datetime", "id")
+    count_estimate = True
+    conditional_relations = {"file_records": None, "availability": "updated", "tags": None}
 
 
-class DatasetDetail(generics.RetrieveUpdateDestroyAPIView):
+class DatasetDetail(ConditionalMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Dataset.objects.all()
     serializer_class = DatasetSerializer
     permission_classes = rest_permission_classes()
+    conditional_relations = {"file_records": None, "availability": "updated", "tags": None}
 
 
 # FileRecord
@@ -275,7 +311,7 @@ class FileRecordFilter(BaseFilterSet):
         exclude = ["json"]
 
 
-class FileRecordList(generics.ListCreateAPIView):
+class FileRecordList(StreamingListMixin, ValuesListMixin, generics.ListCreateAPIView):
     """
     get: **FILTERS**
 
@@ -284,14 +320,22 @@ class FileRecordList(generics.ListCreateAPIView):
     -   **lab**: lab name `/files?lab=wittenlab`
     -   **globus_is_personal**: bool type of Globus endpoint `/files?globus_is_personal=True`
 
+    **PAGINATION**: `/files?cursor=&limit=1000` pages by id without offset nor count, follow
+    the `next` link of each page
+
+    **EXPORT**: `/files?format=ndjson&limit=all` streams all the file records, one JSON per line
+
     [===> file record model reference](/admin/doc/models/data.filerecord)
     """
 
     queryset = FileRecord.objects.all()
     queryset = FileRecordSerializer.setup_eager_loading(queryset)
     serializer_class = FileRecordSerializer
+    values_serializer_class = FileRecordValuesSerializer
     permission_classes = rest_permission_classes()
     filter_class = FileRecordFilter
+    cursor_ordering = ("id",)
+    count_estimate = True
 
 
 class FileRecordDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -339,6 +383,53 @@ def _make_dataset_response(dataset):
     return out
 
 
+def _make_dataset_responses(datasets):
+    """
+    Same as `_make_dataset_response` for a list of datasets of a single session, with the
+    session information and the file records fetched once for the whole list.
+    """
+    if not datasets:
+        return []
+
+    file_records = {}
+    for fr in FileRecord.objects.filter(
+        dataset__in={d.pk for d in datasets}
+    ).values("id", "dataset", "relative_path", "exists"):
+        file_records.setdefault(fr.pop("dataset"), []).append(fr)
+
+    session = datasets[0].session
+    session_info = {
+        "subject": session.subject.nickname,
+        "session": session.pk,
+        "session_number": session.number,
+        "session_users": ",".join(_.username for _ in session.users.all()),
+        "session_start_time": session.start_time,
+    }
+
+    response = []
+    for dataset in datasets:
+        out = {
+            "id": dataset.pk,
+            "name": dataset.name,
+            "file_size": dataset.file_size,
+            "subject": session_info["subject"],
+            "created_by": dataset.created_by.username,
+            "created_datetime": dataset.created_datetime,
+            "dataset_type": getattr(dataset.dataset_type, "name", ""),
+            "data_format": getattr(dataset.data_format, "name", ""),
+            "session": session_info["session"],
+            "session_number": session_info["session_number"],
+            "session_users": session_info["session_users"],
+            "session_start_time": session_info["session_start_time"],
+            "collection": dataset.collection,
+            "revision": getattr(dataset.revision, "name", None),
+            "default": dataset.default_dataset,
+        }
+        out["file_records"] = file_records.get(dataset.pk, [])
+        response.append(out)
+    return response
+
+
 def _parse_path(path):
     pattern = (
         r"^(?P<nickname>[a-zA-Z0-9\-\_]+)/"
@@ -418,9 +509,9 @@ class RegisterFileViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         name = request.data.get("name", None)
         hostname = request.data.get("hostname", None)
         if name:
-            repo = DataRepository.objects.get(name=name)
+            repo = get_reference(DataRepository, name=name)
         elif hostname:
-            repo = DataRepository.objects.get(hostname=hostname)
+            repo = get_reference(DataRepository, hostname=hostname)
         else:
             repo = None
         exists_in = (repo,)
@@ -471,7 +562,7 @@ class RegisterFileViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         # Multiple labs
         labs = request.data.get("projects", "") + request.data.get("labs", "")
         labs = labs.split(",")
-        labs = [Lab.objects.get(name=lab) for lab in labs if lab]
+        labs = [get_reference(Lab, name=lab) for lab in labs if lab]
         repositories = _get_repositories_for_labs(
             labs or [subject.lab], server_only=server_only
         )
@@ -493,38 +584,8 @@ class RegisterFileViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         )
         assert session
 
-        # If the check protected flag is True, loop through the files to see if any are protected
-        if check_protected:
-            prot_response = []
-            protected = []
-            for file in filenames:
-                info, resp = _get_name_collection_revision(
-                    file, rel_dir_path, subject, date
-                )
-
-                if resp:
-                    return resp
-
-                if info is None:
-                    raise ValueError(
-                        f"info is none in RegisterFileViewSet.create for file {file}. Aborting"
-                    )
-
-                prot, prot_info = _check_dataset_protected(
-                    session, info["collection"], info["filename"]
-                )
-                protected.append(prot)
-                prot_response.append({file: prot_info})
-
-            if any(protected):
-                data = {
-                    "status_code": 403,
-                    "error": "One or more datasets is protected",
-                    "details": prot_response,
-                }
-                return Response(data=data, status=403)
-
-        response = []
+        # Parse the collection and revision of every file once
+        infos = []
         for filename, hash, fsize, version in zip(
             filenames, hashes, filesizes, versions
         ):
@@ -541,32 +602,35 @@ class RegisterFileViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
                 raise ValueError(
                     f"info is none in RegisterFileViewSet.create for file {filename}. Aborting"
                 )
+            info.update(file=filename, hash=hash, file_size=fsize, version=version)
+            infos.append(info)
 
-            if info["revision"] is not None:
-                revision, _ = Revision.objects.get_or_create(name=info["revision"])
-            else:
-                revision = None
-
-            dataset, resp = _create_dataset_file_records(
-                collection=info["collection"],
-                rel_dir_path=info["rel_dir_path"],
-                filename=info["filename"],
-                session=session,
-                user=user,
-                repositories=repositories,
-                exists_in=exists_in,
-                hash=hash,
-                file_size=fsize,
-                version=version,
-                revision=revision,
-                default=default,
-            )
-            if resp:
-                return resp
-            out = _make_dataset_response(dataset)
-            response.append(out)
+        # If the check protected flag is True, check in one go if any of the files are protected
+        if check_protected:
+            protected, prot_info = _check_datasets_protected(session, infos)
+            if any(protected):
+                data = {
+                    "status_code": 403,
+                    "error": "One or more datasets is protected",
+                    "details": [
+                        {info["file"]: prot} for info, prot in zip(infos, prot_info)
+                    ],
+                }
+                return Response(data=data, status=403)
+
+        datasets, resp = _create_dataset_file_records_bulk(
+            infos,
+            session=session,
+            user=user,
+            data_repository=repo,
+            repositories=repositories,
+            exists_in=exists_in,
+            default=default,
+        )
+        if resp:
+            return resp
 
-        return Response(response, status=201)
+        return Response(_make_dataset_responses(datasets), status=201)
 
 
 class SyncViewSet(viewsets.GenericViewSet):
@@ -610,7 +674,7 @@ class DownloadViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         if isinstance(projects, str):
             projects = projects.split(",")
         projects = [
-            Project.objects.get(name=project) for project in projects if project
+            get_reference(Project, name=project) for project in projects if project
         ]
 
         # loop over datasets
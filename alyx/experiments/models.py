@@ -11,7 +11,7 @@ from django.core.exceptions import ValidationError
 from mptt.models import MPTTModel, TreeForeignKey
 from django.utils.translation import gettext as _
 
-from alyx.base import BaseModel, BaseManager
+from alyx.base import BaseModel, BaseManager, reference_table
 from actions.models import ChronicRecording
 
 logger = structlog.get_logger(__name__)
@@ -21,6 +21,7 @@ Y_HELP_TEXT = "brain surface antero-posterior coordinate (um) of the insertion,
 Z_HELP_TEXT = "brain surface dorso-ventral coordinate (um) of the insertion, up +, relative to Bregma"
 
 
+@reference_table
 class BrainRegion(MPTTModel):
     acronym = models.CharField(max_length=64, unique=True)
     name = models.CharField(max_length=255, unique=True)
@@ -1,9 +1,9 @@
 from rest_framework import serializers
-from alyx.base import BaseSerializerEnumField
+from alyx.base import BaseSerializerEnumField, SparseFieldsMixin, eager_loading
 from actions.models import EphysSession, Session
 from experiments.models import (ProbeInsertion, TrajectoryEstimate, ProbeModel, CoordinateSystem,
                                 Channel, BrainRegion)
-from data.models import DatasetType, Dataset, DataRepository, FileRecord
+from data.models import DatasetType, Dataset, DataRepository
 
 
 class SessionListSerializer(serializers.ModelSerializer):
@@ -64,10 +64,8 @@ class ChannelSerializer(serializers.ModelSerializer):
 class FilterDatasetSerializer(serializers.ListSerializer):
 
     def to_representation(self, dsets):
-        if DataRepository.objects.count() > 0:
-            frs = FileRecord.objects.filter(pk__in=dsets.values_list("file_records", flat=True))
-            pkd = frs.filter(exists=True).values_list("dataset", flat=True)
-            dsets = dsets.filter(pk__in=pkd)
+        if DataRepository.objects.exists():
+            dsets = dsets.filter(availability__n_existing__gt=0)
         return super(FilterDatasetSerializer, self).to_representation(dsets)
 
 class ProbeInsertionDatasetsSerializer(serializers.ModelSerializer):
@@ -84,13 +82,21 @@ class ProbeInsertionDatasetsSerializer(serializers.ModelSerializer):
                   'hash', 'version', 'collection')
 
 
-class ProbeInsertionListSerializer(serializers.ModelSerializer):
+class ProbeInsertionListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     @staticmethod
-    def setup_eager_loading(queryset):
-        """ Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related('model', 'session')
-        queryset = queryset.prefetch_related('session__subject', 'session__lab', 'datasets')
+    def setup_eager_loading(queryset, fields=None):
+        """
+        Perform necessary eager loading of data to avoid horrible performance.
+        :param fields: optional names of the fields serialized, only their relations are loaded
+        """
+        queryset = eager_loading(
+            queryset, fields,
+            select_related={'model': ['model'], 'session': ['session', 'session_info']},
+            prefetch_related={'session__subject': ['session_info'],
+                              'session__lab': ['session_info'],
+                              'datasets': ['datasets']},
+        )
         return queryset.order_by('-session__start_time')
 
     session = serializers.SlugRelatedField(
@@ -108,7 +114,7 @@ class ProbeInsertionListSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class ProbeInsertionDetailSerializer(serializers.ModelSerializer):
+class ProbeInsertionDetailSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     session = serializers.SlugRelatedField(
         read_only=False, required=False, slug_field='id',
         queryset=EphysSession.objects.filter(task_protocol__icontains='ephys'),
@@ -3,7 +3,9 @@ from django_filters.rest_framework import CharFilter, UUIDFilter, NumberFilter
 from django.db.models import F, Func, Value, CharField, functions, Q
 
 
-from alyx.base import BaseFilterSet, rest_permission_classes
+from alyx.base import (
+    BaseFilterSet, ReferenceCacheMixin, SparseFieldsViewMixin, cached_reference,
+    rest_permission_classes)
 from data.models import Dataset
 from experiments.models import ProbeInsertion, TrajectoryEstimate, Channel, BrainRegion
 from experiments.serializers import (ProbeInsertionListSerializer, ProbeInsertionDetailSerializer,
@@ -16,8 +18,10 @@ Probe insertion objects REST filters and views
 
 
 def _filter_qs_with_brain_regions(self, queryset, region_field, region_value):
-    brs = BrainRegion.objects.filter(
-        **{region_field: region_value}).get_descendants(include_self=True)
+    brs = cached_reference(
+        [BrainRegion], f'descendants:{region_field}={region_value}',
+        lambda: list(BrainRegion.objects.filter(**{region_field: region_value})
+                     .get_descendants(include_self=True).values_list('id', flat=True)))
     qs_trajs = TrajectoryEstimate.objects.filter(provenance__gte=70). \
         prefetch_related('channels__brain_region'). \
         filter(channels__brain_region__in=brs).distinct()
@@ -99,7 +103,7 @@ class ProbeInsertionFilter(BaseFilterSet):
         exclude = ['json']
 
 
-class ProbeInsertionList(generics.ListCreateAPIView):
+class ProbeInsertionList(SparseFieldsViewMixin, generics.ListCreateAPIView):
     """
     get: **FILTERS**
 
@@ -122,6 +126,9 @@ class ProbeInsertionList(generics.ListCreateAPIView):
     -   **atlas_id**: returns a session if any of its channels id matches the
      provided value: `/insertions?atlas_id=950`, cf Allen CCFv2017
 
+    **FIELDS**: `/insertions?fields=id,name,session` or `/insertions?exclude=session_info`
+    only returns and loads the listed fields
+
     [===> probe insertion model reference](/admin/doc/models/experiments.probeinsertion)
     """
     queryset = ProbeInsertion.objects.all()
@@ -245,7 +252,7 @@ class BrainRegionFilter(BaseFilterSet):
         return r.get_ancestors(include_self=True).exclude(pk=0)
 
 
-class BrainRegionList(generics.ListAPIView):
+class BrainRegionList(ReferenceCacheMixin, generics.ListAPIView):
     """
     get: **FILTERS**
 
@@ -2,10 +2,10 @@ from rest_framework import serializers
 from actions.models import Session
 from jobs.models import Task
 from data.models import DataRepository
-from alyx.base import BaseSerializerEnumField
+from alyx.base import BaseSerializerEnumField, SparseFieldsMixin, eager_loading
 
 
-class TaskListSerializer(serializers.ModelSerializer):
+class TaskListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     session = serializers.SlugRelatedField(
         read_only=False, required=False, slug_field="id", many=False, queryset=Session.objects.all()
     )
@@ -20,14 +20,24 @@ class TaskListSerializer(serializers.ModelSerializer):
         ]
 
     @staticmethod
-    def setup_eager_loading(queryset):
-        """Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related("session", "data_repository")
+    def setup_eager_loading(queryset, fields=None):
+        """
+        Perform necessary eager loading of data to avoid horrible performance.
+        :param fields: optional names of the fields serialized, only their relations are loaded
+        """
+        queryset = eager_loading(
+            queryset,
+            fields,
+            select_related={
+                "session": ["session", "session_path"],
+                "data_repository": ["data_repository"],
+            },
+        )
         # queryset = queryset.prefetch_related("parents")
         return queryset.order_by("level", "-priority", "-datetime")
 
 
-class TaskDetailsSeriaizer(serializers.ModelSerializer):
+class TaskDetailsSeriaizer(SparseFieldsMixin, serializers.ModelSerializer):
     session = serializers.SlugRelatedField(
         read_only=False, required=False, slug_field="id", many=False, queryset=Session.objects.all()
     )
@@ -55,9 +65,19 @@ class TaskDetailsSeriaizer(serializers.ModelSerializer):
     session_path = serializers.CharField(read_only=True)
 
     @staticmethod
-    def setup_eager_loading(queryset):
-        """Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related("session", "data_repository")
+    def setup_eager_loading(queryset, fields=None):
+        """
+        Perform necessary eager loading of data to avoid horrible performance.
+        :param fields: optional names of the fields serialized, only their relations are loaded
+        """
+        queryset = eager_loading(
+            queryset,
+            fields,
+            select_related={
+                "session": ["session", "session_path"],
+                "data_repository": ["data_repository"],
+            },
+        )
         return queryset.order_by("level", "-priority", "-datetime")
 
     class Meta:
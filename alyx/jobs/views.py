@@ -12,7 +12,7 @@ from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 import numpy as np
 
-from alyx.base import BaseFilterSet, rest_permission_classes
+from alyx.base import BaseFilterSet, ConditionalMixin, rest_permission_classes
 import django_filters
 import structlog
 from misc.models import Lab
@@ -123,7 +123,7 @@ class TaskFilter(BaseFilterSet):
         exclude = ["json"]
 
 
-class TaskListView(generics.ListCreateAPIView):
+class TaskListView(ConditionalMixin, generics.ListCreateAPIView):
     """
     get: **FILTERS**
     -   **task**: task name `/jobs?task=EphysSyncPulses`
@@ -131,6 +131,15 @@ class TaskListView(generics.ListCreateAPIView):
     -   **lab**: lab name from session table `/jobs?lab=churchlandlab`
     -   **pipeline**: pipeline field from task `/jobs?pipeline=ephys`
 
+    **PAGINATION**: `/tasks?cursor=&limit=1000` pages by id without offset nor count, follow
+    the `next` link of each page
+
+    **FIELDS**: `/tasks?fields=id,status` or `/tasks?exclude=session` only returns the listed
+    fields
+
+    **CACHING**: send back the `ETag` of a response in `If-None-Match` to get a 304 Not Modified
+    when the tasks didn't change
+
     [===> task model reference](/admin/doc/models/jobs.task)
     """
 
@@ -138,6 +147,8 @@ class TaskListView(generics.ListCreateAPIView):
     # queryset = TaskListSerializer.setup_eager_loading(queryset)
     permission_classes = rest_permission_classes()
     filter_class = TaskFilter
+    cursor_ordering = ("id",)
+    conditional_field = "datetime"
 
     def get_serializer_class(self):
         if not self.request:
@@ -148,11 +159,13 @@ class TaskListView(generics.ListCreateAPIView):
             return TaskDetailsSeriaizer
 
 
-class TaskDetailView(generics.RetrieveUpdateDestroyAPIView):
+class TaskDetailView(ConditionalMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Task.objects.all()
     # queryset = TaskDetailsSeriaizer.setup_eager_loading(queryset)
     serializer_class = TaskDetailsSeriaizer
     permission_classes = rest_permission_classes()
+    conditional_field = "datetime"
+    conditional_relations = {"parents": None}
 
 
 def convert_mount(path, reverse=False) -> str:
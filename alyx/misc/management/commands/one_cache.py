@@ -1,15 +1,20 @@
 from time import time
+from datetime import datetime, timedelta
 import io
+import os
 import socket
 import json
 import logging
 from pathlib import Path
 import urllib.parse
-from functools import wraps
+from functools import wraps, partial
+from contextlib import suppress
+from itertools import islice
 from sys import getsizeof
 import zipfile
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 import pyarrow.parquet as pq
 import pyarrow as pa
@@ -18,17 +23,23 @@ from one.alf.cache import _metadata
 from one.remote.aws import get_s3_virtual_host
 
 from django.db import connection
-from django.db.models import Q, Exists, OuterRef
+from django.utils import timezone
+from django.db.models import Q, Count, Max, ExpressionWrapper, BooleanField
 from django.core.management.base import BaseCommand
 from django.contrib.postgres.aggregates import ArrayAgg
 
 from alyx.settings import TABLES_ROOT
 from actions.models import Session
-from data.models import Dataset, FileRecord
+from data.models import Dataset, Tag
 from experiments.models import ProbeInsertion
 
 logger = logging.getLogger(__name__)
 ONE_API_VERSION = "1.13.0"  # Minimum compatible ONE api version
+STREAM_CHUNK_SIZE = 50_000  # Default number of records per batch when streaming tables
+WATERMARK_OVERLAP = timedelta(minutes=1)  # Re-fetch records this close to the watermark
+CACHE_ZIP_NAME = "cache.zip"
+CACHE_INFO_NAME = "cache_info.json"
+TAG_CACHE_WORKERS = 4  # Number of threads writing tag caches in parallel
 
 
 def measure_time(func):
@@ -90,15 +101,78 @@ def _save(filename: str, df: pd.DataFrame, metadata: dict = None, dry=False) ->
             # Filename mustn't include scheme
             pq.write_table(table, parsed.path, filesystem=_s3_filesystem())
         elif parsed.scheme == "":
-            pq.write_table(table, filename)
+            pq.write_table(table, filename + ".tmp")
+            os.replace(filename + ".tmp", filename)
         else:
             raise ValueError(f'Unsupported URI scheme "{parsed.scheme}"')
     return table
 
 
+class _TellWriter(io.RawIOBase):
+    """
+    Write-only wrapper that keeps track of the stream position.
+
+    Zip entries opened for writing are not seekable and do not implement tell, which is required
+    by the parquet writer to record column chunk offsets.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        n = self._fp.write(b)
+        self._pos += n
+        return n
+
+    def tell(self):
+        return self._pos
+
+
+def _write_stream(
+    sink, frames, metadata: dict = None, types: dict = None, **kwargs
+) -> pq.FileMetaData:
+    """
+    Write an iterable of DataFrames to a single parquet table, one row group per frame.
+
+    Only one frame is held in memory at a time. The schema of the first frame is used for the
+    whole table, with the field types in `types` taking precedence so that columns that happen
+    to be entirely null in the first frame are typed correctly.
+
+    :param sink: A file path or writable file-like object
+    :param frames: An iterable of pandas DataFrames with identical columns and index
+    :param metadata: A dict of optional metadata
+    :param types: A map of column name to pyarrow data type
+    :param kwargs: Optional arguments to pass to pyarrow.parquet.ParquetWriter, e.g. filesystem
+    :return: The parquet file metadata, or None if no frames were written
+    """
+    writer = schema = None
+    types = types or {}
+    try:
+        for df in frames:
+            table = pa.Table.from_pandas(df)
+            if writer is None:
+                fields = [pa.field(f.name, types.get(f.name, f.type)) for f in table.schema]
+                meta = {
+                    "one_metadata": json.dumps(metadata or {}).encode(),
+                    **table.schema.metadata,
+                }
+                schema = pa.schema(fields, metadata=meta)
+                writer = pq.ParquetWriter(sink, schema, **kwargs)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    return writer.writer.metadata if writer is not None else None
+
+
 class Command(BaseCommand):
     """
-    NB: When compress flag is passed, all tables are expected to fit into memory together.
+    NB: When compress flag is passed, all tables are expected to fit into memory together, unless
+    the stream flag is also passed.
     """
 
     help = "Generate ONE cache tables"
@@ -106,6 +180,9 @@ class Command(BaseCommand):
     tables = None
     metadata = None
     compress = None
+    stream = None
+    incremental = None
+    chunk_size = STREAM_CHUNK_SIZE
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -120,7 +197,30 @@ class Command(BaseCommand):
         parser.add_argument("--int-id", action="store_true", help="Save uuids as ints")
         parser.add_argument("--compress", action="store_true", help="Save files into compressed folder")
         parser.add_argument("--tag", nargs="*", help="List of tag names to filter datasets by")
+        parser.add_argument(
+            "--tag-caches",
+            nargs="*",
+            help="Generate the global cache and a cache for each of these tags (default all) in a "
+            "single pass",
+        )
         parser.add_argument("--qc", action="store_true", help="Save QC fields to a JSON file")
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="Read records in chunks and write tables incrementally with bounded memory",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Update the previously generated tables with the records changed since the last "
+            "run",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=STREAM_CHUNK_SIZE,
+            help="Number of records per chunk when streaming",
+        )
 
     def handle(self, *_, **options):
         if options["verbosity"] < 1:
@@ -129,7 +229,19 @@ class Command(BaseCommand):
             logger.setLevel(logging.DEBUG)
         self.dst_dir = options.get("destination")  # TABLES_ROOT folder
         self.compress = options.get("compress")
+        self.stream = options.get("stream")
+        self.incremental = options.get("incremental")
+        self.chunk_size = options.get("chunk_size") or STREAM_CHUNK_SIZE
         tables, int_id, qc = options.get("tables"), options.get("int_id"), options.get("qc")
+        if options.get("tag_caches") is not None:
+            if options.get("tag") or self.stream or self.incremental:
+                raise ValueError(
+                    "--tag-caches may not be combined with --tag, --stream or --incremental"
+                )
+            self.metadata = create_metadata()
+            self.metadata["watermark"] = timezone.now().isoformat()
+            self.generate_tag_caches(tables, options["tag_caches"], int_id=int_id, export_qc=qc)
+            return
         self.generate_tables(tables, int_id=int_id, export_qc=qc, tags=options.get("tag"))
 
     def generate_tables(self, tables, export_qc=False, **kwargs) -> list:
@@ -141,18 +253,35 @@ class Command(BaseCommand):
         :return: A list of paths to the saved files.
         """
         self.metadata = create_metadata()
+        # Records modified after this time will be picked up by the next incremental run
+        self.metadata["watermark"] = timezone.now().isoformat()
         if kwargs.get("tags"):
             self.metadata["database_tags"] = kwargs.get("tags")
+        if self.stream:
+            if self.incremental:
+                raise ValueError("Incremental updates are not supported in stream mode")
+            return self._generate_tables_stream(tables, export_qc=export_qc, **kwargs)
+        since, previous = self._load_previous(tables, **kwargs) if self.incremental else (None, {})
         to_compress = {}
         dry = self.compress
         for table in tables:
             if table.lower() == "sessions":
-                logger.debug("Generating sessions DataFrame")
-                tbl, filename = self._save_table(generate_sessions_frame(**kwargs), table, dry=dry)
+                if since:
+                    logger.debug(f"Updating sessions DataFrame with changes since {since}")
+                    df = update_sessions_frame(previous["sessions"], since, **kwargs)
+                else:
+                    logger.debug("Generating sessions DataFrame")
+                    df = generate_sessions_frame(**kwargs)
+                tbl, filename = self._save_table(df, table, dry=dry)
                 to_compress[filename] = tbl
             elif table.lower() == "datasets":
-                logger.debug("Generating datasets DataFrame")
-                tbl, filename = self._save_table(generate_datasets_frame(**kwargs), table, dry=dry)
+                if since:
+                    logger.debug(f"Updating datasets DataFrame with changes since {since}")
+                    df = update_datasets_frame(previous["datasets"], since, **kwargs)
+                else:
+                    logger.debug("Generating datasets DataFrame")
+                    df = generate_datasets_frame(**kwargs)
+                tbl, filename = self._save_table(df, table, dry=dry)
                 to_compress[filename] = tbl
             else:
                 raise ValueError(f'Unknown table "{table}"')
@@ -163,9 +292,171 @@ class Command(BaseCommand):
 
         if self.compress:
             return list(self._compress_tables(to_compress))
+        elif self.incremental:
+            # The cache info holds the watermark for the next incremental run
+            tables_info = {
+                Path(f).stem: {"nrecs": t.num_rows, "size": t.nbytes}
+                for f, t in to_compress.items()
+                if isinstance(t, pa.Table)
+            }
+            metadata = {**self.metadata, "tables": tables_info}
+            tag_file = self._table_path(CACHE_INFO_NAME)
+            self._publish(tag_file, json.dumps(metadata, indent=1).encode())
+            return [*to_compress.keys(), tag_file]
         else:
             return list(to_compress.keys())
 
+    @measure_time
+    def generate_tag_caches(self, tables, tags=None, export_qc=False, int_id=True) -> list:
+        """
+        Generate the global cache and a cache for each tag from a single pass over the database.
+
+        The global tables and tag memberships are fetched once and partitioned in memory, then
+        each cache is written to its own folder (<dst_dir>/<tag>/) by a pool of worker threads.
+        The metadata attribute is expected to be set before calling this method.
+
+        :param tables: A tuple of table names.
+        :param tags: A list of tag names; if empty, a cache is generated for every tag.
+        :param export_qc: If true, the extended QC will be saved to a JSON file.
+        :param int_id: If true, uuids are saved as 2xint64.
+        :return: A list of paths to the saved files.
+        """
+        fetchers = {
+            "sessions": lambda: pd.DataFrame.from_records(
+                _sessions_query().values_list(*SESSIONS_FIELDS), columns=SESSIONS_FIELDS
+            ),
+            "datasets": lambda: pd.DataFrame.from_records(
+                _datasets_query().values_list(*DATASETS_FIELDS), columns=DATASETS_FIELDS
+            ),
+        }
+        formatters = {
+            "sessions": _format_sessions_frame,
+            "datasets": lambda df, int_id: _format_datasets_frame(df, int_id=int_id).sort_index(),
+        }
+        tables = [x.lower() for x in tables]
+        for table in tables:
+            if table not in fetchers:
+                raise ValueError(f'Unknown table "{table}"')
+        tags = list(tags or Tag.objects.values_list("name", flat=True))
+
+        # Fetch everything needed up front: the workers do not touch the database
+        members = Dataset.tags.through.objects.filter(tag__name__in=tags)
+        members = pd.DataFrame.from_records(
+            members.values_list("tag__name", "dataset_id", "dataset__session_id"),
+            columns=["tag", "dataset", "session"],
+        )
+        raw = {}
+        for table in tables:
+            logger.debug(f"Fetching {table} records")
+            raw[table] = fetchers[table]()
+        qc = self._fetch_qc() if export_qc else None
+
+        def write(tag):
+            writer = Command()
+            writer.compress = self.compress
+            writer.metadata = dict(self.metadata)
+            if tag is None:
+                writer.dst_dir, frames, qc_subset = self.dst_dir, raw, qc
+            else:
+                writer.dst_dir = self._table_path(tag)
+                writer.metadata["database_tags"] = [tag]
+                rows = members[members["tag"] == tag]
+                ids = {"sessions": rows["session"].unique(), "datasets": rows["dataset"].unique()}
+                frames = {k: df[df["id"].isin(ids[k])] for k, df in raw.items()}
+                if qc is not None:
+                    eids = set(map(str, ids["sessions"]))
+                    qc_subset = [d for d in qc if d["eid"] in eids]
+            to_compress = {}
+            for table in tables:
+                df = formatters[table](frames[table].copy(), int_id=int_id)
+                tbl, filename = writer._save_table(df, table, dry=self.compress)
+                to_compress[filename] = tbl
+            if qc is not None:
+                tbl, filename = writer._save_qc(dry=self.compress, qc=qc_subset)
+                to_compress[filename] = tbl
+            if self.compress:
+                return list(writer._compress_tables(to_compress))
+            return list(to_compress.keys())
+
+        logger.info(f"Writing global cache and {len(tags)} tag caches...")
+        with ThreadPoolExecutor(max_workers=TAG_CACHE_WORKERS) as executor:
+            return [f for files in executor.map(write, [None, *tags]) for f in files]
+
+    def _load_previous(self, tables, int_id=True, tags=None) -> tuple:
+        """
+        Load the watermark and tables saved by a previous run.
+
+        An incremental update is only possible if the previous run saved all the requested tables
+        with the same id format and tags.
+
+        :param tables: A tuple of table names.
+        :param int_id: If true, the tables are expected to be indexed by 2xint64 uuids.
+        :param tags: The dataset tags used to filter the tables.
+        :return: The watermark datetime and a map of table name to DataFrame, or (None, {}) if
+         the tables must be generated from scratch.
+        """
+        parsed = urllib.parse.urlparse(self.dst_dir)
+        scheme = parsed.scheme or "file"
+        try:
+            if scheme == "s3":
+                s3 = _s3_filesystem()
+
+                def read(name):
+                    path = f'{parsed.netloc}/{parsed.path.strip("/")}/{name}'
+                    with s3.open_input_stream(path) as stream:
+                        return stream.read()
+
+            else:
+
+                def read(name):
+                    return Path(self.dst_dir, name).read_bytes()
+
+            info = json.loads(read(CACHE_INFO_NAME))
+            if not info.get("watermark") or info.get("database_tags") != (tags or None):
+                logger.info(
+                    "Previous cache has no watermark or different tags; generating full tables"
+                )
+                return None, {}
+            previous = {}
+            if self.compress:
+                with zipfile.ZipFile(io.BytesIO(read(CACHE_ZIP_NAME))) as zip:
+                    for table in map(str.lower, tables):
+                        data = io.BytesIO(zip.read(f"{table}.pqt"))
+                        previous[table] = pq.read_table(data).to_pandas()
+            else:
+                for table in map(str.lower, tables):
+                    previous[table] = pq.read_table(io.BytesIO(read(f"{table}.pqt"))).to_pandas()
+        except (OSError, KeyError, ValueError) as ex:
+            logger.info(f"Failed to load previous cache ({ex}); generating full tables")
+            return None, {}
+        for table, df in previous.items():
+            if ("id_0" in df.index.names) != bool(int_id):
+                logger.info(
+                    f"Previous {table} table has different id format; generating full tables"
+                )
+                return None, {}
+        return datetime.fromisoformat(info["watermark"]) - WATERMARK_OVERLAP, previous
+
+    def _publish(self, filename, data):
+        """
+        Write data to a file in dst_dir, replacing any existing file atomically.
+
+        Local files are written to a temporary file then renamed; S3 objects are only visible once
+        the upload has completed.
+
+        :param filename: The full path of the file as returned by _table_path
+        :param data: The bytes or buffer to write
+        """
+        parsed = urllib.parse.urlparse(filename)
+        if parsed.scheme == "s3":
+            s3 = _s3_filesystem()
+            with s3.open_output_stream(f'{parsed.netloc}/{parsed.path.strip("/")}') as stream:
+                stream.write(data)
+        else:
+            with open(f"{filename}.tmp", "wb") as fid:
+                fid.write(data)
+            os.replace(f"{filename}.tmp", filename)
+
     def _save_table(self, table, name, **kwargs):
         """Save a given table to <dst_dir>/<name>.pqt.
 
@@ -179,17 +470,102 @@ class Command(BaseCommand):
         """
         if not kwargs.get("dry"):
             logger.info(f'Saving table "{name}" to {self.dst_dir}...')
+        filename = self._table_path(f"{name}.pqt")  # Save to parquet
+        pa_table = _save(filename, table, self.metadata, **kwargs)
+        return pa_table, filename
+
+    @measure_time
+    def _generate_tables_stream(self, tables, export_qc=False, **kwargs) -> list:
+        """
+        Generate and save a list of tables, reading the records in chunks.
+
+        Records are fetched through a server-side cursor and each chunk is written to the parquet
+        file (or directly into the zip archive when compressing) as a separate row group, so that
+        memory use is bounded by the chunk size rather than the size of the tables.
+
+        :param tables: A tuple of table names.
+        :param export_qc: If true, the extended QC will be saved to a JSON file.
+        :param kwargs: Arguments to pass to cache generation functions.
+        :return: A list of paths to the saved files.
+        """
+        generators = {"sessions": iter_sessions_frames, "datasets": iter_datasets_frames}
+        types = {"sessions": SESSIONS_TYPES, "datasets": DATASETS_TYPES}
+        for table in tables:
+            if table.lower() not in generators:
+                raise ValueError(f'Unknown table "{table}"')
+        scheme = urllib.parse.urlparse(self.dst_dir).scheme or "file"
+        if scheme not in ("file", "s3"):
+            raise ValueError(f'Unsupported URI scheme "{scheme}"')
+
+        def frames(name):
+            logger.debug(f"Streaming {name} DataFrame")
+            return generators[name](chunk_size=self.chunk_size, **kwargs)
+
+        if not self.compress:
+            filenames = []
+            for table in map(str.lower, tables):
+                logger.info(f'Saving table "{table}" to {self.dst_dir}...')
+                filename = self._table_path(f"{table}.pqt")
+                if scheme == "s3":
+                    parsed = urllib.parse.urlparse(filename)
+                    sink = f"{parsed.netloc}/{parsed.path.strip('/')}"
+                    fs_kwargs = {"filesystem": _s3_filesystem()}
+                else:
+                    sink, fs_kwargs = f"{filename}.tmp", {}
+                info = _write_stream(sink, frames(table), self.metadata, types[table], **fs_kwargs)
+                if scheme == "file" and info is not None:
+                    os.replace(sink, filename)
+                logger.debug(f"Wrote {info.num_rows if info else 0} {table} records")
+                filenames.append(filename)
+            if export_qc:
+                filenames.append(self._save_qc(tags=kwargs.get("tags"))[1])
+            return filenames
+
+        logger.info("Compressing tables...")
+
+        def write_tables(zip):
+            jsonmeta = {}
+            for table in map(str.lower, tables):
+                with zip.open(f"{table}.pqt", "w", force_zip64=True) as entry:
+                    sink = _TellWriter(entry)
+                    info = _write_stream(sink, frames(table), self.metadata, types[table])
+                jsonmeta[table] = {"nrecs": info.num_rows if info else 0, "size": sink.tell()}
+            if export_qc:
+                qc, _ = self._save_qc(dry=True, tags=kwargs.get("tags"))
+                zip.writestr("QC.json", json.dumps(qc))
+            return jsonmeta
+
+        return list(self._publish_zip(write_tables))
+
+    def _table_path(self, name) -> str:
+        """Return the full path of a file within dst_dir, creating the local folder if required"""
         scheme = urllib.parse.urlparse(self.dst_dir).scheme or "file"
         if scheme == "file":
-            Path(self.dst_dir).mkdir(exist_ok=True)
-            filename = Path(self.dst_dir) / f"{name}.pqt"  # Save to parquet
-        else:
-            filename = self.dst_dir.strip("/") + f"/{name}.pqt"  # Save to parquet
-        pa_table = _save(str(filename), table, self.metadata, **kwargs)
-        return pa_table, str(filename)
+            Path(self.dst_dir).mkdir(parents=True, exist_ok=True)
+            return str(Path(self.dst_dir) / name)
+        return self.dst_dir.strip("/") + f"/{name}"
 
     @measure_time
-    def _save_qc(self, dry=False, tags=None):
+    def _save_qc(self, dry=False, tags=None, qc=None):
+        """
+        Save the session and insertion QC to <dst_dir>/QC.json.
+
+        :param dry: If True, does not actually write to disk
+        :param tags: The dataset tags used to filter the sessions
+        :param qc: A list of QC records as returned by _fetch_qc; if None, the records are fetched
+        :return: The QC records and the full path to the saved file
+        """
+        if qc is None:
+            qc = self._fetch_qc(tags=tags)
+        filename = self._table_path("QC.json")  # Save to JSON
+        if not dry:
+            with open(filename, "w") as fp:
+                json.dump(qc, fp)
+        return qc, filename
+
+    @staticmethod
+    def _fetch_qc(tags=None) -> list:
+        """Fetch the session QC records, collated with the QC of their probe insertions"""
         sessions = Session.objects.all()
         if tags:
             if not isinstance(tags, str):
@@ -226,89 +602,152 @@ class Command(BaseCommand):
                     "extended_qc": ins["json"].pop("extended_qc"),
                 }
             )
-
-        filename = self.dst_dir.strip("/") + "/QC.json"  # Save to JSON
-        if not dry:
-            with open(filename, "w") as fp:
-                json.dump(qc, fp)
-        return qc, str(filename)
+        return qc
 
     def _compress_tables(self, table_map) -> tuple:
         """
         Write cache_info JSON and create zip file comprising parquet tables + JSON
 
-        :param table_map: a dict of filenames and corresponding
-        :return:
+        Each parquet table is written straight into its zip entry, see _publish_zip.
+
+        :param table_map: a dict of filenames and corresponding pyarrow tables or JSON records
+        :return: The paths of the zip and cache info files
         """
-        ZIP_NAME = "cache.zip"
-        META_NAME = "cache_info.json"
+        logger.info("Compressing tables...")
 
-        logger.info("Compressing tables...")  # Write zip in memory
-        zip_buffer = io.BytesIO()  # Mem buffer to store compressed table data
-        with tempfile.TemporaryDirectory() as tmp, zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip:
+        def write_tables(zip):
             jsonmeta = {}
             for filename, table in table_map.items():
-                tmp_filename = Path(tmp) / Path(filename).name  # Table filename in temp dir
-                ext = Path(filename).suffix
+                name, ext = Path(filename).name, Path(filename).suffix
                 if ext == ".pqt":
-                    pq.write_table(table, tmp_filename)  # Write table to tempdir
-                    zip.write(tmp_filename, Path(filename).name)  # Load and compress
-                    pqtinfo = pq.read_metadata(tmp_filename)  # Load metadata for cache_info file
-                    jsonmeta[Path(filename).stem] = {"nrecs": pqtinfo.num_rows, "size": pqtinfo.serialized_size}
+                    with zip.open(name, "w", force_zip64=True) as entry:
+                        sink = _TellWriter(entry)
+                        with pq.ParquetWriter(sink, table.schema) as writer:
+                            writer.write_table(table)
+                    jsonmeta[Path(filename).stem] = {"nrecs": table.num_rows, "size": sink.tell()}
                 elif ext == ".json":
-                    with open(tmp_filename, "w") as fp:
-                        json.dump(table, fp)
-                    zip.write(tmp_filename, Path(filename).name)
+                    zip.writestr(name, json.dumps(table))
                 else:
                     raise NotImplementedError(f'Unable to save table with extension "{ext}"')
-            metadata = {**self.metadata, "tables": jsonmeta}
-            zip.writestr(META_NAME, json.dumps(metadata, indent=1))  # Compress cache info
+            return jsonmeta
+
+        return self._publish_zip(write_tables)
+
+    def _publish_zip(self, write_tables) -> tuple:
+        """
+        Stream the cache tables into <dst_dir>/cache.zip, then write the cache_info JSON.
+
+        The archive is written directly to its destination without an intermediate copy in memory
+        or on disk. A local archive is written to a temporary file that then replaces the
+        previous one; on S3 it is uploaded to a temporary key through a multipart output stream and
+        moved once complete. The cache info is written last so that clients never see new info
+        pointing to an old archive.
 
-        logger.info("Writing to file...")
+        NB: S3 objects larger than 5 GB cannot be moved.
+
+        :param write_tables: A callable that writes the tables into an open ZipFile and returns a
+         dict of table name to table info (nrecs, size)
+        :return: The paths of the zip and cache info files
+        """
         parsed = urllib.parse.urlparse(self.dst_dir)
         scheme = parsed.scheme or "file"
+        if scheme == "s3":
+            s3 = _s3_filesystem()
+            zip_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{CACHE_ZIP_NAME}'
+            tag_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{CACHE_INFO_NAME}'
+            open_stream, remove = s3.open_output_stream, s3.delete_file
+        elif scheme == "file":
+            zip_file = Path(self._table_path(CACHE_ZIP_NAME))
+            tag_file = Path(self.dst_dir) / CACHE_INFO_NAME
+            open_stream, remove = partial(open, mode="wb"), os.remove
+        else:
+            raise ValueError(f'Unsupported URI scheme "{scheme}"')
+
+        tmp_file = f"{zip_file}.tmp"
+        logger.debug(f"Opening output stream to {tmp_file}")
         try:
+            with open_stream(tmp_file) as stream, \
+                    zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as zip:
+                metadata = {**self.metadata, "tables": write_tables(zip)}
+                # Compress cache info
+                zip.writestr(CACHE_INFO_NAME, json.dumps(metadata, indent=1))
             if scheme == "s3":
-                zip_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{ZIP_NAME}'
-                tag_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{META_NAME}'
-                s3 = _s3_filesystem()
+                s3.move(tmp_file, zip_file)
                 metadata["location"] = get_s3_virtual_host(zip_file, s3.region)  # Add URL
-                # Write cache info json to s3
-                logger.debug(f"Opening output stream to {tag_file}")
-                with s3.open_output_stream(tag_file) as stream:
-                    stream.write(json.dumps(metadata, indent=1).encode())
-                # Write zip file to s3
-                logger.debug(f"Opening output stream to {zip_file}")
-                with s3.open_output_stream(zip_file) as stream:
-                    stream.write(zip_buffer.getbuffer())
-            elif scheme == "file":
-                # creates a json file containing metadata and add it to the zip file
-                tag_file = Path(self.dst_dir) / META_NAME
-                zip_file = Path(self.dst_dir) / ZIP_NAME
-                with open(tag_file, "w") as fid:
-                    json.dump(metadata, fid, indent=1)
-                with open(zip_file, "wb") as fid:
-                    fid.write(zip_buffer.getbuffer())
             else:
-                raise ValueError(f'Unsupported URI scheme "{scheme}"')
-        finally:
-            zip_buffer.close()
+                os.replace(tmp_file, zip_file)
+        except BaseException:
+            with suppress(OSError):
+                remove(tmp_file)
+            raise
+        self._publish(self._table_path(CACHE_INFO_NAME), json.dumps(metadata, indent=1).encode())
         return zip_file, tag_file
 
 
-@measure_time
-def generate_sessions_frame(int_id=True, tags=None) -> pd.DataFrame:
-    """SESSIONS_COLUMNS = (
-        'id',               # uuid str
-        'lab',              # str
-        'subject',          # str
-        'date',             # str yyyy-mm-dd
-        'number',           # int64
-        'task_protocol',    # str
-        'projects'           # str
-    )
+SESSIONS_FIELDS = (
+    "id",
+    "lab__name",
+    "subject__nickname",
+    "start_time__date",
+    "number",
+    "task_protocol",
+    "all_projects",
+)
+SESSIONS_TYPES = {"task_protocol": pa.string(), "projects": pa.string()}
+DATASETS_FIELDS = (
+    "id",
+    "name",
+    "file_size",
+    "hash",
+    "collection",
+    "revision__name",
+    "default_dataset",
+    "session__id",
+    "session__start_time__date",
+    "session__number",
+    "session__subject__nickname",
+    "session__lab__name",
+    "exists_flatiron",
+    "exists_aws",
+)
+DATASETS_TYPES = {"file_size": pa.float64(), "hash": pa.string(), "rel_path": pa.string()}
+
+
+def _uuid2np(uuids) -> np.ndarray:
+    """Convert UUID objects to an Nx2 int64 array, including for empty inputs"""
+    return uuid2np(uuids) if len(uuids) else np.empty((0, 2), dtype=np.int64)
+
+
+def _iter_chunks(query, fields, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield DataFrames of at most `chunk_size` records, fetched through a server-side cursor"""
+    records = query.values_list(*fields).iterator(chunk_size=chunk_size)
+    while chunk := list(islice(records, chunk_size)):
+        yield pd.DataFrame.from_records(chunk, columns=fields)
+
+
+def _filter_sessions(project=None, lab=None, subject=None, date_range=None, dataset_type=None):
     """
-    fields = ("id", "lab__name", "subject__nickname", "start_time__date", "number", "task_protocol", "all_projects")
+    Return the primary keys of the sessions matching the given filters.
+
+    :param project: A project name
+    :param lab: A lab name
+    :param subject: A subject nickname
+    :param date_range: A pair of dates (inclusive)
+    :param dataset_type: A dataset type name; sessions must have at least one such dataset
+    :return: A values queryset of session pks, or None if no filters were given
+    """
+    lookups = {
+        "projects__name": project,
+        "lab__name": lab,
+        "subject__nickname": subject,
+        "start_time__date__range": date_range,
+        "data_dataset_session_related__dataset_type__name": dataset_type,
+    }
+    lookups = {k: v for k, v in lookups.items() if v}
+    return Session.objects.filter(**lookups).values("pk") if lookups else None
+
+
+def _sessions_query(tags=None, **filters):
     query = (
         Session.objects.select_related("subject", "lab")
         .prefetch_related("projects")
@@ -320,9 +759,13 @@ def generate_sessions_frame(int_id=True, tags=None) -> pd.DataFrame:
             query = query.filter(data_dataset_session_related__tags__name__in=tags)
         else:
             query = query.filter(data_dataset_session_related__tags__name=tags)
-    df = pd.DataFrame.from_records(query.values(*fields).distinct())
-    logger.debug(f"Raw session frame = {getsizeof(df) / 1024**2} MiB")
-    # Rename, sort fields
+    if (sessions := _filter_sessions(**filters)) is not None:
+        query = query.filter(pk__in=sessions)
+    return query.distinct()
+
+
+def _format_sessions_frame(df, int_id=True) -> pd.DataFrame:
+    """Rename and convert the raw session records to the ONE sessions table format"""
     df["all_projects"] = df["all_projects"].map(lambda x: ",".join(filter(None, set(x))))
     df = (
         df.rename(lambda x: x.split("__")[0], axis=1)
@@ -337,63 +780,73 @@ def generate_sessions_frame(int_id=True, tags=None) -> pd.DataFrame:
 
     if int_id:
         # Convert UUID objects to 2xint64
-        df[["id_0", "id_1"]] = uuid2np(df["id"].values)
+        df[["id_0", "id_1"]] = _uuid2np(df["id"].values)
         df = df.drop("id", axis=1).set_index(["id_0", "id_1"])
     else:
         # Convert UUID objects to str: not supported by parquet
         df["id"] = df["id"].astype(str)
         df.set_index("id", inplace=True)
-
-    logger.debug(f"Final session frame = {getsizeof(df) / 1024 ** 2:.1f} MiB")
     return df
 
 
 @measure_time
-def generate_datasets_frame(int_id=True, tags=None) -> pd.DataFrame:
-    """DATASETS_COLUMNS = (
+def generate_sessions_frame(int_id=True, tags=None, **filters) -> pd.DataFrame:
+    """SESSIONS_COLUMNS = (
         'id',               # uuid str
-        'eid',              # uuid str
-        'session_path',     # relative to the root
-        'rel_path',         # relative to the session path, includes the filename
-        'file_size',        # float, bytes, optional
-        'hash',             # sha1/md5 str, recomputed in load function
-        'exists'            # bool
+        'lab',              # str
+        'subject',          # str
+        'date',             # str yyyy-mm-dd
+        'number',           # int64
+        'task_protocol',    # str
+        'projects'           # str
     )
     """
-    # Determine which file records are on AWS and which are on FlatIron
-    fr = FileRecord.objects.select_related("data_repository")
-    on_flatiron = fr.filter(dataset=OuterRef("pk"), exists=True, data_repository__name__startswith="flatiron").values(
-        "pk"
-    )
-    on_aws = fr.filter(dataset=OuterRef("pk"), exists=True, data_repository__name__startswith="aws").values("pk")
+    query = _sessions_query(tags, **filters)
+    df = pd.DataFrame.from_records(query.values_list(*SESSIONS_FIELDS), columns=SESSIONS_FIELDS)
+    logger.debug(f"Raw session frame = {getsizeof(df) / 1024**2} MiB")
+    df = _format_sessions_frame(df, int_id=int_id)
+    logger.debug(f"Final session frame = {getsizeof(df) / 1024 ** 2:.1f} MiB")
+    return df
+
+
+def iter_sessions_frames(int_id=True, tags=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the sessions table in chunks of at most `chunk_size` records.
+
+    See generate_sessions_frame for the table columns. Rows are sorted within each chunk only.
+    """
+    for df in _iter_chunks(_sessions_query(tags), SESSIONS_FIELDS, chunk_size):
+        df = _format_sessions_frame(df, int_id=int_id)
+        if not df.empty:
+            yield df
+
+
+def _datasets_query(tags=None, dataset_type=None, **filters):
+    # Determine which datasets exist on AWS and which on FlatIron, see DatasetAvailability
+    exists = Q(availability__n_existing__gt=0)
+    on_flatiron = exists & Q(data_repository__name__startswith="flatiron")
+    on_aws = exists & Q(data_repository__name__startswith="aws")
     # Fetch datasets and their related tables
     ds = Dataset.objects.select_related("session", "session__subject", "session__lab", "revision")
     if tags:
         kw = {"tags__name__in" if not isinstance(tags, str) else "tags__name": tags}
         ds = ds.prefetch_related("tag").filter(**kw)
+    if dataset_type:
+        ds = ds.filter(dataset_type__name=dataset_type)
+    if (sessions := _filter_sessions(**filters)) is not None:
+        ds = ds.filter(session__in=sessions)
     # Filter out datasets that do not exist on either repository
-    ds = ds.annotate(exists_flatiron=Exists(on_flatiron), exists_aws=Exists(on_aws))
-    ds = ds.filter(Q(exists_flatiron=True) | Q(exists_aws=True))
-
-    # fields to keep from Dataset table
-    fields = (
-        "id",
-        "name",
-        "file_size",
-        "hash",
-        "collection",
-        "revision__name",
-        "default_dataset",
-        "session__id",
-        "session__start_time__date",
-        "session__number",
-        "session__subject__nickname",
-        "session__lab__name",
-        "exists_flatiron",
-        "exists_aws",
+    ds = ds.annotate(
+        exists_flatiron=ExpressionWrapper(on_flatiron, output_field=BooleanField()),
+        exists_aws=ExpressionWrapper(on_aws, output_field=BooleanField()),
     )
+    return ds.filter(Q(exists_flatiron=True) | Q(exists_aws=True))
+
+
+def _format_datasets_frame(df, int_id=True) -> pd.DataFrame:
+    """Rename and convert the raw dataset records to the ONE datasets table format"""
     fields_map = {"session__id": "eid", "default_dataset": "default_revision"}
-    df = pd.DataFrame.from_records(ds.values(*fields)).rename(fields_map, axis=1)
+    df = df.rename(fields_map, axis=1)
+    df["file_size"] = df["file_size"].astype(float)
     df["exists"] = True
 
     # TODO New version without this nonsense
@@ -401,28 +854,203 @@ def generate_datasets_frame(int_id=True, tags=None) -> pd.DataFrame:
     globus_path = df.pop("session__lab__name") + "/Subjects"
     subject = df.pop("session__subject__nickname")
     date = df.pop("session__start_time__date").astype(str)
-    number = df.pop("session__number").apply(lambda x: str(x).zfill(3))
+    number = df.pop("session__number").astype(str).str.zfill(3)
     df["session_path"] = globus_path.str.cat((subject, date, number), sep="/")
 
-    # relative_path
-    revision = map(lambda x: None if not x else f"#{x}#", df.pop("revision__name"))
-    zipped = zip(df.pop("collection"), revision, df.pop("name"))
-    df["rel_path"] = ["/".join(filter(None, x)) for x in zipped]
+    # relative_path: collection/#revision#/name, omitting the empty parts
+    revision = df.pop("revision__name").fillna("")
+    revision = ("#" + revision + "#").where(revision != "", "")
+    collection = df.pop("collection").fillna("")
+    rel_path = collection.str.cat((revision, df.pop("name")), sep="/")
+    df["rel_path"] = rel_path.str.replace("/{2,}", "/", regex=True).str.lstrip("/")
 
     if int_id:
         # Convert UUID objects to 2xint64
-        df[["id_0", "id_1"]] = uuid2np(df["id"].values)
-        df[["eid_0", "eid_1"]] = uuid2np(df["eid"].values)
-        df = df.drop(["id", "eid"], axis=1).set_index(["eid_0", "eid_1", "id_0", "id_1"]).sort_index()
+        df[["id_0", "id_1"]] = _uuid2np(df["id"].values)
+        df[["eid_0", "eid_1"]] = _uuid2np(df["eid"].values)
+        df = df.drop(["id", "eid"], axis=1).set_index(["eid_0", "eid_1", "id_0", "id_1"])
     else:
         # Convert UUIDs to str: not supported by parquet
         df[["id", "eid"]] = df[["id", "eid"]].astype(str)
-        df = df.set_index(["eid", "id"]).sort_index()
+        df = df.set_index(["eid", "id"])
+    return df
+
 
+@measure_time
+def generate_datasets_frame(int_id=True, tags=None, **filters) -> pd.DataFrame:
+    """DATASETS_COLUMNS = (
+        'id',               # uuid str
+        'eid',              # uuid str
+        'session_path',     # relative to the root
+        'rel_path',         # relative to the session path, includes the filename
+        'file_size',        # float, bytes, optional
+        'hash',             # sha1/md5 str, recomputed in load function
+        'exists'            # bool
+    )
+    """
+    query = _datasets_query(tags, **filters)
+    df = pd.DataFrame.from_records(query.values_list(*DATASETS_FIELDS), columns=DATASETS_FIELDS)
+    df = _format_datasets_frame(df, int_id=int_id).sort_index()
     logger.debug(f"Final datasets frame = {getsizeof(df) / 1024 ** 2:.1f} MiB")
     return df
 
 
+def iter_datasets_frames(int_id=True, tags=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the datasets table in chunks of at most `chunk_size` records.
+
+    See generate_datasets_frame for the table columns. Records are ordered by session and dataset
+    UUID in the database rather than sorted in memory.
+    """
+    query = _datasets_query(tags).order_by("session_id", "id")
+    for df in _iter_chunks(query, DATASETS_FIELDS, chunk_size):
+        yield _format_datasets_frame(df, int_id=int_id)
+
+
+def _merge_frames(previous, changed, changed_ids, current_ids, int_id=True) -> pd.DataFrame:
+    """
+    Merge changed records into a previously generated table.
+
+    Rows of the previous table whose id was either changed or is no longer in the database are
+    dropped and the changed rows are appended.
+
+    :param previous: The previously generated table
+    :param changed: The table of changed records, formatted like the previous table
+    :param changed_ids: The UUIDs of all changed records, including those removed when formatting
+    :param current_ids: The UUIDs of all the records that currently belong in the table
+    :param int_id: If true, the tables are indexed by 2xint64 uuids
+    :return: The merged table
+    """
+
+    def to_keys(ids):
+        ids = list(ids)
+        if not int_id:
+            return [str(x) for x in ids]
+        return list(map(tuple, _uuid2np(ids)))
+
+    id_levels = ["id_0", "id_1"] if int_id else ["id"]
+    other_levels = [x for x in previous.index.names if x not in id_levels]
+    keys = previous.index.droplevel(other_levels) if other_levels else previous.index
+    keep = keys.isin(to_keys(current_ids)) & ~keys.isin(to_keys(changed_ids))
+    logger.debug(
+        f"Dropping {(~keep).sum()} previous records and adding {len(changed)} changed records"
+    )
+    return pd.concat([previous[keep], changed])
+
+
+@measure_time
+def update_sessions_frame(previous, since, int_id=True, tags=None) -> pd.DataFrame:
+    """
+    Update a sessions table with the sessions modified since a given time.
+
+    See generate_sessions_frame for the table columns.
+
+    :param previous: The previously generated sessions table
+    :param since: Sessions with an auto_datetime on or after this datetime are updated
+    :param int_id: If true, the tables are indexed by 2xint64 uuids
+    :param tags: The dataset tags used to filter the sessions
+    :return: The updated sessions table
+    """
+    query = _sessions_query(tags)
+    changed = query.filter(auto_datetime__gte=since)
+    df = pd.DataFrame.from_records(changed.values_list(*SESSIONS_FIELDS), columns=SESSIONS_FIELDS)
+    changed_ids = df["id"].tolist()
+    if not df.empty:
+        df = _format_sessions_frame(df, int_id=int_id)
+    if df.empty:  # Nothing changed or only dud sessions
+        df = previous.iloc[:0]
+    current_ids = query.values_list("id", flat=True)
+    df = _merge_frames(previous, df, changed_ids, current_ids, int_id=int_id)
+    return df.sort_values(["date", "subject", "number"], ascending=False)
+
+
+@measure_time
+def update_datasets_frame(previous, since, int_id=True, tags=None) -> pd.DataFrame:
+    """
+    Update a datasets table with the datasets modified since a given time.
+
+    Datasets are considered modified if either they or their session have an auto_datetime on
+    or after `since`, or if their availability was updated since, as the exists flag of the file
+    records is often changed by bulk updates that do not touch the dataset. See
+    generate_datasets_frame for the table columns.
+
+    :param previous: The previously generated datasets table
+    :param since: Datasets modified on or after this datetime are updated
+    :param int_id: If true, the tables are indexed by 2xint64 uuids
+    :param tags: The dataset tags used to filter the datasets
+    :return: The updated datasets table
+    """
+    query = _datasets_query(tags)
+    changed = query.filter(
+        Q(auto_datetime__gte=since) |
+        Q(session__auto_datetime__gte=since) |
+        Q(availability__updated__gte=since)
+    )
+    df = pd.DataFrame.from_records(changed.values_list(*DATASETS_FIELDS), columns=DATASETS_FIELDS)
+    changed_ids = df["id"].tolist()
+    df = _format_datasets_frame(df, int_id=int_id) if not df.empty else previous.iloc[:0]
+    # Datasets that no longer exist on a repository are also absent from the current ids
+    current_ids = query.values_list("id", flat=True)
+    return _merge_frames(previous, df, changed_ids, current_ids, int_id=int_id).sort_index()
+
+
+def table_slice_version(table, tags=None, **filters) -> str:
+    """
+    Return a token that changes whenever the records of a filtered table change.
+
+    The token combines the number of matching records, which changes upon deletion, with the
+    most recent auto_datetime of the records (and of their sessions and availability for the
+    datasets table).
+
+    :param table: The table name, 'sessions' or 'datasets'
+    :param tags: The dataset tags used to filter the records
+    :param filters: Further filters, see _filter_sessions and _datasets_query
+    :return: A version string
+    """
+    if table == "sessions":
+        query = _sessions_query(tags, **filters).order_by()
+        stats = query.aggregate(n=Count("pk", distinct=True), last=Max("auto_datetime"))
+    elif table == "datasets":
+        query = _datasets_query(tags, **filters).order_by()
+        stats = query.aggregate(
+            n=Count("pk", distinct=True),
+            last=Max("auto_datetime"),
+            last_session=Max("session__auto_datetime"),
+            last_availability=Max("availability__updated"),
+        )
+    else:
+        raise ValueError(f'Unknown table "{table}"')
+    return json.dumps(stats, default=str, sort_keys=True)
+
+
+def save_table_slice(
+    filename, table, fmt="pqt", int_id=False, tags=None, metadata=None, **filters
+) -> pa.Table:
+    """
+    Save a subset of the sessions or datasets cache table to a local file.
+
+    :param filename: The local file path
+    :param table: The table name, 'sessions' or 'datasets'
+    :param fmt: The file format, either 'pqt' (parquet) or 'arrow' (Arrow IPC file)
+    :param int_id: If true, uuids are saved as 2xint64
+    :param tags: The dataset tags used to filter the records
+    :param metadata: A dict of optional metadata
+    :param filters: Further filters, see _filter_sessions and _datasets_query
+    :return: The saved pyarrow table
+    """
+    generators = {"sessions": generate_sessions_frame, "datasets": generate_datasets_frame}
+    if table not in generators:
+        raise ValueError(f'Unknown table "{table}"')
+    df = generators[table](int_id=int_id, tags=tags, **filters)
+    if fmt == "pqt":
+        return _save(filename, df, metadata)
+    elif fmt == "arrow":
+        pa_table = update_table_metadata(pa.Table.from_pandas(df), metadata)
+        with pa.OSFile(filename, "wb") as sink, pa.ipc.new_file(sink, pa_table.schema) as writer:
+            writer.write_table(pa_table)
+        return pa_table
+    raise ValueError(f'Unsupported format "{fmt}"')
+
+
 def create_metadata() -> dict:
     """Create ONE metadata dictionary"""
     meta = _metadata(connection.settings_dict["NAME"] or socket.gethostname())
@@ -15,7 +15,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.utils import timezone
 
-from alyx.base import BaseModel, modify_fields
+from alyx.base import BaseModel, ReferenceManager, modify_fields, reference_table
 from alyx.settings import TIME_ZONE, UPLOADED_IMAGE_WIDTH, DEFAULT_LAB_NAME
 
 
@@ -60,7 +60,10 @@ class LabMember(AbstractUser):
         return "username"
 
 
+@reference_table
 class Lab(BaseModel):
+    objects = ReferenceManager()
+
     name = models.CharField(max_length=255, unique=True)
     institution = models.CharField(max_length=255, blank=True)
     address = models.CharField(max_length=255, blank=True)
@@ -124,3 +124,190 @@ class ONECache(TestCase):
         s3 = one_cache._s3_filesystem(region=region)
         self.assertIsInstance(s3, pa.fs.S3FileSystem)
         self.assertEqual(s3.region, region)
+
+    def test_format_datasets_frame(self):
+        """Test the vectorized session and relative path construction of datasets table"""
+        import uuid
+        import datetime
+        import pandas as pd
+        eid = uuid.uuid4()
+        records = [
+            (uuid.uuid4(), 'a.b.npy', 10, None, 'alf', 'v1', True, eid,
+             datetime.date(2020, 1, 2), 1, 'foo', 'lab', True, False),
+            (uuid.uuid4(), 'c.d.npy', None, 'abc', '', None, True, eid,
+             datetime.date(2020, 1, 2), 1, 'foo', 'lab', False, True),
+            (uuid.uuid4(), 'e.f.npy', 5, 'def', 'raw/probe00', '', False, eid,
+             datetime.date(2020, 1, 2), 1, 'foo', 'lab', True, True),
+        ]
+        df = pd.DataFrame.from_records(records, columns=one_cache.DATASETS_FIELDS)
+        df = one_cache._format_datasets_frame(df, int_id=False)
+        expected = ['alf/#v1#/a.b.npy', 'c.d.npy', 'raw/probe00/e.f.npy']
+        self.assertEqual(expected, df['rel_path'].tolist())
+        self.assertEqual({'lab/Subjects/foo/2020-01-02/001'}, set(df['session_path']))
+        self.assertEqual(['eid', 'id'], df.index.names)
+        self.assertEqual('float64', df['file_size'].dtype)
+
+    def test_write_stream(self):
+        """Test writing a parquet table in chunks into a zip archive"""
+        import io
+        import zipfile
+        import pandas as pd
+        import pyarrow.parquet as pq
+        frames = [
+            pd.DataFrame({'id': ['a', 'b'], 'hash': [None, None]}).set_index('id'),
+            pd.DataFrame({'id': ['c'], 'hash': ['abc']}).set_index('id'),
+        ]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zip:
+            with zip.open('datasets.pqt', 'w') as entry:
+                info = one_cache._write_stream(
+                    one_cache._TellWriter(entry), frames, {'foo': 'bar'}, {'hash': pa.string()})
+        self.assertEqual(3, info.num_rows)
+        self.assertEqual(2, info.num_row_groups)
+        with zipfile.ZipFile(buffer) as zip:
+            table = pq.read_table(io.BytesIO(zip.read('datasets.pqt')))
+        self.assertIn(b'one_metadata', table.schema.metadata)
+        df = table.to_pandas()
+        self.assertEqual(['a', 'b', 'c'], df.index.tolist())
+        self.assertEqual([True, True, False], df['hash'].isna().tolist())
+        self.assertEqual('abc', df.loc['c', 'hash'])
+        # No frames should write nothing
+        self.assertIsNone(one_cache._write_stream(io.BytesIO(), []))
+
+    def test_merge_frames(self):
+        """Test merging changed records into a previous table for incremental updates"""
+        import uuid
+        import pandas as pd
+        eid, ids = uuid.uuid4(), [uuid.uuid4() for _ in range(4)]
+        for int_id in (False, True):
+            with self.subTest(int_id=int_id):
+                def frame(idx, sizes):
+                    df = pd.DataFrame({
+                        'id': [ids[i] for i in idx], 'eid': eid, 'file_size': sizes
+                    })
+                    if int_id:
+                        df[['id_0', 'id_1']] = one_cache.uuid2np(df['id'].values)
+                        df[['eid_0', 'eid_1']] = one_cache.uuid2np(df['eid'].values)
+                        return df.drop(['id', 'eid'], axis=1).set_index(
+                            ['eid_0', 'eid_1', 'id_0', 'id_1'])
+                    return df.astype({'id': str, 'eid': str}).set_index(['eid', 'id'])
+
+                previous = frame([0, 1, 2], [1., 2., 3.])
+                changed = frame([1, 3], [20., 40.])
+                # Dataset 2 was deleted, 1 was modified and 3 was added
+                current_ids = [ids[0], ids[1], ids[3]]
+                merged = one_cache._merge_frames(
+                    previous, changed, [ids[1], ids[3]], current_ids, int_id=int_id).sort_index()
+                self.assertEqual(frame([0, 1, 3], [1., 20., 40.]).sort_index().to_dict(),
+                                 merged.to_dict())
+                # No changes
+                merged = one_cache._merge_frames(
+                    previous, previous.iloc[:0], [], ids, int_id=int_id)
+                self.assertTrue(previous.equals(merged))
+
+    def test_generate_tag_caches(self):
+        """Test generating the global cache and the tag caches in a single pass"""
+        import tempfile
+        from pathlib import Path
+        import pandas as pd
+        from misc.models import Lab
+        from actions.models import Session
+        from data.models import (
+            Dataset, DatasetType, DataFormat, DataRepository, FileRecord, Tag)
+        from subjects.models import Project
+        lab = Lab.objects.create(name='cachelab')
+        subject = Subject.objects.create(nickname='cachesub', lab=lab)
+        repo = DataRepository.objects.create(name='flatiron_cachelab')
+        project = Project.objects.create(name='cacheproject', default_data_repository=repo)
+        fmt = DataFormat.objects.create(file_extension='npy')
+        tag = Tag.objects.create(name='cachetag')
+        Tag.objects.create(name='emptytag')
+        start_time = datetime(2020, 1, 2, 12)
+        sessions = [Session.objects.create(subject=subject, lab=lab, project=project, number=n,
+                                           start_time=start_time) for n in (1, 2)]
+        for i, session in enumerate(sessions):
+            dtype = DatasetType.objects.create(object=f'obj{i}', attribute='attr')
+            dset = Dataset.objects.create(session=session, dataset_type=dtype, data_format=fmt,
+                                          collection='alf', data_repository=repo)
+            FileRecord.objects.create(dataset=dset, exists=True)
+            if i == 0:
+                dset.tags.add(tag)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cmd = one_cache.Command()
+            cmd.dst_dir, cmd.compress, cmd.metadata = tmp, False, {}
+            files = cmd.generate_tag_caches(
+                ('sessions', 'datasets'), ['cachetag', 'emptytag'], int_id=False)
+            self.assertEqual(6, len(files))
+            datasets = pd.read_parquet(Path(tmp, 'datasets.pqt'))
+            self.assertEqual(2, len(datasets))
+            expected = {'alf/obj0.attr.npy', 'alf/obj1.attr.npy'}
+            self.assertEqual(expected, set(datasets['rel_path']))
+            sessions = pd.read_parquet(Path(tmp, 'cachetag', 'sessions.pqt'))
+            self.assertEqual(['cachesub'], sessions['subject'].tolist())
+            datasets = pd.read_parquet(Path(tmp, 'cachetag', 'datasets.pqt'))
+            self.assertEqual(['alf/obj0.attr.npy'], datasets['rel_path'].tolist())
+            self.assertEqual(0, len(pd.read_parquet(Path(tmp, 'emptytag', 'datasets.pqt'))))
+
+    def test_update_datasets_frame(self):
+        """Test updating the datasets table with the datasets whose availability changed"""
+        from django.utils import timezone
+        from misc.models import Lab
+        from actions.models import Session
+        from data.models import (
+            Dataset, DatasetAvailability, DatasetType, DataFormat, DataRepository, FileRecord,
+            update_dataset_availability)
+        from subjects.models import Project
+        lab = Lab.objects.create(name='updatelab')
+        subject = Subject.objects.create(nickname='updatesub', lab=lab)
+        repo = DataRepository.objects.create(name='flatiron_updatelab')
+        project = Project.objects.create(name='updateproject', default_data_repository=repo)
+        session = Session.objects.create(subject=subject, lab=lab, project=project, number=1,
+                                         start_time=datetime(2020, 1, 2, 12))
+        dset = Dataset.objects.create(
+            session=session, dataset_type=DatasetType.objects.create(object='obj', attribute='a'),
+            data_format=DataFormat.objects.create(file_extension='npy'), data_repository=repo)
+        fr = FileRecord.objects.create(dataset=dset, exists=False)
+        previous = one_cache.generate_datasets_frame(int_id=False)
+        self.assertEqual(0, len(previous))
+        # the file is found by a bulk update, which saves neither the dataset nor its session
+        past = timezone.now() - timedelta(days=1)
+        Dataset.objects.filter(pk=dset.pk).update(auto_datetime=past)
+        Session.objects.filter(pk=session.pk).update(auto_datetime=past)
+        FileRecord.objects.filter(pk=fr.pk).update(exists=True)
+        update_dataset_availability([dset.pk])
+        # within a transaction, the availability is stamped with its start time
+        since = DatasetAvailability.objects.get(pk=dset.pk).updated
+        df = one_cache.update_datasets_frame(previous, since, int_id=False)
+        self.assertEqual([str(dset.pk)], df.index.get_level_values('id').tolist())
+
+    def test_compress_tables(self):
+        """Test streaming tables into the cache zip and publishing it atomically"""
+        import io
+        import json
+        import tempfile
+        import zipfile
+        from pathlib import Path
+        import pyarrow.parquet as pq
+        table = pa.table({'id': ['a', 'b', 'c']})
+        with tempfile.TemporaryDirectory() as tmp:
+            cmd = one_cache.Command()
+            cmd.dst_dir, cmd.metadata = tmp, {'origin': 'test'}
+            table_map = {f'{tmp}/datasets.pqt': table, f'{tmp}/QC.json': [{'eid': 'a'}]}
+            zip_file, tag_file = cmd._compress_tables(table_map)
+            files = {x.name for x in Path(tmp).iterdir()}
+            self.assertEqual({'cache.zip', 'cache_info.json'}, files)
+            info = json.loads(Path(tag_file).read_text())
+            self.assertEqual(3, info['tables']['datasets']['nrecs'])
+            with zipfile.ZipFile(zip_file) as zip:
+                self.assertEqual(['datasets.pqt', 'QC.json', 'cache_info.json'], zip.namelist())
+                self.assertTrue(table.equals(pq.read_table(io.BytesIO(zip.read('datasets.pqt')))))
+                self.assertEqual(info, json.loads(zip.read('cache_info.json')))
+            # A failure should leave the previous cache in place
+            previous = Path(zip_file).read_bytes()
+            table_map[f'{tmp}/foo.csv'] = None
+            with self.assertRaises(NotImplementedError):
+                cmd._compress_tables(table_map)
+            self.assertEqual(previous, Path(zip_file).read_bytes())
+            files = {x.name for x in Path(tmp).iterdir()}
+            self.assertEqual({'cache.zip', 'cache_info.json'}, files)
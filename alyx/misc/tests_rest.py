@@ -1,16 +1,27 @@
 from datetime import datetime
-from unittest import mock
+from unittest import mock, skipIf
 from pathlib import Path
 import json
+import os
 import tempfile
 
+from django.core.cache import cache
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 
 from alyx.base import BaseTests
 from misc.models import LabMembership, Lab
-from misc.views import _get_cache_info
-from data.models import Tag
+from misc.views import _get_cache_info, _cache_info
+from data.models import DataRepository, Tag
+from actions.models import Session
+from subjects.models import Project, Subject
+
+try:
+    import pyarrow as pa
+    from misc.management.commands import one_cache  # noqa
+    SKIP_ONE_CACHE = False
+except ImportError:
+    SKIP_ONE_CACHE = True
 
 
 class APIActionsTests(BaseTests):
@@ -75,6 +86,7 @@ class TestCacheView(BaseTests):
         self.superuser = get_user_model().objects.create_user('test', 'test', 'test')
         self.client.login(username='test', password='test')
         self.tag = Tag.objects.create(name='2022_Q1_paper')
+        _cache_info.clear()
 
     def test_cache_version_view(self):
         r = self.client.get(reverse('cache-info', args=['TAG_NAME_2021']), follow=True)
@@ -85,7 +97,52 @@ class TestCacheView(BaseTests):
             req.get().json.return_value = cache_info
             r = self.client.get(reverse('cache-info'), follow=True)
             self.assertEqual(200, r.status_code)
-            self.assertEqual(r.json(), cache_info)
+            self.assertEqual(r.json(), {**cache_info, 'location': URL + '/cache.zip'})
+            # Conditional requests
+            etag = r['ETag']
+            r = self.client.get(reverse('cache-info'), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(304, r.status_code)
+            r = self.client.get(reverse('cache-info'), HTTP_IF_MODIFIED_SINCE=r['Last-Modified'])
+            self.assertEqual(304, r.status_code)
+            # The cache info should only have been fetched once
+            self.assertEqual(1, req.get().json.call_count)
+            # Once expired, the cache info should be reloaded
+            with mock.patch('misc.views.time.monotonic', return_value=float('inf')):
+                req.get().json.return_value = {**cache_info, 'min_api_version': '1.14.0'}
+                r = self.client.get(reverse('cache-info'), HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(200, r.status_code)
+                self.assertNotEqual(etag, r['ETag'])
+
+    def test_cache_download_view(self):
+        with tempfile.TemporaryDirectory() as URI, mock.patch('misc.views.TABLES_ROOT', URI):
+            data = bytes(range(100))
+            Path(URI, 'cache.zip').write_bytes(data)
+            r = self.client.get(reverse('cache-download'))
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(data, b''.join(r.streaming_content))
+            self.assertEqual('bytes', r['Accept-Ranges'])
+            etag = r['ETag']
+            r = self.client.get(reverse('cache-download'), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(304, r.status_code)
+            # Byte ranges
+            r = self.client.get(reverse('cache-download'), HTTP_RANGE='bytes=10-19')
+            self.assertEqual(206, r.status_code)
+            self.assertEqual('bytes 10-19/100', r['Content-Range'])
+            self.assertEqual(data[10:20], b''.join(r.streaming_content))
+            r = self.client.get(reverse('cache-download'), HTTP_RANGE='bytes=-5')
+            self.assertEqual(data[-5:], b''.join(r.streaming_content))
+            r = self.client.get(reverse('cache-download'), HTTP_RANGE='bytes=200-')
+            self.assertEqual(416, r.status_code)
+            self.assertEqual('bytes */100', r['Content-Range'])
+            # An invalid range should be ignored
+            r = self.client.get(reverse('cache-download'), HTTP_RANGE='bytes=19-10')
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(data, b''.join(r.streaming_content))
+            # A range with a stale If-Range should return the whole file
+            r = self.client.get(reverse('cache-download'),
+                                HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(data, b''.join(r.streaming_content))
 
     def test_get_cache_info(self):
         # First test with local file path
@@ -145,3 +202,57 @@ class TestCacheView(BaseTests):
         with mock.patch('misc.views.TABLES_ROOT', 'fs://path/to/cache'), \
                 self.assertRaises(ValueError):
             _get_cache_info()
+
+    @skipIf(SKIP_ONE_CACHE, 'Missing dependencies')
+    def test_cache_slice_view(self):
+        lab = Lab.objects.create(name='slicelab')
+        subject = Subject.objects.create(nickname='slicesub', lab=lab)
+        repo = DataRepository.objects.create(name='slicerepo')
+        project = Project.objects.create(name='sliceproject', default_data_repository=repo)
+        Session.objects.create(subject=subject, lab=lab, project=project, number=1,
+                               start_time=datetime(2020, 1, 2, 12))
+        url = reverse('cache-slice', kwargs={'table': 'sessions', 'ext': 'arrow'})
+        query = {'lab': 'slicelab', 'date_range': '2020-01-01,2020-01-31'}
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch('misc.views.CACHE_SLICES_ROOT', root):
+            r = self.client.get(url, query)
+            self.assertEqual(200, r.status_code)
+            table = pa.ipc.open_file(pa.py_buffer(b''.join(r.streaming_content))).read_all()
+            self.assertEqual(['slicesub'], table.column('subject').to_pylist())
+            files = list(Path(root).iterdir())
+            self.assertEqual(1, len(files))
+            # A second request should be served from disk
+            with mock.patch('misc.management.commands.one_cache.save_table_slice') as save:
+                r = self.client.get(url, query)
+                self.assertEqual(200, r.status_code)
+                save.assert_not_called()
+            # Adding a session should invalidate the memoized table once the version expires
+            Session.objects.create(subject=subject, lab=lab, project=project, number=2,
+                                   start_time=datetime(2020, 1, 3, 12))
+            r = self.client.get(url, query)
+            table = pa.ipc.open_file(pa.py_buffer(b''.join(r.streaming_content))).read_all()
+            self.assertEqual(1, table.num_rows)
+            cache.clear()
+            r = self.client.get(url, query)
+            table = pa.ipc.open_file(pa.py_buffer(b''.join(r.streaming_content))).read_all()
+            self.assertEqual(2, table.num_rows)
+            self.assertEqual(1, len(list(Path(root).iterdir())))
+            self.assertNotEqual(files, list(Path(root).iterdir()))
+            # A file removed by a concurrent request should be regenerated
+            next(Path(root).iterdir()).unlink()
+            r = self.client.get(url, query)
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(1, len(list(Path(root).iterdir())))
+            # Files that were not requested for a while should be evicted
+            old_file = Path(root).joinpath('old.pqt')
+            old_file.touch()
+            os.utime(old_file, (0, 0))
+            # Parquet and filter validation
+            url = reverse('cache-slice', kwargs={'table': 'datasets', 'ext': 'pqt'})
+            r = self.client.get(url, {'subject': 'slicesub'})
+            self.assertEqual(200, r.status_code)
+            self.assertEqual('application/vnd.apache.parquet', r['Content-Type'])
+            self.assertFalse(old_file.exists())
+            self.assertEqual(2, len(list(Path(root).iterdir())))
+            r = self.client.get(url, {'date_range': '2020-01-01'})
+            self.assertEqual(400, r.status_code)
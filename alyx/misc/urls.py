@@ -18,6 +18,11 @@ urlpatterns = [
     re_path("^media/(?P<img_url>.*)", mv.MediaView.as_view(), name="media"),
     path("cache.zip", mv.CacheDownloadView.as_view(), name="cache-download"),
     re_path(r"^cache/info(?:/(?P<tag>\w+))?/$", mv.CacheVersionView.as_view(), name="cache-info"),
+    re_path(
+        r"^cache/(?P<table>sessions|datasets)\.(?P<ext>pqt|arrow)$",
+        mv.CacheSliceView.as_view(),
+        name="cache-slice",
+    ),
 ]
 
 try:
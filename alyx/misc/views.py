@@ -1,25 +1,47 @@
 from pathlib import Path
+from datetime import date, datetime
+from copy import deepcopy
+import os
 import os.path as op
+import re
 import json
+import hashlib
+import threading
+import time
+import uuid
 from mimetypes import guess_type
 import urllib.parse
 import requests
 
 # from one.remote.aws import get_s3_virtual_host
 from django.contrib.auth import get_user_model
-from django.http import HttpResponse, FileResponse, JsonResponse, HttpResponseRedirect, HttpResponseNotFound, Http404
+from django.core.cache import cache
+from django.http import (
+    HttpResponse,
+    FileResponse,
+    JsonResponse,
+    HttpResponseRedirect,
+    HttpResponseNotFound,
+    StreamingHttpResponse,
+)
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import condition
 
 from rest_framework import viewsets, views
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework.reverse import reverse
 from rest_framework import generics
 
-from alyx.base import BaseFilterSet, rest_permission_classes
-from data.models import Tag
+from alyx.base import BaseFilterSet, ReferenceCacheMixin, rest_permission_classes
+from data.models import DataRepository, Tag
 from .serializers import UserSerializer, LabSerializer, NoteSerializer
 from .models import Lab, Note
-from alyx.settings import TABLES_ROOT, MEDIA_ROOT
+from alyx.settings import TABLES_ROOT, MEDIA_ROOT, CACHE_SLICES_ROOT
 
 
 @api_view(["GET"])
@@ -78,12 +100,13 @@ class LabFilter(BaseFilterSet):
         exclude = ["json"]
 
 
-class LabList(generics.ListCreateAPIView):
+class LabList(ReferenceCacheMixin, generics.ListCreateAPIView):
     queryset = Lab.objects.all()
     serializer_class = LabSerializer
     permission_classes = rest_permission_classes()
     lookup_field = "name"
     filter_class = LabFilter
+    reference_models = (Lab, DataRepository)
 
 
 class LabDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -134,7 +157,47 @@ class MediaView(views.APIView):
             return HttpResponseNotFound(f"Media not found at {path}")
 
 
+CACHE_INFO_TTL = 60  # Number of seconds the cache info is kept in memory
+_cache_info = {}  # Map of (TABLES_ROOT, tag) to (expiry time, cache info)
+_cache_info_lock = threading.Lock()
+
+
 def _get_cache_info(tag=None):
+    """
+    Return the cache info of the given tag, loading it at most once every CACHE_INFO_TTL seconds.
+
+    :param: optional tag name for fetching a specific cache
+    :return: dict of cache table information
+    """
+    key = (TABLES_ROOT, tag)
+    with _cache_info_lock:
+        expires, cache_info = _cache_info.get(key, (0, None))
+    if expires < time.monotonic():
+        cache_info = _load_cache_info(tag)
+        with _cache_info_lock:
+            _cache_info[key] = (time.monotonic() + CACHE_INFO_TTL, cache_info)
+    return deepcopy(cache_info)
+
+
+def _cache_info_etag(request, tag=None, **kwargs):
+    """Return a strong ETag for the cache info of a tag, or None if the tag doesn't exist"""
+    try:
+        cache_info = _get_cache_info(tag)
+    except Tag.DoesNotExist:
+        return None
+    return hashlib.sha1(json.dumps(cache_info, sort_keys=True).encode()).hexdigest()
+
+
+def _cache_info_last_modified(request, tag=None, **kwargs):
+    """Return the creation date of the cache of a tag, or None if unknown"""
+    try:
+        created = datetime.fromisoformat(_get_cache_info(tag)["date_created"])
+    except (Tag.DoesNotExist, KeyError, TypeError, ValueError):
+        return None
+    return timezone.make_aware(created) if timezone.is_naive(created) else created
+
+
+def _load_cache_info(tag=None):
     """
     Load and return the cache info JSON file. Contains information such as cache table timestamp,
     size and API version.
@@ -167,18 +230,18 @@ def _get_cache_info(tag=None):
         file_json_cache = f"{cache_root}/{META_NAME}"
         resp = requests.get(file_json_cache)
         resp.raise_for_status()
-        cache_info = resp.json()
+        cache_info = dict(resp.json())  # a copy, as the location is added in place
         if "location" not in cache_info:
             cache_info["location"] = cache_root + "/cache.zip"
     elif scheme == "s3":
         # Use PyArrow to read file from s3
-        from misc.management.commands.one_cache import _s3_filesystem
+        from misc.management.commands.one_cache import _s3_filesystem, get_s3_virtual_host
 
         s3 = _s3_filesystem()
         cache_root = parsed.netloc + "/" + parsed.path.strip("/") + (f"/{tag}" if tag else "")
         file_json_cache = f"{cache_root}/{META_NAME}"
         with s3.open_input_stream(file_json_cache) as stream:
-            cache_info = json.load(stream)
+            cache_info = dict(json.load(stream))
         if "location" not in cache_info:
             cache_info["location"] = get_s3_virtual_host(f"{cache_root}/cache.zip", region=s3.region)
     else:
@@ -187,9 +250,73 @@ def _get_cache_info(tag=None):
     return cache_info
 
 
+def _read_range(fh, length, chunk_size=FileResponse.block_size):
+    """Yield chunks of an open file up to a given number of bytes, then close it"""
+    with fh:
+        while length > 0 and (chunk := fh.read(min(chunk_size, length))):
+            length -= len(chunk)
+            yield chunk
+
+
+def _file_response(request, path, content_type=None):
+    """
+    Return a file response supporting conditional requests and single byte ranges.
+
+    The strong ETag and Last-Modified headers are derived from the file's modification time and
+    size. A request with an If-None-Match or If-Modified-Since header matching the file returns
+    304; a request with a Range header returns the requested bytes with status 206, unless an
+    If-Range header no longer matches the file.
+
+    :param request: The HTTP request
+    :param path: The path of the local file to serve
+    :param content_type: The response content type, guessed from the file name by default
+    :return: A response object
+    """
+    stat = os.stat(path)
+    etag = quote_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    last_modified = http_date(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is not None:  # Not modified or precondition failed
+        return response
+
+    size = stat.st_size
+    byte_range = re.fullmatch(r"bytes=(\d*)-(\d*)", request.META.get("HTTP_RANGE", "").strip())
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if byte_range and byte_range.group(1) and byte_range.group(2):
+        if int(byte_range.group(1)) > int(byte_range.group(2)):
+            byte_range = None  # An invalid range is ignored (RFC 9110)
+    if byte_range and any(byte_range.groups()) and if_range in (None, etag, last_modified):
+        start, end = byte_range.groups()
+        if start:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        else:  # Suffix range, i.e. the last n bytes
+            start, end = max(size - int(end), 0), size - 1
+        if start >= size or start > end:  # Unsatisfiable, e.g. a zero length suffix
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+        fh = open(path, "rb")
+        fh.seek(start)
+        content_type = content_type or guess_type(path)[0] or "application/octet-stream"
+        response = StreamingHttpResponse(
+            _read_range(fh, end - start + 1), status=206, content_type=content_type
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = str(end - start + 1)
+    else:
+        response = FileResponse(open(path, "rb"), content_type=content_type)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = last_modified
+    return response
+
+
 class CacheVersionView(views.APIView):
     permission_classes = rest_permission_classes()
 
+    @method_decorator(
+        condition(etag_func=_cache_info_etag, last_modified_func=_cache_info_last_modified)
+    )
     def get(self, request=None, tag=None, **kwargs):
         try:
             return JsonResponse(_get_cache_info(tag))
@@ -205,5 +332,109 @@ class CacheDownloadView(views.APIView):
             response = HttpResponseRedirect(TABLES_ROOT.strip("/") + "/cache.zip")
         else:
             cache_file = Path(TABLES_ROOT).joinpath("cache.zip")
-            response = FileResponse(open(cache_file, "br"))
+            response = _file_response(request, cache_file)
         return response
+
+
+CACHE_SLICE_VERSION_TTL = 60  # Number of seconds the records' version of a slice is cached
+CACHE_SLICE_MAX_AGE = 86400  # Number of seconds after which an unrequested slice is removed
+
+
+def _evict_cache_slices(root, max_age=CACHE_SLICE_MAX_AGE):
+    """
+    Remove the slice files, including the leftovers of failed requests, that have not been
+    requested for max_age seconds.
+
+    :param root: the folder of the cache slices
+    :param max_age: the number of seconds after which an unrequested file is removed
+    """
+    expiry = time.time() - max_age
+    for file in Path(root).iterdir():
+        try:
+            if file.stat().st_mtime < expiry:
+                file.unlink()
+        except FileNotFoundError:  # Removed by a concurrent request
+            pass
+
+
+class CacheSliceView(views.APIView):
+    """
+    Return the sessions or datasets cache table for a subset of the database, with the same
+    schema as the tables in cache.zip, as a parquet (.pqt) or Arrow IPC (.arrow) file.
+
+    Query parameters (all optional):
+
+    - **project**: project name
+    - **lab**: lab name
+    - **subject**: subject nickname
+    - **date_range**: two ISO dates separated by a comma, e.g. `2020-01-01,2020-01-31`
+    - **dataset_type**: dataset type name
+    - **tag**: dataset tag name
+    - **int_id**: if true, UUIDs are stored as pairs of int64
+
+    Tables are memoized on disk by filters and regenerated when the matching records change;
+    the records are checked for changes at most once every CACHE_SLICE_VERSION_TTL seconds and
+    the tables not requested for CACHE_SLICE_MAX_AGE seconds are removed.
+    """
+
+    permission_classes = rest_permission_classes()
+    content_types = {
+        "pqt": "application/vnd.apache.parquet",
+        "arrow": "application/vnd.apache.arrow.file",
+    }
+
+    def get(self, request=None, table=None, ext=None, **kwargs):
+        from misc.management.commands import one_cache
+
+        params = request.query_params
+        fields = ("project", "lab", "subject", "dataset_type")
+        filters = {k: params[k] for k in fields if params.get(k)}
+        if params.get("tag"):
+            filters["tags"] = params["tag"]
+        if params.get("date_range"):
+            try:
+                start, end = map(date.fromisoformat, params["date_range"].split(","))
+            except ValueError:
+                raise ValidationError(
+                    {"date_range": "Expected two ISO dates separated by a comma"}
+                )
+            filters["date_range"] = (start, end)
+        int_id = params.get("int_id", "").lower() in ("1", "true")
+
+        # Files are named by a hash of the filters, followed by a hash of the records' version
+        key = {"table": table, "int_id": int_id, **filters}
+        key = hashlib.sha1(json.dumps(key, default=str, sort_keys=True).encode()).hexdigest()
+        version_key = f"alyx:cache-slice:{key}"
+        version = cache.get(version_key)
+        if version is None:
+            version = one_cache.table_slice_version(table, **filters)
+            version = hashlib.sha1(version.encode()).hexdigest()
+            cache.set(version_key, version, CACHE_SLICE_VERSION_TTL)
+        root = Path(CACHE_SLICES_ROOT)
+        filename = root / f"{key}_{version}.{ext}"
+        try:
+            file = open(filename, "rb")
+            os.utime(file.fileno())  # Slices are evicted by last request time
+        except FileNotFoundError:  # Not generated yet or removed by a concurrent request
+            root.mkdir(parents=True, exist_ok=True)
+            metadata = {
+                **one_cache.create_metadata(),
+                "filters": json.loads(json.dumps(filters, default=str)),
+            }
+            tmp = filename.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            one_cache.save_table_slice(
+                str(tmp), table, fmt=ext, int_id=int_id, metadata=metadata, **filters
+            )
+            # Open before publishing so that the file may not be removed before it is served
+            file = open(tmp, "rb")
+            os.replace(tmp, filename)
+            for stale in root.glob(f"{key}_*.{ext}"):
+                if stale != filename:
+                    stale.unlink(missing_ok=True)
+            _evict_cache_slices(root)
+        return FileResponse(
+            file,
+            content_type=self.content_types[ext],
+            as_attachment=True,
+            filename=f"{table}.{ext}",
+        )
@@ -12,7 +12,7 @@ from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
-from alyx.base import BaseModel, alyx_mail, modify_fields
+from alyx.base import BaseModel, ReferenceManager, alyx_mail, modify_fields, reference_table
 from actions.notifications import responsible_user_changed
 from actions.water_control import water_control
 from actions.models import Surgery, WaterAdministration
@@ -112,7 +112,10 @@ def default_species():
     )[0].pk
 
 
+@reference_table
 class Project(BaseModel):
+    objects = ReferenceManager()
+
     name = models.CharField(max_length=255, unique=True)
     description = models.CharField(max_length=1023, blank=True, help_text="Description of the project")
 
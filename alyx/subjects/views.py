@@ -1,7 +1,7 @@
 from rest_framework import generics
 import django_filters
 
-from alyx.base import BaseFilterSet, rest_permission_classes
+from alyx.base import BaseFilterSet, ReferenceCacheMixin, rest_permission_classes
 from .models import Subject, Project
 from .serializers import (SubjectListSerializer,
                           SubjectDetailSerializer,
@@ -59,7 +59,7 @@ class SubjectDetail(generics.RetrieveUpdateDestroyAPIView):
     lookup_field = 'nickname'
 
 
-class ProjectList(generics.ListCreateAPIView):
+class ProjectList(ReferenceCacheMixin, generics.ListCreateAPIView):
     queryset = Project.objects.all()
     serializer_class = ProjectSerializer
     permission_classes = rest_permission_classes()